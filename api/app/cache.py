@@ -0,0 +1,194 @@
+"""Cache shared by all worker processes on the host.
+
+Entries are files in a local directory, keyed by a hash of their content. An
+entry is written to a temporary file and published with an atomic rename, so
+readers never see a partial entry. Reading an entry touches its modification
+time, and the least recently used entries are evicted when the total size of
+the cache exceeds its limit.
+
+Every worker keeps an estimate of the total size: the size found when it last
+scanned the directory, plus the entries it published since. The directory is
+only scanned, under a lock shared by the workers, when the estimate crosses
+the limit. The entries published by the other workers are not part of the
+estimate, so the cache may exceed its limit until one of them scans it.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from app.memory import SpillStore
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from rdflib import Graph
+
+logger = logging.getLogger("uvicorn.error")
+
+CACHE_DIR = Path(
+    os.getenv("CACHE_DIR", Path(tempfile.gettempdir()) / "rdf-explorer-cache")
+)
+# Total size of the cache in bytes, 0 disables the cache:
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Evict down to this fraction of the limit, to not evict on every write:
+EVICTION_TARGET = 0.9
+LOCK_FILE = ".lock"
+# Part of every key, bump it when the format of the cached content changes:
+CACHE_VERSION = "2"
+
+
+def private_directory(directory: Path) -> Path:
+    """Create a directory for the current user only, or check that it is one.
+
+    Its files are loaded with pickle, so a directory that another user owns or
+    may write to, or a symbolic link to one, is refused.
+    """
+    directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = directory.lstat()
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or stat.S_IMODE(info.st_mode) != 0o700  # noqa: PLR2004
+    ):
+        msg = f"{directory} must be a directory owned by the current user, mode 0700"
+        raise PermissionError(msg)
+    return directory
+
+
+def cache_key(kind: str, *parts: str) -> str:
+    """Get the key of an entry from its kind and the content it is derived from."""
+    digest = hashlib.sha256()
+    for part in (CACHE_VERSION, *parts):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return f"{kind}-{digest.hexdigest()}"
+
+
+class SharedCache:
+    """A size-limited, least recently used cache of bytes in a local directory."""
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        """Create the cache directory, or check it, for the current user only."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # The estimated size of the cache, None until it is scanned:
+        self.size: int | None = None
+        self.size_lock = threading.Lock()
+        if self.enabled:
+            private_directory(directory)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache holds any entries."""
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> bytes | None:
+        """Get an entry, or None if it is not in the cache."""
+        if not self.enabled:
+            return None
+        path = self.directory / key
+        try:
+            value = path.read_bytes()
+            # Mark the entry as recently used:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        """Publish an entry, and evict old entries if the cache is full."""
+        if not self.enabled or len(value) > self.max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            Path(tmp).replace(self.directory / key)
+        except OSError:  # pragma: no cover
+            logger.exception("Error writing cache entry %s", key)
+            Path(tmp).unlink(missing_ok=True)
+            return
+        with self.size_lock:
+            if self.size is not None:
+                self.size += len(value)
+            full = self.size is None or self.size > self.max_bytes
+        if full:
+            self.evict()
+
+    def delete(self, prefix: str) -> None:
+        """Delete all entries whose key starts with the prefix."""
+        if not self.enabled:
+            return
+        for path in self.directory.glob(f"{prefix}*"):
+            path.unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until the cache fits its limit.
+
+        The size left is the new estimate of the size of the cache.
+        """
+        with self._lock():
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                # Most recently used first, so that the oldest entry is popped:
+                entries.sort(reverse=True)
+                while total > self.max_bytes * EVICTION_TARGET:
+                    _, size, path = entries.pop()
+                    Path(path).unlink(missing_ok=True)
+                    total -= size
+            with self.size_lock:
+                self.size = total
+
+    def get_graph(self, key: str) -> Graph | None:
+        """Get a parsed graph, or None if it is not in the cache."""
+        return self.get_object(key)
+
+    def put_graph(self, key: str, graph: Graph) -> None:
+        """Publish a parsed graph, unless it was spilled to disk for its size."""
+        if isinstance(graph.store, SpillStore) and graph.store.spilled:
+            return
+        self.put_object(key, graph)
+
+    def get_object(self, key: str) -> Any:  # noqa: ANN401
+        """Get a pickled object, or None if it is not in the cache."""
+        value = self.get(key)
+        if value is None:
+            return None
+        # The entries are written by this application only, in a private directory:
+        return pickle.loads(value)  # noqa: S301
+
+    def put_object(self, key: str, value: object) -> None:
+        """Publish an object, pickled."""
+        if self.enabled:
+            self.put(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @contextlib.contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Hold an exclusive lock on the cache, across processes."""
+        with (self.directory / LOCK_FILE).open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+cache = SharedCache(CACHE_DIR, CACHE_MAX_BYTES)
@@ -0,0 +1,424 @@
+"""Server-held datasets, changed with SPARQL Update in batched transactions.
+
+A dataset is an immutable snapshot graph and its version. Readers take the
+current snapshot and keep it for the whole request, while writes are applied
+to a copy of it. Updates that arrive while a transaction commits are grouped
+into the next one, which copies and indexes the snapshot once for all of
+them. The new snapshot is then published, to disk for the other workers and
+by a single swap in this one, and the cached closures and results of the
+dataset are invalidated under the same lock. Its materialized views are then
+brought to the new version, once the lock is released; queries are evaluated
+on the snapshot until their view holds for it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import fcntl
+import os
+import pickle
+import tempfile
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Annotated, NamedTuple
+
+from pydantic import StringConstraints
+from rdflib import Graph
+from rdflib.plugins.stores.memory import Memory
+
+from app.cache import cache, cache_key, private_directory
+from app.inference import InferenceMode, expand
+from app.memory import SpillStore, charge, governed_graph
+from app.views import Delta, MaterializedView, materialize, refresh
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from rdflib.plugins.sparql.sparql import Update
+    from rdflib.term import Node
+
+    type Triple = tuple[Node, Node, Node]
+
+DATASETS_DIR = Path(
+    os.getenv("DATASETS_DIR", Path(tempfile.gettempdir()) / "rdf-explorer-datasets")
+)
+# Dataset names are used in file names and cache keys:
+DATASET_NAME_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+DatasetName = Annotated[str, StringConstraints(pattern=DATASET_NAME_PATTERN)]
+# Update operations that only read and write the default graph of the dataset:
+UPDATE_OPERATIONS = ("InsertData", "DeleteData", "Modify", "DeleteWhere")
+
+
+class UpdateError(Exception):
+    """Raised when an update of a batch fails, the others are committed."""
+
+
+class UpdateResult(NamedTuple):
+    """The version an update was committed in, and the triples it changed."""
+
+    version: int
+    added: int
+    removed: int
+    length: int
+
+
+class DeltaStore(Memory):
+    """An in-memory store that records the triples added to and removed from it."""
+
+    def __init__(self) -> None:
+        """Start with no changes recorded."""
+        super().__init__()
+        self.added: set[Triple] = set()
+        self.removed: set[Triple] = set()
+
+    def add(self, triple: Triple, context: Graph, *, quoted: bool = False) -> None:
+        """Add a triple, and record it if it is new."""
+        exists = next(self.triples(triple, None), None) is not None
+        super().add(triple, context, quoted=quoted)
+        if not exists:
+            if triple in self.removed:
+                self.removed.discard(triple)
+            else:
+                self.added.add(triple)
+
+    def remove(self, triple_pattern: Triple, context: Graph | None = None) -> None:
+        """Remove the triples matching a pattern, and record them."""
+        for triple, _ in list(self.triples(triple_pattern, context)):
+            if triple in self.added:
+                self.added.discard(triple)
+            else:
+                self.removed.add(triple)
+        super().remove(triple_pattern, context)
+
+    def reset(self) -> tuple[set[Triple], set[Triple]]:
+        """Get the changes recorded so far, and start recording anew."""
+        added, removed = self.added, self.removed
+        self.added, self.removed = set(), set()
+        return added, removed
+
+
+class Dataset:
+    """A named dataset, persisted in a directory shared by the workers."""
+
+    def __init__(self, name: str, directory: Path) -> None:
+        """Hold no snapshot until one is read."""
+        self.name = name
+        self.directory = directory
+        self.state: tuple[int, Graph] = (0, Graph())
+        self.pending: list[tuple[Update, asyncio.Future[UpdateResult]]] = []
+        self.committer: asyncio.Task[None] | None = None
+        self.loading = threading.Lock()
+        # The views last read, by the identity of their file:
+        self.views_state: tuple[tuple[int, int], dict[str, MaterializedView]] = (
+            (0, 0),
+            {},
+        )
+
+    @property
+    def cache_prefix(self) -> str:
+        """Get the prefix of the cache keys of the closures and results."""
+        return f"dataset.{self.name}."
+
+    def version(self) -> int | None:
+        """Get the latest version of the dataset, or None if it does not exist."""
+        try:
+            return int((self.directory / f"{self.name}.version").read_text())
+        except FileNotFoundError:
+            return None
+
+    def length(self) -> int:
+        """Get the number of triples of the latest version, without loading it.
+
+        Falls back to the snapshot held if the number was not persisted.
+        """
+        try:
+            return int((self.directory / f"{self.name}.length").read_text())
+        except FileNotFoundError:
+            return len(self.state[1])
+
+    def snapshot(self) -> tuple[int, Graph]:
+        """Get the latest version of the dataset and its graph.
+
+        The graph must not be changed, readers keep it for their whole request.
+        Raises KeyError if the dataset does not exist.
+        """
+        version = self.version()
+        if version is None:
+            raise KeyError(self.name)
+        # Versions only grow, even across deletion, but reload on any change so
+        # that a snapshot of a deleted dataset is never served:
+        if version != self.state[0]:
+            with self.loading:
+                # Another thread may have loaded it meanwhile:
+                if version != self.state[0]:  # pragma: no branch
+                    data = (self.directory / f"{self.name}.pickle").read_bytes()
+                    # Written by this application only, in a private directory:
+                    self.state = pickle.loads(data)  # noqa: S301
+        return self.state
+
+    def graph(self, inference: InferenceMode) -> tuple[int, Graph]:
+        """Get the latest snapshot, with inferred triples if requested.
+
+        The closure is shared with the other workers through the cache.
+        """
+        version, graph = self.snapshot()
+        if inference in (InferenceMode.NONE, InferenceMode.REWRITE):
+            return version, graph
+        key = cache_key(self.cache_prefix + "graph", str(version), inference)
+        closure = cache.get_graph(key)
+        if closure is None:
+            closure = copy_graph(graph, governed_graph())
+            expand(closure, inference)
+            charge(closure)
+            cache.put_graph(key, closure)
+        return version, closure
+
+    def views(self) -> dict[str, MaterializedView]:
+        """Get the materialized views of the dataset, by name."""
+        try:
+            stat = (self.directory / f"{self.name}.views").stat()
+        except FileNotFoundError:
+            return {}
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        if identity != self.views_state[0]:
+            data = (self.directory / f"{self.name}.views").read_bytes()
+            # Written by this application only, in a private directory:
+            self.views_state = (identity, pickle.loads(data))  # noqa: S301
+        return self.views_state[1]
+
+    def view(self, query: str) -> MaterializedView | None:
+        """Get a view of the latest version with the same query, if there is one."""
+        version = self.version()
+        return next(
+            (
+                view
+                for view in self.views().values()
+                if view.version == version and view.matches(query)
+            ),
+            None,
+        )
+
+    def put_view(self, name: str, query: str) -> MaterializedView:
+        """Register a view, or replace it, and materialize it on the latest version.
+
+        Raises KeyError if the dataset does not exist.
+        """
+        with self._lock():
+            version, graph = self.snapshot()
+            view = materialize(query, graph, version)
+            self._write("views", pickle.dumps({**self.views(), name: view}))
+        return view
+
+    def delete_view(self, name: str) -> None:
+        """Delete a view. Raises KeyError if it does not exist."""
+        with self._lock():
+            views = dict(self.views())
+            del views[name]
+            self._write("views", pickle.dumps(views))
+
+    def replace(self, graph: Graph) -> int:
+        """Replace the graph of the dataset, creating it if needed.
+
+        Snapshots are held in memory, so a governed graph is copied into one.
+        """
+        if isinstance(graph.store, SpillStore):
+            graph = copy_graph(graph, Graph())
+        with self._lock():
+            version = self._last_version() + 1
+            self._publish(version, graph)
+        self._refresh_views(version, graph, None)
+        return version
+
+    def delete(self) -> None:
+        """Delete the dataset, its views and its cached closures and results."""
+        with self._lock():
+            # Keep the last version, so that a new dataset with the same name
+            # gets versions, and cache keys, the deleted one never had:
+            self._write("generation", str(self._last_version()).encode())
+            for suffix in ("version", "length", "pickle", "views"):
+                (self.directory / f"{self.name}.{suffix}").unlink(missing_ok=True)
+            cache.delete(self.cache_prefix)
+
+    async def update(self, update: Update) -> UpdateResult:
+        """Apply an update in the next transaction and get its result.
+
+        The update is committed even if the request is cancelled meanwhile.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((update, future))
+        if self.committer is None:
+            self.committer = asyncio.create_task(self._commit_pending())
+        return await asyncio.shield(future)
+
+    async def _commit_pending(self) -> None:
+        """Commit the pending updates, in batches, until there are none left."""
+        try:
+            while self.pending:
+                batch, self.pending = self.pending, []
+                try:
+                    results = await asyncio.to_thread(
+                        self.commit, [update for update, _ in batch]
+                    )
+                except Exception as e:  # noqa: BLE001 # pragma: no cover
+                    results = [e] * len(batch)
+                for (_, future), result in zip(batch, results, strict=True):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        finally:
+            self.committer = None
+
+    def commit(self, updates: list[Update]) -> list[UpdateResult | Exception]:
+        """Apply a batch of updates to a copy of the latest snapshot and publish it.
+
+        Every update is atomic: a failed update is rolled back and the others
+        are committed. The whole snapshot is copied and persisted, however few
+        triples the updates change, so that readers never see a partial
+        version; batching updates spreads this cost over them.
+        """
+        with self._lock():
+            version, snapshot = self.snapshot()
+            store = DeltaStore()
+            working = copy_graph(snapshot, Graph(store=store))
+            store.reset()
+            deltas: list[tuple[set[Triple], set[Triple]] | Exception] = []
+            predicates: set[Node] = set()
+            # The net changes of the batch, for the views:
+            net_added: set[Triple] = set()
+            net_removed: set[Triple] = set()
+            for update in updates:
+                try:
+                    working.update(update)
+                except Exception as e:  # noqa: BLE001
+                    # Roll back the triples changed by the failed update:
+                    working -= list(store.added)
+                    working += list(store.removed)
+                    store.reset()
+                    deltas.append(UpdateError(str(e)))
+                    continue
+                added, removed = store.reset()
+                predicates.update(p for _, p, _ in added | removed)
+                deltas.append((added, removed))
+                net_added, net_removed = (
+                    (net_added - removed) | (added - net_removed),
+                    (net_removed - added) | (removed - net_added),
+                )
+            if predicates:
+                version += 1
+                self._publish(version, working)
+        if predicates:
+            self._refresh_views(
+                version, working, Delta(snapshot, net_added, net_removed)
+            )
+        return [
+            delta
+            if isinstance(delta, Exception)
+            else UpdateResult(
+                version=version,
+                added=len(delta[0]),
+                removed=len(delta[1]),
+                length=len(working),
+            )
+            for delta in deltas
+        ]
+
+    def _publish(self, version: int, graph: Graph) -> None:
+        """Persist a new snapshot, swap it in and invalidate the cache."""
+        state = (version, graph)
+        self._write("pickle", pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        self._write("length", str(len(graph)).encode())
+        self._write("version", str(version).encode())
+        self.state = state
+        cache.delete(self.cache_prefix)
+
+    def _refresh_views(self, version: int, graph: Graph, delta: Delta | None) -> None:
+        """Bring the views to a new version, without holding the lock meanwhile.
+
+        The delta holds the changes from the previous version, None means that
+        any triple may have changed. Views replaced or refreshed for a later
+        version meanwhile are kept.
+        """
+        refreshed = {
+            name: refresh(view, graph, version, delta)
+            for name, view in self.views().items()
+            if view.version < version
+        }
+        if not refreshed:
+            return
+        with self._lock():
+            views = self.views()
+            kept = {
+                name: view
+                for name, view in refreshed.items()
+                if name in views
+                and views[name].query == view.query
+                and views[name].version < version
+            }
+            if kept:
+                self._write("views", pickle.dumps({**views, **kept}))
+
+    def _last_version(self) -> int:
+        """Get the latest version of the dataset, or of its deleted predecessors."""
+        version = self.version()
+        if version is not None:
+            return version
+        try:
+            return int((self.directory / f"{self.name}.generation").read_text())
+        except FileNotFoundError:
+            return 0
+
+    def _write(self, suffix: str, content: bytes) -> None:
+        """Replace a file of the dataset atomically."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        Path(tmp).replace(self.directory / f"{self.name}.{suffix}")
+
+    @contextlib.contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Hold an exclusive lock on the dataset, across processes."""
+        private_directory(self.directory)
+        with (self.directory / f"{self.name}.lock").open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def copy_graph(graph: Graph, target: Graph) -> Graph:
+    """Add the triples and prefixes of a graph, in bulk, to a target graph."""
+    for prefix, namespace in graph.namespaces():
+        target.bind(prefix, namespace, override=False)
+    target += graph
+    return target
+
+
+class Datasets:
+    """The datasets held by the server, loaded on demand by every worker."""
+
+    def __init__(self, directory: Path) -> None:
+        """Hold no datasets until they are used, in a directory of the current user."""
+        self.directory = private_directory(directory)
+        self.held: dict[str, Dataset] = {}
+
+    def get(self, name: str) -> Dataset | None:
+        """Get a dataset, or None if it does not exist."""
+        dataset = self.held.get(name) or Dataset(name, self.directory)
+        if dataset.version() is None:
+            self.held.pop(name, None)
+            return None
+        self.held[name] = dataset
+        return dataset
+
+    def create(self, name: str, graph: Graph) -> Dataset:
+        """Create or replace a dataset."""
+        dataset = self.held.get(name) or Dataset(name, self.directory)
+        dataset.replace(graph)
+        self.held[name] = dataset
+        return dataset
+
+
+datasets = Datasets(DATASETS_DIR)
@@ -0,0 +1,161 @@
+"""Plans of SPARQL queries, with the rows and time of every operator.
+
+The plan of a query is its algebra tree, as it is evaluated after the
+optimisations of the endpoint. To analyze a query, it is run with every
+operator it evaluates wrapped in a generator that counts the solutions the
+operator produces and the time spent producing them, including the time spent
+in its operands. Operators evaluated more than once, like the right operand
+of a lazy join, add up their calls.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import TYPE_CHECKING, Any
+
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evaluate import evalPart
+from rdflib.plugins.sparql.parserutils import CompValue
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+
+    from rdflib.plugins.sparql.sparql import QueryContext
+
+# Operands of an operator in the algebra, in evaluation order:
+OPERANDS = ("p", "p1", "p2")
+# The query forms return their result, not solutions to measure:
+QUERY_FORMS = ("SelectQuery", "AskQuery", "ConstructQuery", "DescribeQuery")
+
+
+class Explain(StrEnum):
+    """Enum for the explain modes of a query.
+
+    NONE: run the query.
+    PLAN: get the plan of the query, without running it.
+    ANALYZE: run the query and get its plan, with the rows and time of every
+    operator.
+    """
+
+    NONE = "none"
+    PLAN = "plan"
+    ANALYZE = "analyze"
+
+
+@dataclass
+class OperatorStats:
+    """The calls of an operator, the solutions it produced and the time it took."""
+
+    calls: int = 0
+    rows: int = 0
+    time: float = 0.0
+
+
+@dataclass
+class Analysis:
+    """The stats of the operators of a query, by the identity of their node."""
+
+    operators: dict[int, OperatorStats] = field(default_factory=dict)
+    # Operators being dispatched to their evaluation function:
+    dispatching: set[int] = field(default_factory=set)
+
+
+analysis: ContextVar[Analysis | None] = ContextVar("analysis", default=None)
+
+
+@contextlib.contextmanager
+def analyze() -> Iterator[Analysis]:
+    """Measure the operators of the queries evaluated in the context."""
+    current = Analysis()
+    token = analysis.set(current)
+    try:
+        yield current
+    finally:
+        analysis.reset(token)
+
+
+def evaluate_measured(ctx: QueryContext, part: CompValue) -> Any:  # noqa: ANN401
+    """Evaluate an operator, measuring it if a query is being analyzed.
+
+    Registered as a custom evaluation function of rdflib, that dispatches the
+    operator back to its own evaluation function.
+    """
+    current = analysis.get()
+    if current is None or part.name in QUERY_FORMS or id(part) in current.dispatching:
+        raise NotImplementedError
+    stats = current.operators.setdefault(id(part), OperatorStats())
+    stats.calls += 1
+    start = time.perf_counter()
+    current.dispatching.add(id(part))
+    try:
+        solutions = evalPart(ctx, part)
+    finally:
+        current.dispatching.discard(id(part))
+        stats.time += time.perf_counter() - start
+    return measured(solutions, stats)
+
+
+CUSTOM_EVALS["rdf-explorer-analyze"] = evaluate_measured
+
+
+def measured(solutions: Iterable[Any], stats: OperatorStats) -> Iterator[Any]:
+    """Count the solutions of an operator, and the time taken to produce them."""
+    iterator = iter(solutions)
+    while True:
+        start = time.perf_counter()
+        try:
+            solution = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stats.time += time.perf_counter() - start
+        stats.rows += 1
+        yield solution
+
+
+def describe_plan(node: CompValue, current: Analysis | None = None) -> dict[str, Any]:
+    """Describe an operator of the algebra and its operands, with their stats."""
+    stats = None if current is None else current.operators.get(id(node))
+    return {
+        "operator": node.name,
+        "detail": detail(node),
+        "calls": None if stats is None else stats.calls,
+        "rows": None if stats is None else stats.rows,
+        "time": None if stats is None else round(stats.time, 6),
+        "operands": [
+            describe_plan(operand, current)
+            for operand in (getattr(node, key) for key in OPERANDS)
+            if isinstance(operand, CompValue)
+        ],
+    }
+
+
+def detail(node: CompValue) -> str | None:
+    """Describe the arguments of an operator that tell it apart."""
+    describe = DETAILS.get(node.name)
+    return None if describe is None else describe(node)
+
+
+def filter_detail(node: CompValue) -> str:
+    """Describe the expression of a FILTER by its function or operator."""
+    if isinstance(node.expr, CompValue):
+        return node.expr.name
+    return node.expr.n3()
+
+
+# How to describe the arguments of an operator, by operator:
+DETAILS: dict[str, Callable[[CompValue], str | None]] = {
+    "BGP": lambda node: " . ".join(
+        " ".join(term.n3() for term in triple) for triple in node.triples
+    ),
+    "Project": lambda node: " ".join(variable.n3() for variable in node.PV),
+    "Extend": lambda node: node.var.n3(),
+    "Filter": filter_detail,
+    "Slice": lambda node: f"offset {node.start}, limit {node.length}",
+    "values": lambda node: f"{len(node.res)} rows",
+    "Join": lambda node: "lazy" if node.lazy else None,
+}
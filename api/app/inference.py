@@ -0,0 +1,189 @@
+"""Entailment regimes for RDF data graphs."""
+
+from __future__ import annotations
+
+from enum import StrEnum
+from typing import TYPE_CHECKING, Annotated, Any
+
+from owlrl import DeductiveClosure, OWLRL_Semantics, RDFS_Semantics
+from pydantic import BeforeValidator
+from rdflib import RDF, RDFS, Graph, Literal, URIRef
+from rdflib.paths import AlternativePath, MulPath, Path, SequencePath
+from rdflib.plugins.sparql.algebra import traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from rdflib.namespace import NamespaceManager
+    from rdflib.plugins.sparql.sparql import Query
+    from rdflib.term import Node
+
+
+class InferenceMode(StrEnum):
+    """Enum for the supported entailment regimes.
+
+    NONE: no inference.
+    RDFS: full RDFS closure.
+    OWL_RL_LITE: subclass, subproperty, domain and range only.
+    OWL_RL: full OWL 2 RL closure.
+    REWRITE: no materialisation, rdf:type and subproperty patterns in the query
+    are expanded at query time.
+    """
+
+    NONE = "none"
+    RDFS = "rdfs"
+    OWL_RL_LITE = "owl-rl-lite"
+    OWL_RL = "owl-rl"
+    REWRITE = "rewrite"
+
+
+def _from_bool(value: Any) -> Any:  # noqa: ANN401
+    """Map the legacy boolean inference flag onto an inference mode."""
+    if isinstance(value, bool):
+        return InferenceMode.OWL_RL if value else InferenceMode.NONE
+    return value
+
+
+# Accepts both an inference mode and the legacy true/false flag:
+Inference = Annotated[InferenceMode, BeforeValidator(_from_bool)]
+
+
+def expand(graph: Graph, mode: InferenceMode) -> None:
+    """Materialise the closure of the graph, in place, for the given mode."""
+    if mode == InferenceMode.RDFS:
+        DeductiveClosure(RDFS_Semantics).expand(graph)
+    elif mode == InferenceMode.OWL_RL:
+        DeductiveClosure(OWLRL_Semantics).expand(graph)
+    elif mode == InferenceMode.OWL_RL_LITE:
+        _expand_lite(graph)
+
+
+def _ancestors(graph: Graph, predicate: URIRef) -> dict[Node, set[Node]]:
+    """Get the reflexive, transitive closure of a hierarchy, keyed by the child."""
+    parents: dict[Node, set[Node]] = {}
+    for child, parent in graph.subject_objects(predicate):
+        parents.setdefault(child, set()).add(parent)
+    closure: dict[Node, set[Node]] = {}
+    for start in parents:
+        seen = {start}
+        stack = [start]
+        while stack:
+            for parent in parents.get(stack.pop(), ()):
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        closure[start] = seen
+    return closure
+
+
+def _expand_lite(graph: Graph) -> None:
+    """Materialise subclass, subproperty, domain and range entailments.
+
+    The transitive closures of the hierarchies are computed first, and their
+    triples added to the graph. The other rules produce no schema triples, so
+    a single pass over the data in the order subproperty, domain/range,
+    subclass then reaches the fixpoint.
+    """
+    super_properties = _ancestors(graph, RDFS.subPropertyOf)
+    super_classes = _ancestors(graph, RDFS.subClassOf)
+
+    # scm-spo, scm-sco: (c subClassOf d), (d subClassOf e) -> (c subClassOf e)
+    inferred = [
+        (child, predicate, parent, graph)
+        for predicate, ancestors in (
+            (RDFS.subPropertyOf, super_properties),
+            (RDFS.subClassOf, super_classes),
+        )
+        for child, parents in ancestors.items()
+        for parent in parents
+        if parent != child
+    ]
+    graph.addN(inferred)
+
+    # prp-spo1: (x p y), (p subPropertyOf q) -> (x q y)
+    inferred = [
+        (s, q, o, graph)
+        for p, supers in super_properties.items()
+        for s, o in graph.subject_objects(p)
+        for q in supers
+        if q != p
+    ]
+    graph.addN(inferred)
+
+    # prp-dom, prp-rng: (p domain c), (x p y) -> (x a c) ; (p range c) -> (y a c)
+    inferred = [
+        (s, RDF.type, c, graph)
+        for p, c in graph.subject_objects(RDFS.domain)
+        for s in graph.subjects(p)
+    ]
+    inferred += [
+        (o, RDF.type, c, graph)
+        for p, c in graph.subject_objects(RDFS.range)
+        for o in graph.objects(None, p)
+        if not isinstance(o, Literal)
+    ]
+    graph.addN(inferred)
+
+    # cax-sco: (x a c), (c subClassOf d) -> (x a d)
+    inferred = [
+        (s, RDF.type, d, graph)
+        for c, supers in super_classes.items()
+        for s in graph.subjects(RDF.type, c)
+        for d in supers
+        if d != c
+    ]
+    graph.addN(inferred)
+
+
+class _DistinctPath(Path):
+    """A property path that yields every (subject, object) pair only once.
+
+    Mimics materialised entailment, where an inferred triple exists once even
+    if it can be derived in several ways.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def eval(
+        self,
+        graph: Graph,
+        subj: Node | None = None,
+        obj: Node | None = None,
+    ) -> Iterator[tuple[Node, Node]]:
+        seen: set[tuple[Node, Node]] = set()
+        for pair in self.path.eval(graph, subj, obj):
+            if pair not in seen:
+                seen.add(pair)
+                yield pair
+
+    def n3(self, namespace_manager: NamespaceManager | None = None) -> str:
+        return self.path.n3(namespace_manager)
+
+
+def rewrite_query(query: Query, graph: Graph) -> None:
+    """Expand rdf:type and subproperty patterns in the query algebra, in place.
+
+    Triple patterns with rdf:type become rdf:type/rdfs:subClassOf*, and
+    patterns with a property that has subproperties in the graph become an
+    alternative over the property and all its subproperties.
+    """
+    has_subclasses = (None, RDFS.subClassOf, None) in graph
+    sub_properties: dict[Node, set[Node]] = {}
+    for child, parents in _ancestors(graph, RDFS.subPropertyOf).items():
+        for parent in parents:
+            sub_properties.setdefault(parent, {parent}).add(child)
+
+    def rewrite_predicate(predicate: Any) -> Any:  # noqa: ANN401
+        if predicate == RDF.type and has_subclasses:
+            return _DistinctPath(SequencePath(RDF.type, MulPath(RDFS.subClassOf, "*")))
+        if len(sub_properties.get(predicate, ())) > 1:
+            return _DistinctPath(AlternativePath(*sorted(sub_properties[predicate])))
+        return predicate
+
+    def rewrite_bgp(part: Any) -> None:  # noqa: ANN401
+        if isinstance(part, CompValue) and part.name == "BGP":
+            part["triples"] = [(s, rewrite_predicate(p), o) for s, p, o in part.triples]
+
+    traverse(query.algebra, visitPost=rewrite_bgp)
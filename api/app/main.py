@@ -1,9 +1,22 @@
 """API for running SPARQL queries on RDF data."""
 
-from fastapi import FastAPI
+from __future__ import annotations
+
+from http import HTTPStatus
+from typing import TYPE_CHECKING
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+
+from app.memory import request_memory
+from app.routers import datasets, prefixes, shacl, sparql, status
+from app.scheduler import Overloaded
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
 
-from app.routers import prefixes, shacl, sparql
+    from fastapi import Response
 
 app = FastAPI()
 
@@ -28,7 +41,28 @@ async def health_check() -> dict[str, str]:
     return {"status": "OK"}
 
 
+@app.middleware("http")
+async def account_memory(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    """Account for the memory of the graphs built for a request."""
+    with request_memory():
+        return await call_next(request)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(_: Request, exc: Overloaded) -> JSONResponse:
+    """Shed load with 429 Too Many Requests when the queues are full."""
+    return JSONResponse(
+        status_code=HTTPStatus.TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 # Set up routes:
 app.include_router(sparql.router)
 app.include_router(shacl.router)
 app.include_router(prefixes.router)
+app.include_router(datasets.router)
+app.include_router(status.router)
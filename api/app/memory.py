@@ -0,0 +1,370 @@
+"""Memory governance for the graphs parsed from request data.
+
+The graphs of requests are held by a SpillStore, which accounts for the
+triples added to it, while the data is parsed and while the inference closure
+is materialised, against the request it is built for and against the worker.
+When the request or the worker crosses its limit, the store moves its triples
+to an SQLite database in a temporary file and keeps them there from then on.
+Queries and validations run on the disk-backed graph, more slowly, instead of
+the worker running out of memory.
+
+The memory held by a graph is estimated from its number of triples.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from rdflib import BNode, Graph, Literal, URIRef
+from rdflib.plugins.stores.memory import Memory
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+    from rdflib.term import Node
+
+    type Triple = tuple[Node, Node, Node]
+    type TriplePattern = tuple[Node | None, Node | None, Node | None]
+
+logger = logging.getLogger("uvicorn.error")
+
+# Estimated memory of a triple held by an in-memory graph:
+MEMORY_BYTES_PER_TRIPLE = int(os.getenv("MEMORY_BYTES_PER_TRIPLE", "1500"))
+# Memory the graphs of a request, and of all requests of a worker, may hold:
+MEMORY_REQUEST_BYTES = int(os.getenv("MEMORY_REQUEST_BYTES", str(1024**3)))
+MEMORY_WORKER_BYTES = int(os.getenv("MEMORY_WORKER_BYTES", str(4 * 1024**3)))
+SPILL_DIR = Path(os.getenv("SPILL_DIR", tempfile.gettempdir()))
+# Triples accounted at a time, so that the lock is not taken for every triple:
+CHARGE_TRIPLES = 1024
+
+
+@dataclass
+class MemoryAccount:
+    """The estimated memory held by the graphs of a request or of a worker."""
+
+    limit: int
+    held: int = 0
+    peak: int = 0
+    spilled: int = 0
+    # Reentrant, as stores release their memory when they are collected:
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False)
+
+    def charge(self, size: int) -> bool:
+        """Account for memory taken, or released if negative.
+
+        Returns whether the account is still within its limit.
+        """
+        with self.lock:
+            self.held += size
+            self.peak = max(self.peak, self.held)
+            return self.held <= self.limit
+
+    def stats(self) -> dict[str, int]:
+        """Get the memory held, its peak and limit, and the graphs spilled."""
+        return {
+            "held": self.held,
+            "peak": self.peak,
+            "limit": self.limit,
+            "spilled": self.spilled,
+        }
+
+
+worker_account = MemoryAccount(MEMORY_WORKER_BYTES)
+request_account: ContextVar[MemoryAccount | None] = ContextVar(
+    "request_account", default=None
+)
+
+
+@contextlib.contextmanager
+def request_memory() -> Iterator[MemoryAccount]:
+    """Account for the graphs built in the context against a new request."""
+    account = MemoryAccount(MEMORY_REQUEST_BYTES)
+    token = request_account.set(account)
+    try:
+        yield account
+    finally:
+        request_account.reset(token)
+
+
+def governed_graph() -> Graph:
+    """Get an empty graph whose memory is accounted, and spilled if needed."""
+    return Graph(store=SpillStore())
+
+
+def charge(graph: Graph) -> None:
+    """Account for the triples added to a governed graph and not yet charged.
+
+    Stores charge the triples added in batches, so a graph is charged once it
+    is parsed or expanded, even if it is smaller than a batch.
+    """
+    if isinstance(graph.store, SpillStore) and graph.store.uncharged:
+        graph.store.charge()
+
+
+def shared_graph(graph: Graph) -> Graph:
+    """Get the graph held on disk, so that other processes can open it.
+
+    A spilled graph is returned as is, other graphs are copied to a database.
+    Pickling the result pickles the path of its database, not its triples.
+    """
+    if isinstance(graph.store, SpillStore) and graph.store.spilled:
+        return graph
+    store = SpillStore()
+    store.disk = DiskTriples.create()
+    store.disk.add(graph)
+    shared = Graph(store=store)
+    for prefix, namespace in graph.namespaces():
+        shared.bind(prefix, namespace)
+    return shared
+
+
+def encode(term: Node) -> str:
+    """Encode a term as text, keeping its kind, language and datatype."""
+    if isinstance(term, Literal):
+        return f"L{term.language or ''}\0{term.datatype or ''}\0{term}"
+    if isinstance(term, BNode):
+        return f"B{term}"
+    return f"U{term}"
+
+
+def decode(value: str) -> Node:
+    """Decode a term encoded as text."""
+    kind, rest = value[0], value[1:]
+    if kind == "L":
+        language, datatype, lexical = rest.split("\0", 2)
+        return Literal(
+            lexical,
+            lang=language or None,
+            datatype=URIRef(datatype) if datatype else None,
+        )
+    return BNode(rest) if kind == "B" else URIRef(rest)
+
+
+class DiskTriples:
+    """Triples in an SQLite database, indexed like the in-memory store.
+
+    The database file is deleted with the object that created it. Copies
+    pickled to other processes open the same file.
+    """
+
+    def __init__(self, path: Path, *, owner: bool) -> None:
+        """Open the database, creating its table if this object owns it."""
+        self.path = path
+        self.owner = owner
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if owner:
+            # The database only lives as long as the graph, it need not survive
+            # a crash:
+            self.connection.executescript(
+                """
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE triples (
+                    s TEXT NOT NULL, p TEXT NOT NULL, o TEXT NOT NULL,
+                    PRIMARY KEY (s, p, o)
+                ) WITHOUT ROWID;
+                CREATE INDEX triples_pos ON triples (p, o, s);
+                CREATE INDEX triples_osp ON triples (o, s, p);
+                """
+            )
+        (self.length,) = self.connection.execute(
+            "SELECT COUNT(*) FROM triples"
+        ).fetchone()
+
+    @classmethod
+    def create(cls) -> DiskTriples:
+        """Create an empty database in a new file in the spill directory."""
+        fd, path = tempfile.mkstemp(
+            dir=SPILL_DIR, prefix="rdf-explorer-spill-", suffix=".sqlite"
+        )
+        os.close(fd)
+        return cls(Path(path), owner=True)
+
+    def add(self, triples: Iterable[Triple]) -> None:
+        """Add triples, ignoring those already in the database."""
+        cursor = self.connection.executemany(
+            "INSERT OR IGNORE INTO triples VALUES (?, ?, ?)",
+            (tuple(map(encode, triple)) for triple in triples),
+        )
+        self.length += cursor.rowcount
+
+    def remove(self, pattern: TriplePattern) -> None:
+        """Remove the triples matching a pattern."""
+        where, parameters = self._where(pattern)
+        cursor = self.connection.execute(
+            f"DELETE FROM triples{where}",  # noqa: S608 - only column names
+            parameters,
+        )
+        self.length -= cursor.rowcount
+
+    def triples(self, pattern: TriplePattern) -> Iterator[Triple]:
+        """Get the triples matching a pattern."""
+        where, parameters = self._where(pattern)
+        for row in self.connection.execute(
+            f"SELECT s, p, o FROM triples{where}",  # noqa: S608 - only column names
+            parameters,
+        ):
+            yield decode(row[0]), decode(row[1]), decode(row[2])
+
+    def close(self) -> None:
+        """Close the database, and delete it if this object owns it."""
+        self.connection.close()
+        if self.owner:
+            self.path.unlink(missing_ok=True)
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Pickle the path of the database, after committing its triples."""
+        self.connection.commit()
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Open the database of the pickled object, without owning it."""
+        self.__init__(state["path"], owner=False)
+
+    def __del__(self) -> None:
+        """Close the database when the graph is collected."""
+        # The connection is missing if opening the database failed:
+        if hasattr(self, "connection"):  # pragma: no branch
+            self.close()
+
+    @staticmethod
+    def _where(pattern: TriplePattern) -> tuple[str, list[str]]:
+        """Get the WHERE clause matching a pattern, and its parameters."""
+        bound = [
+            (column, term)
+            for column, term in zip("spo", pattern, strict=True)
+            if term is not None
+        ]
+        if not bound:
+            return "", []
+        where = " AND ".join(f"{column} = ?" for column, _ in bound)
+        return f" WHERE {where}", [encode(term) for _, term in bound]
+
+
+class SpillStore(Memory):
+    """An in-memory store that moves its triples to disk when memory runs short.
+
+    The triples are accounted against the request the store is created or
+    loaded for, and against the worker, until they are moved to disk or the
+    store is collected. Only the triples are moved, the prefixes are kept in
+    memory.
+    """
+
+    def __init__(self) -> None:
+        """Start empty, in memory."""
+        super().__init__()
+        self.disk: DiskTriples | None = None
+        self.request = request_account.get()
+        self.charged = 0
+        self.uncharged = 0
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the triples were moved to disk."""
+        return self.disk is not None
+
+    def add(self, triple: Triple, context: Graph, *, quoted: bool = False) -> None:
+        """Add a triple, and account for it if it is new."""
+        if self.disk is not None:
+            self.disk.add([triple])
+            return
+        length = super().__len__()
+        super().add(triple, context, quoted=quoted)
+        if super().__len__() > length:
+            self.uncharged += 1
+            if self.uncharged >= CHARGE_TRIPLES:
+                self.charge()
+
+    def remove(
+        self, triple_pattern: TriplePattern, context: Graph | None = None
+    ) -> None:
+        """Remove the triples matching a pattern."""
+        if self.disk is not None:
+            self.disk.remove(triple_pattern)
+            return
+        length = super().__len__()
+        super().remove(triple_pattern, context)
+        # Released at the next charge:
+        self.uncharged -= length - super().__len__()
+
+    def triples(
+        self, triple_pattern: TriplePattern, context: Graph | None = None
+    ) -> Iterator[tuple[Triple, Iterator[Graph | None]]]:
+        """Get the triples matching a pattern, with their contexts."""
+        if self.disk is None:
+            yield from super().triples(triple_pattern, context)
+            return
+        for triple in self.disk.triples(triple_pattern):
+            yield triple, iter((context,))
+
+    def __len__(self, context: Graph | None = None) -> int:
+        """Get the number of triples."""
+        if self.disk is not None:
+            return self.disk.length
+        return super().__len__(context)
+
+    def charge(self) -> None:
+        """Account for the triples added since the last charge.
+
+        Moves the triples to disk if the request or the worker is over its limit.
+        """
+        size = self.uncharged * MEMORY_BYTES_PER_TRIPLE
+        self.charged += self.uncharged
+        self.uncharged = 0
+        within = worker_account.charge(size)
+        if self.request is not None:
+            within = self.request.charge(size) and within
+        if not within:
+            self.spill()
+
+    def spill(self) -> None:
+        """Move the triples to a database on disk, and release their memory."""
+        disk = DiskTriples.create()
+        disk.add(triple for triple, _ in super().triples((None, None, None)))
+        namespaces = list(self.namespaces())
+        # Drop the in-memory indexes, and keep the prefixes:
+        Memory.__init__(self)
+        for prefix, namespace in namespaces:
+            self.bind(prefix, namespace)
+        self.disk = disk
+        self.release()
+        worker_account.spilled += 1
+        if self.request is not None:
+            self.request.spilled += 1
+        logger.warning(
+            "Spilled a graph of %d triples to disk, in %s", disk.length, disk.path
+        )
+
+    def release(self) -> None:
+        """Stop accounting for the triples held in memory."""
+        size = -self.charged * MEMORY_BYTES_PER_TRIPLE
+        self.charged = 0
+        worker_account.charge(size)
+        if self.request is not None:
+            self.request.charge(size)
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Pickle the store, without its accounting."""
+        return self.__dict__ | {"request": None, "charged": 0, "uncharged": 0}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Load the store, and account for it against the current request."""
+        self.__dict__.update(state)
+        self.request = request_account.get()
+        if self.disk is None:
+            self.uncharged = len(self)
+            self.charge()
+
+    def __del__(self) -> None:
+        """Stop accounting for the triples when the graph is collected."""
+        if getattr(self, "charged", 0):
+            self.release()
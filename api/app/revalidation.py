@@ -0,0 +1,416 @@
+"""Incremental SHACL revalidation on data deltas.
+
+Validations are persisted in a directory shared by the workers, so that any
+worker can apply the next delta to a validation. A validation is pickled to a
+file named by its id when it is created and after every delta, under a lock
+across processes, and published with an atomic rename.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import os
+import pickle
+import re
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+from itertools import chain
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from pyshacl import Validator
+from rdflib import RDFS, SH, BNode, Graph, Literal, URIRef
+from rdflib.collection import Collection
+from rdflib.compare import to_canonical_graph
+
+from app.cache import private_directory
+from app.inference import InferenceMode, expand
+from app.memory import SpillStore, charge, governed_graph
+from app.validation import PartialReport, merge_reports, validate_focus_nodes
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from rdflib.term import Node
+
+    type Triple = tuple[Node, Node, Node]
+
+SHACL_VALIDATIONS_DIR = Path(
+    os.getenv(
+        "SHACL_VALIDATIONS_DIR",
+        Path(tempfile.gettempdir()) / "rdf-explorer-validations",
+    )
+)
+# Number of incremental validations kept, the least recently used are deleted:
+SHACL_MAX_VALIDATIONS = int(os.getenv("SHACL_MAX_VALIDATIONS", "16"))
+# Validation ids are used in file names:
+VALIDATION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# Constraints and targets whose dependencies cannot be derived from the shapes:
+OPAQUE_PREDICATES = (SH.sparql, SH.target, SH.validator)
+# Path operators wrapping a single path:
+UNARY_PATHS = (SH.zeroOrMorePath, SH.oneOrMorePath, SH.zeroOrOnePath)
+
+
+class ValidationResult(NamedTuple):
+    """A single sh:ValidationResult and the triples describing it."""
+
+    focus_node: Node
+    node: Node
+    triples: list[Triple]
+    signature: frozenset[Triple]
+
+
+class IncrementalValidation:
+    """Validation state for a (dataset, shapes) pair.
+
+    Keeps the results of the last validation grouped by focus node. A delta
+    revalidates only the focus nodes it can affect: the subjects of the
+    changed triples, the objects when they are reached through an inverse
+    path or targeted by sh:targetObjectsOf, and then, up to a fixpoint, every
+    node whose path values are affected. This covers nested sh:node and
+    sh:property shapes. Changes to rdfs:subClassOf, and shapes with
+    SPARQL-based constraints or targets, fall back to a full revalidation.
+    """
+
+    def __init__(
+        self, data_graph: Graph, shapes_graph: Graph, inference: InferenceMode
+    ) -> None:
+        """Validate the data graph and keep the results."""
+        self.asserted = data_graph
+        self.shapes_graph = shapes_graph
+        self.inference = inference
+        self.forward, self.inverse = path_predicates(shapes_graph)
+        self.target_objects = set(shapes_graph.objects(None, SH.targetObjectsOf))
+        self.opaque = any((None, p, None) in shapes_graph for p in OPAQUE_PREDICATES)
+        self.data_graph = self._closure()
+        self.results: dict[Node, list[ValidationResult]] = {}
+        self.lock = threading.Lock()
+        self._validate(None)
+
+    @property
+    def conforms(self) -> bool:
+        """Whether the data graph conforms to the shapes."""
+        return not any(self.results.values())
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Pickle the validation without its lock, and its graphs by value.
+
+        Spilled graphs are copied into memory, as their database is deleted
+        with them.
+        """
+        asserted = by_value(self.asserted)
+        data_graph = (
+            asserted if self.data_graph is self.asserted else by_value(self.data_graph)
+        )
+        return self.__dict__ | {
+            "asserted": asserted,
+            "data_graph": data_graph,
+            "lock": None,
+        }
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Load the validation with a new lock."""
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def report(self) -> Graph:
+        """Get the current validation report."""
+        results = list(chain.from_iterable(self.results.values()))
+        _, report_graph = merge_reports(
+            self.shapes_graph,
+            [
+                (
+                    self.conforms,
+                    [result.node for result in results],
+                    list(chain.from_iterable(result.triples for result in results)),
+                )
+            ],
+        )
+        return report_graph
+
+    def apply(self, added: Graph, removed: Graph) -> tuple[Graph, Graph]:
+        """Apply a delta to the data graph and revalidate the affected focus nodes.
+
+        Returns the results that were added and removed by the delta.
+        """
+        with self.lock:
+            before = self.data_graph
+            if self.data_graph is self.asserted:
+                delta = {t for t in removed if t in before}
+                delta |= {t for t in added if t not in before}
+                self.asserted -= removed
+                self.asserted += added
+            else:
+                # Inferred triples may come and go with the delta:
+                self.asserted -= removed
+                self.asserted += added
+                self.data_graph = self._closure()
+                delta = set(before) ^ set(self.data_graph)
+
+            affected = self._affected(delta)
+            if affected is None:
+                previous = self.results
+                self.results = {}
+            else:
+                previous = {
+                    node: self.results.pop(node)
+                    for node in affected
+                    if node in self.results
+                }
+            self._validate(affected)
+            current = {
+                node: self.results[node]
+                for node in (self.results.keys() if affected is None else affected)
+                if node in self.results
+            }
+            return _diff(current, previous), _diff(previous, current)
+
+    def _closure(self) -> Graph:
+        """Get the graph to validate, with inferred triples if requested."""
+        if self.inference in (InferenceMode.NONE, InferenceMode.REWRITE):
+            return self.asserted
+        graph = governed_graph()
+        graph += self.asserted
+        expand(graph, self.inference)
+        charge(graph)
+        return graph
+
+    def _affected(self, delta: set[Triple]) -> set[Node] | None:
+        """Get the focus nodes affected by a delta, or None if all of them are."""
+        if self.opaque or any(p == RDFS.subClassOf for _, p, _ in delta):
+            return None
+        affected = {s for s, _, _ in delta}
+        affected |= {o for _, p, o in delta if p in self.inverse}
+        affected = {node for node in affected if not isinstance(node, Literal)}
+        # Targeted objects are focus nodes, even literals:
+        affected |= {o for _, p, o in delta if p in self.target_objects}
+        frontier = list(affected)
+        while frontier:
+            node = frontier.pop()
+            dependants = chain(
+                chain.from_iterable(
+                    self.data_graph.subjects(p, node) for p in self.forward
+                ),
+                chain.from_iterable(
+                    self.data_graph.objects(node, p) for p in self.inverse
+                ),
+            )
+            for dependant in dependants:
+                if dependant not in affected and not isinstance(dependant, Literal):
+                    affected.add(dependant)
+                    frontier.append(dependant)
+        return affected
+
+    def _validate(self, focus_filter: set[Node] | None) -> None:
+        """Validate the given focus nodes, or all of them, and keep the results."""
+        validator = Validator(
+            self.data_graph, shacl_graph=self.shapes_graph, options={"inplace": True}
+        )
+        for shape in validator.shacl_graph.shapes:
+            focus_nodes = [
+                node
+                for node in shape.focus_nodes(self.data_graph)
+                if focus_filter is None or node in focus_filter
+            ]
+            if not focus_nodes:
+                continue
+            partial = validate_focus_nodes(
+                validator, self.data_graph, shape.node, focus_nodes
+            )
+            for result in split_results(partial):
+                self.results.setdefault(result.focus_node, []).append(result)
+
+
+class ValidationStore:
+    """The incremental validations, persisted in a directory shared by the workers.
+
+    Workers keep the validations they last used in memory, as long as their
+    file has not been replaced by another worker.
+    """
+
+    def __init__(self, directory: Path, max_validations: int) -> None:
+        """Hold no validations until they are used, in a directory of the user."""
+        self.directory = private_directory(directory)
+        self.max_validations = max_validations
+        # The validations last used, by id, with the identity of their file:
+        self.held: OrderedDict[str, tuple[tuple[int, int], IncrementalValidation]] = (
+            OrderedDict()
+        )
+
+    def create(self, validation: IncrementalValidation) -> str:
+        """Persist a new validation and get its id."""
+        # Every validation has its own state, even for the same data and shapes:
+        validation_id = secrets.token_urlsafe(16)
+        with self._lock(validation_id):
+            self._publish(validation_id, validation)
+        self._evict()
+        return validation_id
+
+    def apply(
+        self, validation_id: str, added: Graph, removed: Graph
+    ) -> tuple[Graph, Graph, Graph]:
+        """Apply a delta to a validation and persist it.
+
+        Returns the updated report and the results added and removed by the
+        delta. Raises KeyError if the validation does not exist.
+        """
+        if (
+            not VALIDATION_ID_PATTERN.fullmatch(validation_id)
+            or not (self.directory / f"{validation_id}.pickle").exists()
+        ):
+            raise KeyError(validation_id)
+        with self._lock(validation_id):
+            validation = self._load(validation_id)
+            added_results, removed_results = validation.apply(added, removed)
+            self._publish(validation_id, validation)
+            return validation.report(), added_results, removed_results
+
+    def _load(self, validation_id: str) -> IncrementalValidation:
+        """Get the latest state of a validation, or raise KeyError."""
+        path = self.directory / f"{validation_id}.pickle"
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # pragma: no cover - deleted meanwhile
+            self.held.pop(validation_id, None)
+            raise KeyError(validation_id) from None
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        held = self.held.get(validation_id)
+        if held is None or held[0] != identity:
+            # Written by this application only, in a private directory:
+            held = (identity, pickle.loads(path.read_bytes()))  # noqa: S301
+        self._hold(validation_id, held)
+        return held[1]
+
+    def _publish(self, validation_id: str, validation: IncrementalValidation) -> None:
+        """Replace the file of a validation atomically, and hold it."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(validation, f, protocol=pickle.HIGHEST_PROTOCOL)
+        path = self.directory / f"{validation_id}.pickle"
+        Path(tmp).replace(path)
+        stat = path.stat()
+        self._hold(validation_id, ((stat.st_ino, stat.st_mtime_ns), validation))
+
+    def _hold(
+        self,
+        validation_id: str,
+        held: tuple[tuple[int, int], IncrementalValidation],
+    ) -> None:
+        """Keep a validation in memory, forgetting the least recently used."""
+        self.held[validation_id] = held
+        self.held.move_to_end(validation_id)
+        while len(self.held) > self.max_validations:
+            self.held.popitem(last=False)
+
+    def _evict(self) -> None:
+        """Delete the least recently changed validations beyond the limit."""
+        files = []
+        for path in self.directory.glob("*.pickle"):
+            with contextlib.suppress(FileNotFoundError):
+                files.append((path.stat().st_mtime_ns, path))
+        files.sort()
+        for _, path in files[: max(0, len(files) - self.max_validations)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".lock").unlink(missing_ok=True)
+            self.held.pop(path.stem, None)
+
+    @contextlib.contextmanager
+    def _lock(self, validation_id: str) -> Iterator[None]:
+        """Hold an exclusive lock on a validation, across processes."""
+        with (self.directory / f"{validation_id}.lock").open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def by_value(graph: Graph) -> Graph:
+    """Get a graph that pickles its triples, copying a spilled graph into memory."""
+    if not (isinstance(graph.store, SpillStore) and graph.store.spilled):
+        return graph
+    copy = Graph()
+    for prefix, namespace in graph.namespaces():
+        copy.bind(prefix, namespace)
+    copy += graph
+    return copy
+
+
+def path_predicates(shapes_graph: Graph) -> tuple[set[Node], set[Node]]:
+    """Get the predicates used forwards and inverted in the sh:path of the shapes."""
+    forward: set[Node] = set()
+    inverse: set[Node] = set()
+
+    def walk(path: Node, *, inverted: bool) -> None:
+        if isinstance(path, URIRef):
+            (inverse if inverted else forward).add(path)
+            return
+        if (inner := shapes_graph.value(path, SH.inversePath)) is not None:
+            walk(inner, inverted=not inverted)
+            return
+        if (inner := shapes_graph.value(path, SH.alternativePath)) is not None:
+            for item in Collection(shapes_graph, inner):
+                walk(item, inverted=inverted)
+            return
+        for operator in UNARY_PATHS:
+            if (inner := shapes_graph.value(path, operator)) is not None:
+                walk(inner, inverted=inverted)
+                return
+        # A sequence path is an RDF list of paths:
+        for item in Collection(shapes_graph, path):
+            walk(item, inverted=inverted)
+
+    for path in set(shapes_graph.objects(None, SH.path)):
+        walk(path, inverted=False)
+    return forward, inverse
+
+
+def split_results(partial: PartialReport) -> list[ValidationResult]:
+    """Split a partial report into its individual results."""
+    _, results, triples = partial
+    graph = Graph()
+    for triple in triples:
+        graph.add(triple)
+    split = []
+    for result in results:
+        subtree = []
+        nodes = [result]
+        seen = {result}
+        while nodes:
+            for triple in graph.triples((nodes.pop(), None, None)):
+                subtree.append(triple)
+                if isinstance(triple[2], BNode) and triple[2] not in seen:
+                    seen.add(triple[2])
+                    nodes.append(triple[2])
+        canonical = Graph()
+        for triple in subtree:
+            canonical.add(triple)
+        split.append(
+            ValidationResult(
+                focus_node=graph.value(result, SH.focusNode),
+                node=result,
+                triples=subtree,
+                signature=frozenset(to_canonical_graph(canonical)),
+            )
+        )
+    return split
+
+
+def _diff(
+    results: dict[Node, list[ValidationResult]],
+    others: dict[Node, list[ValidationResult]],
+) -> Graph:
+    """Get the results that have no equal among the others, as a graph."""
+    signatures = {result.signature for result in chain.from_iterable(others.values())}
+    graph = Graph(bind_namespaces="core")
+    for result in chain.from_iterable(results.values()):
+        if result.signature not in signatures:
+            for triple in result.triples:
+                graph.add(triple)
+    return graph
+
+
+validations = ValidationStore(SHACL_VALIDATIONS_DIR, SHACL_MAX_VALIDATIONS)
@@ -0,0 +1,255 @@
+"""API endpoints for managing the datasets held by the server."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Path, Request, Response
+from pydantic import BaseModel
+from rdflib.exceptions import ParserError
+from rdflib.plugins.sparql import prepareQuery
+
+from app.datasets import DATASET_NAME_PATTERN, Dataset, datasets
+from app.memory import charge, governed_graph
+
+if TYPE_CHECKING:
+    from app.views import MaterializedView
+
+router = APIRouter(tags=["datasets"])
+logger = logging.getLogger("uvicorn.error")
+
+DatasetPath = Annotated[str, Path(pattern=DATASET_NAME_PATTERN)]
+
+
+class DatasetRequest(BaseModel):
+    """Request model for creating or replacing a dataset held by the server."""
+
+    data: str
+
+
+class DatasetResponse(BaseModel):
+    """Response model for a dataset held by the server."""
+
+    name: str
+    version: int
+    length: int
+
+
+class ViewRequest(BaseModel):
+    """Request model for registering a view of a dataset."""
+
+    query: str
+
+
+class ViewResponse(BaseModel):
+    """Response model for a materialized view of a dataset.
+
+    `version` is the version of the dataset the table holds for, and
+    `refreshed` the version it was last computed on. `predicates` are the
+    predicates whose changes refresh the view, null if it reads any.
+    """
+
+    dataset: str
+    name: str
+    query: str
+    version: int
+    refreshed: int
+    length: int
+    predicates: list[str] | None
+
+
+async def check_content_type(request: Request) -> None:
+    """Check that the content type of the request is application/json."""
+    content_type = request.headers.get("content-type", None)
+    if not content_type or "application/json" not in content_type:
+        raise HTTPException(
+            status_code=HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported media type {content_type}",
+        )
+
+
+@router.put(
+    "/datasets/{name}",
+    dependencies=[Depends(check_content_type)],
+    responses={
+        200: {
+            "description": "The dataset, created or replaced with the given data",
+        },
+    },
+)
+async def put_dataset(
+    name: DatasetPath, dataset_request: DatasetRequest
+) -> DatasetResponse:
+    """Create or replace a dataset with the provided RDF data."""
+
+    def create() -> Dataset:
+        """Parse and persist the dataset, outside the event loop."""
+        # The parsed data is accounted for, and spilled to disk if too large:
+        graph = governed_graph()
+        try:
+            graph.parse(data=dataset_request.data)
+        except ParserError as e:
+            raise HTTPException(
+                status_code=400, detail="Invalid RDF data: " + str(e)
+            ) from e
+        charge(graph)
+        return datasets.create(name, graph)
+
+    return dataset_response(await asyncio.to_thread(create))
+
+
+@router.get(
+    "/datasets/{name}",
+    responses={
+        200: {
+            "description": "The version and size of the dataset",
+        },
+        404: {
+            "description": "The dataset does not exist",
+        },
+    },
+)
+async def get_dataset(name: DatasetPath) -> DatasetResponse:
+    """Get the latest version of a dataset and its number of triples."""
+    return dataset_response(held_dataset(name))
+
+
+@router.delete(
+    "/datasets/{name}",
+    status_code=HTTPStatus.NO_CONTENT,
+    responses={
+        404: {
+            "description": "The dataset does not exist",
+        },
+    },
+)
+async def delete_dataset(name: DatasetPath) -> Response:
+    """Delete a dataset and its cached closures and results."""
+    await asyncio.to_thread(held_dataset(name).delete)
+    return Response(status_code=HTTPStatus.NO_CONTENT)
+
+
+def held_dataset(name: str) -> Dataset:
+    """Get a dataset held by the server, or raise 404 Not Found."""
+    dataset = datasets.get(name)
+    if dataset is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown dataset {name}",
+        )
+    return dataset
+
+
+def dataset_response(dataset: Dataset) -> DatasetResponse:
+    """Describe the latest version of a dataset."""
+    try:
+        version, graph = dataset.snapshot()
+    except KeyError as e:  # pragma: no cover - deleted meanwhile
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown dataset {dataset.name}",
+        ) from e
+    return DatasetResponse(name=dataset.name, version=version, length=len(graph))
+
+
+@router.put(
+    "/datasets/{name}/views/{view}",
+    dependencies=[Depends(check_content_type)],
+    responses={
+        200: {
+            "description": "The view, materialized on the latest version",
+        },
+        404: {
+            "description": "The dataset does not exist",
+        },
+    },
+)
+async def put_view(
+    name: DatasetPath, view: DatasetPath, view_request: ViewRequest
+) -> ViewResponse:
+    """Register a view of a dataset, or replace it, and materialize it.
+
+    The view is kept up to date as the dataset changes, and queries with the
+    same text are answered from its table.
+    """
+    dataset = held_dataset(name)
+    try:
+        parsed_query = prepareQuery(view_request.query)
+    except Exception as e:
+        msg = "Invalid SPARQL query: " + str(e)
+        raise HTTPException(status_code=400, detail=msg) from e
+    if parsed_query.algebra.name != "SelectQuery":
+        msg = "Views must be SELECT queries"
+        raise HTTPException(status_code=400, detail=msg)
+    try:
+        materialized = await asyncio.to_thread(
+            dataset.put_view, view, view_request.query
+        )
+    except KeyError as e:  # pragma: no cover - deleted meanwhile
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown dataset {name}",
+        ) from e
+    return view_response(dataset, view, materialized)
+
+
+@router.get(
+    "/datasets/{name}/views/{view}",
+    responses={
+        200: {
+            "description": "The query and table size of the view",
+        },
+        404: {
+            "description": "The dataset or the view does not exist",
+        },
+    },
+)
+async def get_view(name: DatasetPath, view: DatasetPath) -> ViewResponse:
+    """Get a view of a dataset, and the version its table holds for."""
+    dataset = held_dataset(name)
+    materialized = dataset.views().get(view)
+    if materialized is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown view {view}",
+        )
+    return view_response(dataset, view, materialized)
+
+
+@router.delete(
+    "/datasets/{name}/views/{view}",
+    status_code=HTTPStatus.NO_CONTENT,
+    responses={
+        404: {
+            "description": "The dataset or the view does not exist",
+        },
+    },
+)
+async def delete_view(name: DatasetPath, view: DatasetPath) -> Response:
+    """Delete a view of a dataset."""
+    try:
+        held_dataset(name).delete_view(view)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown view {view}",
+        ) from e
+    return Response(status_code=HTTPStatus.NO_CONTENT)
+
+
+def view_response(dataset: Dataset, name: str, view: MaterializedView) -> ViewResponse:
+    """Describe a materialized view."""
+    return ViewResponse(
+        dataset=dataset.name,
+        name=name,
+        query=view.query,
+        version=view.version,
+        refreshed=view.refreshed,
+        length=len(view.rows),
+        predicates=None
+        if view.predicates is None
+        else sorted(str(predicate) for predicate in view.predicates),
+    )
@@ -1,15 +1,28 @@
 """API endpoints for running SHACL validation on RDF data."""
 
+from __future__ import annotations
+
+import asyncio
 import logging
 from http import HTTPStatus
+from typing import TYPE_CHECKING
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from owlrl import DeductiveClosure, OWLRL_Semantics
 from pydantic import BaseModel
 from pyshacl import validate
-from rdflib import Graph
 from rdflib.exceptions import ParserError
 
+from app.cache import cache, cache_key
+from app.inference import Inference, InferenceMode, expand
+from app.memory import charge, governed_graph
+from app.revalidation import IncrementalValidation, validations
+from app.scheduler import client_of, estimate_cost, estimate_triples, scheduler
+from app.singleflight import flights
+from app.validation import validate_parallel
+
+if TYPE_CHECKING:
+    from rdflib import Graph
+
 router = APIRouter(tags=["shacl"])
 logger = logging.getLogger("uvicorn.error")
 
@@ -19,7 +32,8 @@ class SHACLRequest(BaseModel):
 
     data: str
     shapes: str
-    inference: bool = False
+    inference: Inference = InferenceMode.NONE
+    parallel: bool = False
 
 
 class SHACLResponse(BaseModel):
@@ -30,6 +44,30 @@ class SHACLResponse(BaseModel):
     result: str
 
 
+class SHACLValidationResponse(SHACLResponse):
+    """Response model for an incremental SHACL validation."""
+
+    id: str
+
+
+class SHACLDeltaRequest(BaseModel):
+    """Request model for the triples added to and removed from validated data."""
+
+    added: str = ""
+    removed: str = ""
+
+
+class SHACLDeltaResponse(SHACLValidationResponse):
+    """Response model for the revalidation of a delta.
+
+    Besides the updated report, the response holds the validation results
+    that the delta added and removed.
+    """
+
+    added_results: str
+    removed_results: str
+
+
 async def check_content_type(request: Request) -> None:
     """Check that the content type of the request is application/json."""
     content_type = request.headers.get("content-type", None)
@@ -49,42 +87,188 @@ async def check_content_type(request: Request) -> None:
         },
     },
 )
-async def run_shacl(shacl_request: SHACLRequest) -> SHACLResponse:
+async def run_shacl(request: Request, shacl_request: SHACLRequest) -> SHACLResponse:
     """Run the given SHACL validation on the provided RDF data."""
-    # Parse the RDF data into a graph:
-    data_graph = Graph()
-    try:
-        data_graph.parse(data=shacl_request.data)
-    except ParserError as e:
-        msg = "Invalid RDF data: " + str(e)
-        raise HTTPException(status_code=400, detail=msg) from e
+    # Return the result of an identical request, if it is cached:
+    result_key = cache_key(
+        "shacl", shacl_request.data, shacl_request.shapes, shacl_request.inference
+    )
+    cached = cache.get(result_key)
+    if cached is not None:
+        return SHACLResponse.model_validate_json(cached)
 
-    # Parse the SHACL shapes into a graph:
-    shapes_graph = Graph()
-    try:
-        shapes_graph.parse(data=shacl_request.shapes)
-    except ParserError as e:
-        msg = "Invalid SHACL shapes: " + str(e)
-        raise HTTPException(status_code=400, detail=msg) from e
+    def execute() -> SHACLResponse:
+        """Validate the data, outside the event loop."""
+        # Parse the RDF data and the SHACL shapes into graphs:
+        data_graph = load_data_graph(shacl_request.data, shacl_request.inference)
+        shapes_graph = parse_graph(shacl_request.shapes, "Invalid SHACL shapes: ")
 
-    # Run inference if requested:
-    if shacl_request.inference:
+        # Validate the data graph, in a process pool if requested:
+        if shacl_request.parallel:
+            _, results_graph = validate_parallel(data_graph, shapes_graph)
+        else:
+            _, results_graph, _ = validate(
+                data_graph=data_graph, shacl_graph=shapes_graph
+            )
+        # Serialize the result:
         try:
-            DeductiveClosure(OWLRL_Semantics).expand(data_graph)
+            content = results_graph.serialize(format="turtle")
         except Exception as e:  # pragma: no cover
-            msg = "Error running inference: " + str(e)
+            msg = "Error serializing query results: " + str(e)
             raise HTTPException(status_code=400, detail=msg) from e
-
-    # Validate the
-    _, results_graph, _ = validate(data_graph=data_graph, shacl_graph=shapes_graph)
-    # Serialize the result:
-    try:
-        content = results_graph.serialize(format="turtle")
-        return SHACLResponse(
+        response = SHACLResponse(
             length=len(results_graph),
             result_content_type="text/turtle",
             result=content,
         )
+        cache.put(result_key, response.model_dump_json().encode())
+        return response
+
+    # Identical requests in flight share a single validation, which is admitted
+    # according to its estimated cost:
+    cost = estimate_cost(
+        estimate_triples(shacl_request.data),
+        shacl_request.inference,
+        estimate_triples(shacl_request.shapes),
+    )
+    client = client_of(request)
+    return await flights.do(
+        result_key, execute, admit=lambda: scheduler.admit(client, cost)
+    )
+
+
+@router.post(
+    "/shacl/validations",
+    dependencies=[Depends(check_content_type)],
+    responses={
+        200: {
+            "description": "Result of running the SHACL validation",
+        },
+    },
+)
+async def create_validation(
+    request: Request, shacl_request: SHACLRequest
+) -> SHACLValidationResponse:
+    """Run the given SHACL validation and keep its state for incremental updates."""
+
+    def execute() -> SHACLValidationResponse:
+        """Validate the data and persist the validation, outside the event loop."""
+        data_graph = parse_graph(shacl_request.data, "Invalid RDF data: ")
+        shapes_graph = parse_graph(shacl_request.shapes, "Invalid SHACL shapes: ")
+        try:
+            validation = IncrementalValidation(
+                data_graph, shapes_graph, shacl_request.inference
+            )
+        except Exception as e:  # pragma: no cover
+            msg = "Error running validation: " + str(e)
+            raise HTTPException(status_code=400, detail=msg) from e
+        results_graph = validation.report()
+        return SHACLValidationResponse(
+            id=validations.create(validation),
+            length=len(results_graph),
+            result_content_type="text/turtle",
+            result=results_graph.serialize(format="turtle"),
+        )
+
+    # Identical requests are not coalesced, as each creates its own state, but
+    # they are admitted according to their estimated cost:
+    cost = estimate_cost(
+        estimate_triples(shacl_request.data),
+        shacl_request.inference,
+        estimate_triples(shacl_request.shapes),
+    )
+    async with scheduler.admit(client_of(request), cost):
+        return await asyncio.to_thread(execute)
+
+
+@router.post(
+    "/shacl/validations/{validation_id}/delta",
+    dependencies=[Depends(check_content_type)],
+    responses={
+        200: {
+            "description": "Result of revalidating the data affected by the delta",
+        },
+        404: {
+            "description": "The validation does not exist",
+        },
+    },
+)
+async def apply_delta(
+    request: Request, validation_id: str, delta_request: SHACLDeltaRequest
+) -> SHACLDeltaResponse:
+    """Apply a delta to the validated data and revalidate the affected focus nodes.
+
+    Validations are shared by the workers, any of them can apply a delta. An
+    unknown validation, e.g. one deleted to make room for newer ones, must be
+    created again with a full validation.
+    """
+
+    def execute() -> SHACLDeltaResponse:
+        """Revalidate the delta and persist the validation, outside the event loop."""
+        added = parse_graph(delta_request.added, "Invalid added RDF data: ")
+        removed = parse_graph(delta_request.removed, "Invalid removed RDF data: ")
+        try:
+            results_graph, added_results, removed_results = validations.apply(
+                validation_id, added, removed
+            )
+        except KeyError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Unknown validation {validation_id}",
+            ) from e
+        except Exception as e:  # pragma: no cover
+            msg = "Error running validation: " + str(e)
+            raise HTTPException(status_code=400, detail=msg) from e
+        return SHACLDeltaResponse(
+            id=validation_id,
+            length=len(results_graph),
+            result_content_type="text/turtle",
+            result=results_graph.serialize(format="turtle"),
+            added_results=added_results.serialize(format="turtle"),
+            removed_results=removed_results.serialize(format="turtle"),
+        )
+
+    # Deltas to the same validation are applied one at a time, under its lock,
+    # and admitted according to their estimated cost:
+    cost = estimate_cost(
+        estimate_triples(delta_request.added) + estimate_triples(delta_request.removed),
+        InferenceMode.NONE,
+    )
+    async with scheduler.admit(client_of(request), cost):
+        return await asyncio.to_thread(execute)
+
+
+def load_data_graph(data: str, inference: InferenceMode) -> Graph:
+    """Parse the RDF data into a graph and materialise the inferred triples.
+
+    The resulting graph is shared with the other workers through the cache.
+    SHACL targets and sh:class already follow rdfs:subClassOf, so the rewrite
+    mode needs no materialisation here.
+    """
+    if inference == InferenceMode.REWRITE:
+        inference = InferenceMode.NONE
+    key = cache_key("graph", data, inference)
+    graph = cache.get_graph(key)
+    if graph is not None:
+        return graph
+
+    graph = parse_graph(data, "Invalid RDF data: ")
+    try:
+        expand(graph, inference)
     except Exception as e:  # pragma: no cover
-        msg = "Error serializing query results: " + str(e)
+        msg = "Error running inference: " + str(e)
         raise HTTPException(status_code=400, detail=msg) from e
+    charge(graph)
+    cache.put_graph(key, graph)
+    return graph
+
+
+def parse_graph(data: str, error: str) -> Graph:
+    """Parse the RDF data into a graph, prefixing parse errors with the given text."""
+    graph = governed_graph()
+    try:
+        graph.parse(data=data)
+    except ParserError as e:
+        raise HTTPException(status_code=400, detail=error + str(e)) from e
+    charge(graph)
+    return graph
@@ -1,26 +1,76 @@
 """SPARQL endpoint for running SPARQL queries on RDF data."""
 
+from __future__ import annotations
+
+import contextlib
 import logging
 from enum import StrEnum
 from http import HTTPStatus
+from typing import TYPE_CHECKING
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from owlrl import DeductiveClosure, OWLRL_Semantics
-from pydantic import BaseModel
-from rdflib import Graph
+from pydantic import BaseModel, model_validator
 from rdflib.exceptions import Error
-from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+
+from app.cache import cache, cache_key
+from app.datasets import UPDATE_OPERATIONS, DatasetName, UpdateError
+from app.explain import Explain, analyze, describe_plan
+from app.inference import Inference, InferenceMode, expand, rewrite_query
+from app.memory import charge, governed_graph
+from app.routers.datasets import held_dataset
+from app.scheduler import (
+    client_of,
+    estimate_cost,
+    estimate_triples,
+    query_factor,
+    scheduler,
+)
+from app.singleflight import flights
+from app.textindex import TEXT_INDEX, accelerate_text_filters, text_index
+
+if TYPE_CHECKING:
+    from typing import Self
+
+    from rdflib import Graph
+    from rdflib.plugins.sparql.sparql import Query
+    from rdflib.query import Result
+
+    from app.datasets import Dataset
+    from app.views import MaterializedView
 
 router = APIRouter(tags=["sparql"])
 logger = logging.getLogger("uvicorn.error")
 
 
 class SPARQLRequest(BaseModel):
-    """Request model for running a SPARQL query on RDF data."""
+    """Request model for running a SPARQL query on RDF data.
+
+    The query runs on the given data, or on a dataset held by the server.
+    With `explain`, the plan of the query is returned, without running it
+    (`plan`) or with the rows and time of every operator (`analyze`).
+    """
 
-    data: str
+    data: str | None = None
+    dataset: DatasetName | None = None
     query: str
-    inference: bool = False
+    inference: Inference = InferenceMode.NONE
+    explain: Explain = Explain.NONE
+
+    @model_validator(mode="after")
+    def check_source(self) -> Self:
+        """Check that the request holds either data or a dataset."""
+        if (self.data is None) == (self.dataset is None):
+            msg = "Either data or dataset is required"
+            raise ValueError(msg)
+        return self
+
+
+class SPARQLUpdateRequest(BaseModel):
+    """Request model for running a SPARQL update on a dataset held by the server."""
+
+    dataset: DatasetName
+    update: str
 
 
 class SPARQLQueryType(StrEnum):
@@ -32,12 +82,47 @@ class SPARQLQueryType(StrEnum):
     CONSTRUCT = "ConstructQuery"
 
 
+class PlanNode(BaseModel):
+    """Model for an operator of the plan of a SPARQL query, and its operands.
+
+    When the query is analyzed, `calls` counts the evaluations of the
+    operator, `rows` the solutions it produced, and `time` the time spent
+    producing them in seconds, including the time spent in its operands.
+    """
+
+    operator: str
+    detail: str | None = None
+    calls: int | None = None
+    rows: int | None = None
+    time: float | None = None
+    operands: list[PlanNode] = []
+
+
 class SPARQLResponse(BaseModel):
-    """Response model for the result of running a SPARQL query on RDF data."""
+    """Response model for the result of running a SPARQL query on RDF data.
+
+    `plan` is only set when the query is explained; the result is then empty
+    unless the query is analyzed.
+    """
 
     length: int
     result_content_type: str | None = None
     result: str
+    plan: PlanNode | None = None
+
+
+class SPARQLUpdateResponse(BaseModel):
+    """Response model for the result of running a SPARQL update.
+
+    `added` and `removed` count the triples changed by the update, and
+    `version` is the version of the dataset it was committed in.
+    """
+
+    dataset: str
+    version: int
+    added: int
+    removed: int
+    length: int
 
 
 async def check_content_type(request: Request) -> None:
@@ -59,18 +144,35 @@ async def check_content_type(request: Request) -> None:
         },
     },
 )
-async def run_sparql(request: Request, sparql_request: SPARQLRequest) -> SPARQLResponse:  # noqa: C901
-    """Run the given SPARQL query on the provided RDF data."""
-    # Parse the RDF data into a graph:
-    graph = Graph()
-    try:
-        graph.parse(data=sparql_request.data)
-    except Error as e:
-        msg = f"Error: {type(e)} : " + str(e)
-        raise HTTPException(status_code=400, detail=msg) from e
-    except Exception as e:  # pragma: no cover
-        msg = "Invalid RDF data: " + str(e)
-        raise HTTPException(status_code=400, detail=msg) from e
+async def run_sparql(request: Request, sparql_request: SPARQLRequest) -> SPARQLResponse:
+    """Run the given SPARQL query on the provided RDF data, or on a dataset."""
+    # Results on a dataset are cached per version, and invalidated by updates:
+    dataset = None
+    if sparql_request.dataset is None:
+        prefix, source = "", sparql_request.data or ""
+    else:
+        dataset = held_dataset(sparql_request.dataset)
+        prefix, source = dataset.cache_prefix, str(dataset.version())
+
+    # Return the result of an identical request, if it is cached:
+    result_key = cache_key(
+        prefix + "sparql",
+        source,
+        sparql_request.query,
+        sparql_request.inference,
+        sparql_request.explain,
+        request.headers.get("accept", ""),
+    )
+    cached = cache.get(result_key)
+    if cached is not None:
+        return SPARQLResponse.model_validate_json(cached)
+
+    # Answer queries that match a view of the dataset from its table:
+    view = matching_view(sparql_request, dataset)
+    if view is not None:
+        response = await view_response(view, request)
+        cache.put(result_key, response.model_dump_json().encode())
+        return response
 
     # Parse the SPARQL query into a query object:
     try:
@@ -86,41 +188,239 @@ async def run_sparql(request: Request, sparql_request: SPARQLRequest) -> SPARQLR
         msg = "Unsupported SPARQL query type: " + parsed_query.algebra.name
         raise HTTPException(status_code=501, detail=msg) from None
 
-    # Run inference if requested:
-    if sparql_request.inference:
+    # Determine the format of the response based on the Accept header:
+    serialization_format, media_type = await get_format_and_media_type(
+        query_type, request
+    )
+    context = None
+    if serialization_format == "json-ld":
+        context = await get_context_from_prefixes_in_data(sparql_request.data or "")
+
+    def execute() -> SPARQLResponse:
+        """Evaluate the query, outside the event loop."""
+        # Parse the RDF data into a graph, with inferred triples if requested:
+        version, graph = load_source(sparql_request, dataset)
+        index_key = cache_key(
+            prefix + "textindex", version or source, sparql_request.inference
+        )
+        optimise_query(parsed_query, graph, sparql_request.inference, index_key)
+
+        # Run the query, or only explain it:
+        response = evaluate(
+            parsed_query,
+            graph,
+            sparql_request.explain,
+            (serialization_format, media_type),
+            context,
+        )
+        # The timings of an analysis are not reused:
+        if sparql_request.explain != Explain.ANALYZE:
+            cache.put(result_key, response.model_dump_json().encode())
+        return response
+
+    # Identical requests in flight share a single evaluation, which is admitted
+    # according to its estimated cost:
+    triples = estimate_triples(source) if dataset is None else dataset.length() or 1
+    cost = estimate_cost(
+        triples,
+        sparql_request.inference,
+        query_factor(parsed_query.algebra),
+    )
+    client = client_of(request)
+    return await flights.do(
+        result_key, execute, admit=lambda: scheduler.admit(client, cost)
+    )
+
+
+@router.post(
+    "/sparql/update",
+    dependencies=[Depends(check_content_type)],
+    responses={
+        200: {
+            "description": "Result of running the SPARQL update",
+        },
+        404: {
+            "description": "The dataset does not exist",
+        },
+    },
+)
+async def run_sparql_update(
+    update_request: SPARQLUpdateRequest,
+) -> SPARQLUpdateResponse:
+    """Run the given SPARQL update on a dataset held by the server.
+
+    Concurrent updates are committed together in a single transaction, in
+    which every update is atomic. Queries keep reading the previous version
+    of the dataset until the transaction is committed.
+    """
+    dataset = held_dataset(update_request.dataset)
+
+    # Parse the SPARQL update into an update object:
+    try:
+        parsed_update = prepareUpdate(update_request.update)
+    except Exception as e:
+        msg = "Invalid SPARQL update: " + str(e)
+        raise HTTPException(status_code=400, detail=msg) from e
+
+    # Check that the operations only use the dataset:
+    for operation in parsed_update.algebra:
+        if operation.name not in UPDATE_OPERATIONS or operation.using:
+            msg = "Unsupported SPARQL update operation: " + operation.name
+            raise HTTPException(status_code=501, detail=msg)
+
+    # Apply the update in the next transaction:
+    try:
+        result = await dataset.update(parsed_update)
+    except UpdateError as e:
+        msg = "Error running SPARQL update: " + str(e)
+        raise HTTPException(status_code=400, detail=msg) from e
+    return SPARQLUpdateResponse(dataset=dataset.name, **result._asdict())
+
+
+def evaluate(
+    parsed_query: Query,
+    graph: Graph,
+    explain: Explain,
+    format_and_media_type: tuple[str, str],
+    context: dict[str, str] | None,
+) -> SPARQLResponse:
+    """Run the query and serialize its result, and describe its plan if asked."""
+    if explain == Explain.PLAN:
+        return SPARQLResponse(
+            length=0,
+            result="",
+            plan=PlanNode.model_validate(describe_plan(parsed_query.algebra)),
+        )
+    serialization_format, media_type = format_and_media_type
+    with (
+        analyze() if explain == Explain.ANALYZE else contextlib.nullcontext() as (
+            current
+        )
+    ):
+        # Run the query:
         try:
-            DeductiveClosure(OWLRL_Semantics).expand(graph)
+            qres = graph.query(parsed_query)
         except Exception as e:  # pragma: no cover
-            msg = "Error running inference: " + str(e)
+            msg = "Error running SPARQL query: " + str(e)
             raise HTTPException(status_code=400, detail=msg) from e
 
-    # Run the query:
+        # Serialize the result, which consumes the solutions:
+        try:
+            result = serialize_result(qres, serialization_format, context)
+        except Exception as e:  # pragma: no cover
+            msg = "Error serializing query results: " + str(e)
+            raise HTTPException(status_code=400, detail=msg) from e
+    plan = None
+    if current is not None:
+        plan = PlanNode.model_validate(describe_plan(parsed_query.algebra, current))
+    return SPARQLResponse(
+        length=len(qres), result=result, result_content_type=media_type, plan=plan
+    )
+
+
+def matching_view(
+    sparql_request: SPARQLRequest, dataset: Dataset | None
+) -> MaterializedView | None:
+    """Get the view of the dataset with the same query, if there is one.
+
+    Views hold the results without inference, and have no plan to explain.
+    """
+    if (
+        dataset is None
+        or sparql_request.inference != InferenceMode.NONE
+        or sparql_request.explain != Explain.NONE
+    ):
+        return None
+    return dataset.view(sparql_request.query)
+
+
+async def view_response(view: MaterializedView, request: Request) -> SPARQLResponse:
+    """Serialize the table of a view as the result of its query."""
+    serialization_format, media_type = await get_format_and_media_type(
+        SPARQLQueryType.SELECT, request
+    )
+    qres = view.result()
+    return SPARQLResponse(
+        length=len(qres),
+        result=serialize_result(qres, serialization_format, None),
+        result_content_type=media_type,
+    )
+
+
+def optimise_query(
+    parsed_query: Query, graph: Graph, inference: InferenceMode, index_key: str
+) -> None:
+    """Rewrite the query for the inference mode, and to use the text index."""
+    if inference == InferenceMode.REWRITE:
+        rewrite_query(parsed_query, graph)
+    # Look up the literals matching text FILTERs in the index of the graph:
+    if TEXT_INDEX:
+        accelerate_text_filters(parsed_query, lambda: text_index(index_key, graph))
+
+
+def load_source(
+    sparql_request: SPARQLRequest, dataset: Dataset | None
+) -> tuple[str | None, Graph]:
+    """Get the graph to query: the parsed data, or the latest dataset snapshot.
+
+    Also returns the version of the dataset snapshot.
+    """
+    if dataset is None:
+        return None, load_graph(sparql_request.data or "", sparql_request.inference)
     try:
-        qres = graph.query(parsed_query)
+        version, graph = dataset.graph(sparql_request.inference)
+    except KeyError as e:  # pragma: no cover - deleted meanwhile
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Unknown dataset {dataset.name}",
+        ) from e
+    return str(version), graph
+
+
+def serialize_result(
+    qres: Result, serialization_format: str, context: dict[str, str] | None
+) -> str:
+    """Serialize the result of a query, with a JSON-LD context if given."""
+    if qres.type == "ASK":
+        return "true" if qres.askAnswer else "false"
+    if context is not None:
+        return qres.serialize(format=serialization_format, context=context)
+    return qres.serialize(format=serialization_format)
+
+
+def load_graph(data: str, inference: InferenceMode) -> Graph:
+    """Parse the RDF data into a graph and materialise the inferred triples.
+
+    The resulting graph is shared with the other workers through the cache.
+    """
+    # The rewrite mode expands the query instead of the graph:
+    if inference == InferenceMode.REWRITE:
+        inference = InferenceMode.NONE
+    key = cache_key("graph", data, inference)
+    graph = cache.get_graph(key)
+    if graph is not None:
+        return graph
+
+    graph = governed_graph()
+    try:
+        graph.parse(data=data)
+    except Error as e:
+        msg = f"Error: {type(e)} : " + str(e)
+        raise HTTPException(status_code=400, detail=msg) from e
     except Exception as e:  # pragma: no cover
-        msg = "Error running SPARQL query: " + str(e)
+        msg = "Invalid RDF data: " + str(e)
         raise HTTPException(status_code=400, detail=msg) from e
+    charge(graph)
 
-    # Determine the format of the response based on the Accept header:
-    serialization_format, media_type = await get_format_and_media_type(
-        query_type, request
-    )
-    # Serialize the result:
+    # Run inference if requested:
     try:
-        length = len(qres)
-        if parsed_query.algebra.name == "AskQuery":
-            result = "true" if qres.askAnswer else "false"
-        elif serialization_format == "json-ld":
-            context = await get_context_from_prefixes_in_data(sparql_request.data)
-            result = qres.serialize(format=serialization_format, context=context)
-        else:
-            result = qres.serialize(format=serialization_format)
-        return SPARQLResponse(
-            length=length, result=result, result_content_type=media_type
-        )
+        expand(graph, inference)
     except Exception as e:  # pragma: no cover
-        msg = "Error serializing query results: " + str(e)
+        msg = "Error running inference: " + str(e)
         raise HTTPException(status_code=400, detail=msg) from e
+    charge(graph)
+    cache.put_graph(key, graph)
+    return graph
 
 
 async def get_format_and_media_type(
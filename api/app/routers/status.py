@@ -0,0 +1,95 @@
+"""API endpoints for monitoring the state of a worker."""
+
+import logging
+
+from fastapi import APIRouter
+from pydantic import BaseModel
+
+from app.memory import worker_account
+from app.scheduler import scheduler
+from app.singleflight import flights
+
+router = APIRouter(tags=["status"])
+logger = logging.getLogger("uvicorn.error")
+
+
+class FlightStats(BaseModel):
+    """Model for the computations in flight in a worker.
+
+    `flights` maps the key of every computation in flight to the number of
+    requests waiting on it.
+    """
+
+    in_flight: int
+    waiters: int
+    started: int
+    coalesced: int
+    flights: dict[str, int]
+
+
+@router.get(
+    "/status/flights",
+    responses={
+        200: {
+            "description": "Computations in flight and their waiter counts",
+        },
+    },
+)
+async def get_flights() -> FlightStats:
+    """Get the computations in flight in the worker serving the request."""
+    return FlightStats.model_validate(flights.stats())
+
+
+class AdmissionStats(BaseModel):
+    """Model for the jobs of a priority class in a worker.
+
+    `service_time` is the average time a job of the class holds its slot,
+    in seconds.
+    """
+
+    running: int
+    queued: int
+    admitted: int
+    rejected: int
+    service_time: float
+
+
+@router.get(
+    "/status/admission",
+    responses={
+        200: {
+            "description": "Running, queued and rejected jobs per priority class",
+        },
+    },
+)
+async def get_admission() -> dict[str, AdmissionStats]:
+    """Get the state of admission control in the worker serving the request."""
+    return {
+        priority: AdmissionStats.model_validate(stats)
+        for priority, stats in scheduler.stats().items()
+    }
+
+
+class MemoryStats(BaseModel):
+    """Model for the estimated memory held by the graphs of a worker, in bytes.
+
+    `spilled` counts the graphs moved to disk since the worker started.
+    """
+
+    held: int
+    peak: int
+    limit: int
+    spilled: int
+
+
+@router.get(
+    "/status/memory",
+    responses={
+        200: {
+            "description": "Memory held by the graphs of the worker",
+        },
+    },
+)
+async def get_memory() -> MemoryStats:
+    """Get the memory accounted in the worker serving the request."""
+    return MemoryStats.model_validate(worker_account.stats())
@@ -0,0 +1,292 @@
+"""Cost-aware admission control and fair scheduling of evaluations.
+
+Every evaluation gets an estimated cost, from the size of its payload, the
+number of triples, the inference mode and the shape of the query algebra.
+The cost puts it in a priority class. Evaluations run as long as there are
+free slots: overall, per class and per client. The others wait in the queue
+of their class, where clients take turns, and the waiting time of a job
+raises its priority, so that heavy jobs are delayed but not starved. When
+the queue of a class is full, the job is rejected with a retry delay.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import math
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any
+
+from rdflib.paths import Path
+from rdflib.plugins.sparql.algebra import traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from app.inference import InferenceMode
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from fastapi import Request
+
+# Number of evaluations running at the same time in a worker:
+ADMISSION_SLOTS = int(os.getenv("ADMISSION_SLOTS", "0")) or os.cpu_count() or 1
+# Number of heavy evaluations running at the same time in a worker:
+ADMISSION_HEAVY_SLOTS = int(os.getenv("ADMISSION_HEAVY_SLOTS", "0")) or max(
+    1, ADMISSION_SLOTS // 4
+)
+# Number of evaluations of a single client running at the same time:
+ADMISSION_CLIENT_SLOTS = int(os.getenv("ADMISSION_CLIENT_SLOTS", "0")) or max(
+    1, ADMISSION_SLOTS // 2
+)
+# Number of evaluations waiting in the queue of each priority class:
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "64"))
+
+# Bounds of the cost of the cheap and heavy classes:
+CHEAP_COST = 10_000
+HEAVY_COST = 1_000_000
+# Waiting this many seconds raises the priority of a job by one class:
+AGING_SECONDS = 5.0
+# Payload bytes per triple, for data without line breaks (e.g. JSON-LD):
+BYTES_PER_TRIPLE = 100
+# Weight of the closure for each inference mode, relative to no inference:
+INFERENCE_FACTORS = {
+    InferenceMode.NONE: 1.0,
+    InferenceMode.REWRITE: 2.0,
+    InferenceMode.OWL_RL_LITE: 3.0,
+    InferenceMode.RDFS: 10.0,
+    InferenceMode.OWL_RL: 50.0,
+}
+# Weight of the algebra operators, on top of one per triple pattern:
+OPERATOR_WEIGHTS = {
+    "Join": 1.0,
+    "LeftJoin": 2.0,
+    "Minus": 2.0,
+    "Union": 1.0,
+    "Filter": 0.5,
+    "Extend": 0.2,
+    "OrderBy": 1.0,
+    "AggregateJoin": 1.0,
+    "Group": 1.0,
+    "Distinct": 0.5,
+}
+# Weight of a triple pattern with a property path:
+PATH_WEIGHT = 5.0
+# Weight of the service time of the last job in the average of a class:
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class Priority(IntEnum):
+    """Priority classes, lower values are served first."""
+
+    CHEAP = 0
+    STANDARD = 1
+    HEAVY = 2
+
+
+class Overloaded(Exception):  # noqa: N818
+    """Raised when the queue of a priority class is full."""
+
+    def __init__(self, priority: Priority, retry_after: int) -> None:
+        """Keep the class of the rejected job and when to retry it, in seconds."""
+        super().__init__(f"Too many {priority.name.lower()} requests queued")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+def client_of(request: Request) -> str:
+    """Identify the client of a request, for fairness between clients.
+
+    Clients behind a shared proxy can identify themselves with the
+    X-Client-Id header.
+    """
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else "unknown"
+
+
+def estimate_triples(data: str) -> int:
+    """Estimate the number of triples in RDF data without parsing it.
+
+    Turtle and N-Triples have about one triple per line, other payloads are
+    estimated from their size.
+    """
+    return max(1, data.count("\n"), len(data) // BYTES_PER_TRIPLE)
+
+
+def query_factor(algebra: CompValue) -> float:
+    """Get the weight of a query from the operators of its algebra."""
+    weight = 0.0
+
+    def visit(node: Any) -> None:  # noqa: ANN401
+        nonlocal weight
+        if isinstance(node, CompValue):
+            weight += OPERATOR_WEIGHTS.get(node.name, 0.0)
+            if node.name == "BGP":
+                weight += sum(
+                    PATH_WEIGHT if isinstance(p, Path) else 1.0
+                    for _, p, _ in node.triples
+                )
+
+    traverse(algebra, visitPre=visit)
+    return 1.0 + weight
+
+
+def estimate_cost(triples: int, inference: InferenceMode, factor: float = 1.0) -> float:
+    """Estimate the cost of evaluating a query or shapes of the given weight."""
+    return triples * INFERENCE_FACTORS[inference] * factor
+
+
+def classify(cost: float) -> Priority:
+    """Get the priority class of a job of the given cost."""
+    if cost < CHEAP_COST:
+        return Priority.CHEAP
+    if cost < HEAVY_COST:
+        return Priority.STANDARD
+    return Priority.HEAVY
+
+
+@dataclass
+class Job:
+    """An evaluation waiting for a slot."""
+
+    client: str
+    priority: Priority
+    enqueued: float
+    granted: asyncio.Future[None]
+
+
+@dataclass
+class Scheduler:
+    """Admit evaluations within the slots of a worker, queueing the others."""
+
+    slots: int = ADMISSION_SLOTS
+    heavy_slots: int = ADMISSION_HEAVY_SLOTS
+    client_slots: int = ADMISSION_CLIENT_SLOTS
+    max_queued: int = ADMISSION_MAX_QUEUED
+    # Per class, the clients in turn order and their waiting jobs:
+    queues: dict[Priority, OrderedDict[str, deque[Job]]] = field(
+        default_factory=lambda: {priority: OrderedDict() for priority in Priority}
+    )
+    running: Counter[Priority] = field(default_factory=Counter)
+    client_running: Counter[str] = field(default_factory=Counter)
+    admitted: Counter[Priority] = field(default_factory=Counter)
+    rejected: Counter[Priority] = field(default_factory=Counter)
+    # Average service time of each class, in seconds:
+    service_times: dict[Priority, float] = field(default_factory=dict)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, client: str, cost: float) -> AsyncIterator[None]:
+        """Wait for a slot for a job of the given cost, and hold it.
+
+        Raises Overloaded if the queue of the class of the job is full.
+        """
+        priority = classify(cost)
+        if self.queued(priority) >= self.max_queued:
+            self.rejected[priority] += 1
+            raise Overloaded(priority, self.retry_after(priority))
+        job = Job(
+            client=client,
+            priority=priority,
+            enqueued=time.monotonic(),
+            granted=asyncio.get_running_loop().create_future(),
+        )
+        self.queues[priority].setdefault(client, deque()).append(job)
+        self._dispatch()
+        try:
+            await job.granted
+        except asyncio.CancelledError:
+            if job.granted.done() and not job.granted.cancelled():
+                # The slot was granted while the job was being cancelled:
+                self._release(job, 0.0)
+            else:
+                self._dequeue(job)
+            raise
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(job, time.monotonic() - started)
+
+    def queued(self, priority: Priority) -> int:
+        """Get the number of jobs waiting in the queue of a class."""
+        return sum(len(jobs) for jobs in self.queues[priority].values())
+
+    def retry_after(self, priority: Priority) -> int:
+        """Estimate when a rejected job of the class may be admitted, in seconds."""
+        service_time = self.service_times.get(priority, 1.0)
+        slots = self.heavy_slots if priority == Priority.HEAVY else self.slots
+        return max(1, math.ceil(self.queued(priority) * service_time / slots))
+
+    def stats(self) -> dict[str, Any]:
+        """Get the running, queued, admitted and rejected jobs of every class."""
+        return {
+            priority.name.lower(): {
+                "running": self.running[priority],
+                "queued": self.queued(priority),
+                "admitted": self.admitted[priority],
+                "rejected": self.rejected[priority],
+                "service_time": round(self.service_times.get(priority, 0.0), 3),
+            }
+            for priority in Priority
+        }
+
+    def _dispatch(self) -> None:
+        """Grant free slots to the waiting jobs, by aged priority and in turns."""
+        while sum(self.running.values()) < self.slots:
+            now = time.monotonic()
+            candidates = [
+                job
+                for priority in Priority
+                if (job := self._next(priority)) is not None
+            ]
+            if not candidates:
+                return
+            job = min(
+                candidates,
+                key=lambda job: job.priority - (now - job.enqueued) / AGING_SECONDS,
+            )
+            self._dequeue(job)
+            # The client goes to the back of the line of its class:
+            if job.client in self.queues[job.priority]:
+                self.queues[job.priority].move_to_end(job.client)
+            self.running[job.priority] += 1
+            self.client_running[job.client] += 1
+            self.admitted[job.priority] += 1
+            job.granted.set_result(None)
+
+    def _next(self, priority: Priority) -> Job | None:
+        """Get the first job of the class whose client has a free slot."""
+        if priority == Priority.HEAVY and self.running[priority] >= self.heavy_slots:
+            return None
+        for client, jobs in self.queues[priority].items():
+            if self.client_running[client] < self.client_slots:
+                return jobs[0]
+        return None
+
+    def _dequeue(self, job: Job) -> None:
+        """Remove a job from the queue of its class."""
+        jobs = self.queues[job.priority][job.client]
+        jobs.remove(job)
+        if not jobs:
+            del self.queues[job.priority][job.client]
+
+    def _release(self, job: Job, service_time: float) -> None:
+        """Free the slot of a job and grant it to the next one."""
+        self.running[job.priority] -= 1
+        self.client_running[job.client] -= 1
+        # Forget idle clients, which may be many and never come back:
+        if not self.client_running[job.client]:
+            del self.client_running[job.client]
+        average = self.service_times.get(job.priority, service_time)
+        self.service_times[job.priority] = (
+            1 - SERVICE_TIME_SMOOTHING
+        ) * average + SERVICE_TIME_SMOOTHING * service_time
+        self._dispatch()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,92 @@
+"""Coalescing of identical requests in flight.
+
+While a computation for a key is running, later requests for the same key
+wait on it and share its result, instead of starting their own. The
+computation runs in a thread, so that the event loop keeps accepting the
+requests that join it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from contextlib import AbstractAsyncContextManager
+
+
+@dataclass
+class Flight:
+    """A running computation and the number of requests waiting on it."""
+
+    task: asyncio.Future[Any]
+    waiters: int = 0
+
+
+@dataclass
+class SingleFlight:
+    """Run at most one computation per key at a time, within a worker."""
+
+    flights: dict[str, Flight] = field(default_factory=dict)
+    # Number of computations started, and of requests that joined one instead:
+    started: int = 0
+    coalesced: int = 0
+
+    async def do[T](
+        self,
+        key: str,
+        fn: Callable[[], T],
+        admit: Callable[[], AbstractAsyncContextManager[Any]] | None = None,
+    ) -> T:
+        """Run fn in a thread, or wait on the running computation for the key.
+
+        A new computation first enters the admit context, if given, so that
+        only the request starting it is subject to admission control. Errors
+        are shared like results. A waiter that is cancelled, e.g. because its
+        client disconnected, does not cancel the computation.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(task=asyncio.ensure_future(_run(fn, admit)))
+            self.flights[key] = flight
+            self.started += 1
+            flight.task.add_done_callback(lambda task: self._land(key, task))
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+
+    def stats(self) -> dict[str, Any]:
+        """Get the computations in flight and their waiter counts."""
+        return {
+            "in_flight": len(self.flights),
+            "waiters": sum(flight.waiters for flight in self.flights.values()),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "flights": {key: flight.waiters for key, flight in self.flights.items()},
+        }
+
+    def _land(self, key: str, task: asyncio.Future[Any]) -> None:
+        """Forget a finished computation, so that the next request starts anew."""
+        del self.flights[key]
+        # Retrieve the error, which is not logged if every waiter has gone:
+        if not task.cancelled():
+            task.exception()
+
+
+async def _run[T](
+    fn: Callable[[], T],
+    admit: Callable[[], AbstractAsyncContextManager[Any]] | None,
+) -> T:
+    """Run fn in a thread, within the admit context if given."""
+    async with (admit or contextlib.nullcontext)():
+        return await asyncio.to_thread(fn)
+
+
+flights = SingleFlight()
@@ -0,0 +1,207 @@
+"""Trigram index over literals, to answer text FILTERs with index lookups.
+
+FILTERs like CONTAINS(LCASE(?label), "foo") or REGEX(?label, "foo") make the
+evaluator test every literal the BGP binds to ?label. With the index, the
+literals that may match are looked up by the trigrams of the searched text,
+and bound to ?label before the BGP is evaluated. The FILTER itself is kept,
+so the lookup only has to return a superset of the matches.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from itertools import chain
+from typing import TYPE_CHECKING, Any
+
+from rdflib import Literal, Variable
+from rdflib.plugins.sparql.algebra import traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from app.cache import cache
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+    from rdflib import Graph
+    from rdflib.plugins.sparql.sparql import Query
+
+# Set to false to evaluate text FILTERs without the index:
+TEXT_INDEX = os.getenv("TEXT_INDEX", "true").lower() not in ("0", "false", "no")
+# Number of indexes kept in memory by every worker:
+TEXT_INDEX_MAX_HELD = int(os.getenv("TEXT_INDEX_MAX_HELD", "8"))
+NGRAM = 3
+# Functions testing a text for a substring, by the name of their argument:
+SUBSTRING_FUNCTIONS = {
+    "Builtin_CONTAINS": "arg2",
+    "Builtin_STRSTARTS": "arg2",
+    "Builtin_STRENDS": "arg2",
+}
+# Regex syntax the required substrings of a pattern cannot be derived around:
+REGEX_UNSUPPORTED = frozenset("|()[]\\")
+REGEX_QUANTIFIERS = frozenset("?*{")
+REGEX_OPERATORS = frozenset(".^$+")
+# Regex flags that do not change which substrings a match contains:
+REGEX_FLAGS = frozenset("ism")
+
+
+def fold(text: str) -> str:
+    """Fold the case of a text, so that texts equal ignoring case are equal.
+
+    Dotless i is folded to i too, as regexes ignoring case match them.
+    """
+    return text.casefold().replace("\u0131", "i")
+
+
+def trigrams(text: str) -> set[str]:
+    """Get the trigrams of a case-folded text."""
+    return {text[i : i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class TextIndex:
+    """The literals of a graph, indexed by the trigrams of their case-folded text."""
+
+    def __init__(self, graph: Graph) -> None:
+        """Index the literals in object position of the graph."""
+        self.literals = sorted({o for o in graph.objects() if isinstance(o, Literal)})
+        self.texts = [fold(str(literal)) for literal in self.literals]
+        self.postings: dict[str, list[int]] = {}
+        for i, text in enumerate(self.texts):
+            for trigram in trigrams(text):
+                self.postings.setdefault(trigram, []).append(i)
+
+    def search(self, needles: list[str]) -> list[Literal]:
+        """Get the literals containing all the needles, ignoring case."""
+        needles = list(map(fold, needles))
+        postings = sorted(
+            (
+                self.postings.get(trigram, [])
+                for trigram in set().union(*map(trigrams, needles))
+            ),
+            key=len,
+        )
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [
+            self.literals[i]
+            for i in sorted(candidates)
+            if all(needle in self.texts[i] for needle in needles)
+        ]
+
+
+held: OrderedDict[str, TextIndex] = OrderedDict()
+held_lock = threading.Lock()
+
+
+def text_index(key: str, graph: Graph) -> TextIndex:
+    """Get the index of a graph, from memory, the shared cache, or built anew.
+
+    The key identifies the content of the graph, as for the cache.
+    """
+    index = held.get(key)
+    if index is None:
+        index = cache.get_object(key)
+        if index is None:
+            index = TextIndex(graph)
+            cache.put_object(key, index)
+    with held_lock:
+        held[key] = index
+        held.move_to_end(key)
+        while len(held) > TEXT_INDEX_MAX_HELD:
+            held.popitem(last=False)
+    return index
+
+
+def accelerate_text_filters(query: Query, index: Callable[[], TextIndex]) -> int:
+    """Bind the candidates of text FILTERs over a BGP before evaluating it.
+
+    The index is only built if the query has such a FILTER. Returns the
+    number of FILTERs accelerated.
+    """
+    accelerated = 0
+
+    def visit(node: Any) -> None:  # noqa: ANN401
+        nonlocal accelerated
+        if not (
+            isinstance(node, CompValue)
+            and node.name == "Filter"
+            and isinstance(node.p, CompValue)
+            and node.p.name == "BGP"
+        ):
+            return
+        objects = {o for _, _, o in node.p.triples if isinstance(o, Variable)}
+        for variable, needles in text_filters(node.expr):
+            if variable in objects:
+                values = CompValue(
+                    "values",
+                    res=[{variable: literal} for literal in index().search(needles)],
+                )
+                # A lazy join evaluates the BGP once per candidate literal:
+                node.p = CompValue(
+                    "Join",
+                    p1=CompValue("ToMultiSet", p=values),
+                    p2=node.p,
+                    lazy=True,
+                )
+                accelerated += 1
+                return
+
+    traverse(query.algebra, visitPre=visit)
+    return accelerated
+
+
+def text_filters(expr: Any) -> Iterator[tuple[Variable, list[str]]]:  # noqa: ANN401
+    """Get the variables of a FILTER that must contain the given needles.
+
+    Only the conjuncts whose needles have a trigram are returned, testing a
+    variable or its lowercase form, as those can only match literals.
+    """
+    if not isinstance(expr, CompValue):
+        return
+    if expr.name == "ConditionalAndExpression":
+        for conjunct in chain([expr.expr], expr.other):
+            yield from text_filters(conjunct)
+        return
+    if expr.name in SUBSTRING_FUNCTIONS:
+        text, needle = expr.arg1, expr[SUBSTRING_FUNCTIONS[expr.name]]
+        needles = [str(needle)] if isinstance(needle, Literal) else []
+    elif expr.name == "Builtin_REGEX" and isinstance(expr.pattern, Literal):
+        text = expr.text
+        flags = str(expr.flags or "")
+        needles = (
+            [] if set(flags) - REGEX_FLAGS else required_substrings(str(expr.pattern))
+        )
+    else:
+        return
+    if isinstance(text, CompValue) and text.name == "Builtin_LCASE":
+        text = text.arg
+    needles = [needle for needle in needles if len(needle) >= NGRAM]
+    if isinstance(text, Variable) and needles:
+        yield text, needles
+
+
+def required_substrings(pattern: str) -> list[str]:
+    """Get substrings that every match of a regex pattern contains.
+
+    Patterns with alternatives, groups, classes or escapes have none.
+    """
+    if REGEX_UNSUPPORTED & set(pattern):
+        return []
+    substrings = []
+    run = ""
+    chars = iter(pattern)
+    for char in chars:
+        if char in REGEX_QUANTIFIERS:
+            # The quantified character may be absent:
+            run = run[:-1]
+            if char == "{":
+                for closing in chars:  # pragma: no branch
+                    if closing == "}":
+                        break
+        elif char not in REGEX_OPERATORS:
+            run += char
+            continue
+        substrings.append(run)
+        run = ""
+    substrings.append(run)
+    return [substring for substring in substrings if substring]
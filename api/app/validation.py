@@ -0,0 +1,181 @@
+"""Parallel SHACL validation partitioned by shape and focus node."""
+
+from __future__ import annotations
+
+import math
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import TYPE_CHECKING
+
+from pyshacl import ShapesGraph, Validator
+from rdflib import RDF, SH, BNode, Graph, Literal
+
+from app.memory import shared_graph
+
+if TYPE_CHECKING:
+    from rdflib.term import Node
+
+# Number of worker processes used for parallel validation:
+SHACL_WORKERS = int(os.getenv("SHACL_WORKERS", "0")) or os.cpu_count() or 1
+# Data graphs with fewer triples are validated in the worker serving the
+# request, as starting the partitions costs more than it saves:
+SHACL_PARALLEL_MIN_TRIPLES = int(os.getenv("SHACL_PARALLEL_MIN_TRIPLES", "50000"))
+# Number of partitions per worker, to even out shapes of different cost:
+PARTITIONS_PER_WORKER = 4
+
+type Partition = tuple[Node, list[Node]]
+type PartialReport = tuple[bool, list[Node], list[tuple[Node, Node, Node]]]
+
+# The process pools, by number of workers, started on first use and kept:
+_pools: dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+# State of a worker process, set up once per validation:
+_worker: dict[str, Validator | Graph | str] = {}
+
+
+def validate_parallel(
+    data_graph: Graph,
+    shapes_graph: Graph,
+    max_workers: int = SHACL_WORKERS,
+) -> tuple[bool, Graph]:
+    """Validate the data graph against the shapes graph using a process pool.
+
+    The work is split into (shape, focus nodes) partitions and the partial
+    reports are merged into a single sh:ValidationReport. The workers open the
+    data graph from its database on disk, rather than getting a copy, and set
+    up a validator once per validation. Small data graphs are validated in the
+    calling process.
+    """
+    partitions = partition(data_graph, ShapesGraph(shapes_graph), max_workers)
+    if len(data_graph) < SHACL_PARALLEL_MIN_TRIPLES:
+        validator = make_validator(data_graph, shapes_graph)
+        partials = [
+            validate_focus_nodes(validator, data_graph, node, focus_nodes)
+            for node, focus_nodes in partitions
+        ]
+        return merge_reports(shapes_graph, partials)
+
+    shared = shared_graph(data_graph)
+    job = secrets.token_hex(8)
+    # The graphs are pickled once per chunk of partitions:
+    partials = list(
+        process_pool(max_workers).map(
+            validate_job_partition,
+            repeat(job),
+            repeat(shared),
+            repeat(shapes_graph),
+            partitions,
+            chunksize=PARTITIONS_PER_WORKER,
+        )
+    )
+    return merge_reports(shapes_graph, partials)
+
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Get the process pool with the given number of workers, starting it once."""
+    with _pools_lock:
+        pool = _pools.get(max_workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                # Requests are validated in threads, and forking a threaded
+                # process may deadlock:
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+            _pools[max_workers] = pool
+        return pool
+
+
+def partition(
+    data_graph: Graph, shapes_graph: ShapesGraph, max_workers: int
+) -> list[Partition]:
+    """Split the focus nodes of every shape into evenly sized partitions."""
+    targets = [
+        (shape.node, list(shape.focus_nodes(data_graph)))
+        for shape in shapes_graph.shapes
+    ]
+    total = sum(len(focus_nodes) for _, focus_nodes in targets)
+    size = max(1, math.ceil(total / (max_workers * PARTITIONS_PER_WORKER)))
+    return [
+        (node, focus_nodes[i : i + size])
+        for node, focus_nodes in targets
+        for i in range(0, len(focus_nodes), size)
+    ]
+
+
+def init_worker(data_graph: Graph, shapes_graph: Graph) -> None:
+    """Set up the validator of a worker process."""
+    validator = make_validator(data_graph, shapes_graph)
+    _worker.clear()
+    _worker["validator"] = validator
+    _worker["data_graph"] = data_graph
+
+
+def make_validator(data_graph: Graph, shapes_graph: Graph) -> Validator:
+    """Get a validator of the data graph whose shapes can be looked up by node."""
+    validator = Validator(
+        data_graph, shacl_graph=shapes_graph, options={"inplace": True}
+    )
+    # Harvest the shapes, so that they can be looked up by node:
+    _ = validator.shacl_graph.shapes
+    return validator
+
+
+def validate_job_partition(
+    job: str, data_graph: Graph, shapes_graph: Graph, task: Partition
+) -> PartialReport:
+    """Validate a partition in a worker process, set up for its validation."""
+    if _worker.get("job") != job:
+        init_worker(data_graph, shapes_graph)
+        _worker["job"] = job
+    return validate_partition(task)
+
+
+def validate_partition(task: Partition) -> PartialReport:
+    """Validate the focus nodes of a partition against its shape."""
+    validator: Validator = _worker["validator"]  # type: ignore[invalid-assignment]
+    data_graph: Graph = _worker["data_graph"]  # type: ignore[invalid-assignment]
+    node, focus_nodes = task
+    return validate_focus_nodes(validator, data_graph, node, focus_nodes)
+
+
+def validate_focus_nodes(
+    validator: Validator, data_graph: Graph, node: Node, focus_nodes: list[Node]
+) -> PartialReport:
+    """Validate the given focus nodes against a single shape."""
+    shape = validator.shacl_graph.lookup_shape_from_node(node)
+    conforms, results = shape.validate(
+        validator.make_executor(), data_graph, focus=focus_nodes
+    )
+    report_graph, _ = Validator.create_validation_report(
+        validator.shacl_graph, conforms, results
+    )
+    report = report_graph.value(predicate=RDF.type, object=SH.ValidationReport)
+    return (
+        conforms,
+        list(report_graph.objects(report, SH.result)),
+        [triple for triple in report_graph if triple[0] != report],
+    )
+
+
+def merge_reports(
+    shapes_graph: Graph, partials: list[PartialReport]
+) -> tuple[bool, Graph]:
+    """Merge partial validation reports into a single report."""
+    report_graph = Graph(bind_namespaces="core")
+    for prefix, namespace in shapes_graph.namespace_manager.namespaces():
+        report_graph.namespace_manager.bind(prefix, namespace)
+    conforms = all(partial_conforms for partial_conforms, _, _ in partials)
+    report = BNode()
+    report_graph.add((report, RDF.type, SH.ValidationReport))
+    report_graph.add((report, SH.conforms, Literal(conforms)))
+    for _, results, triples in partials:
+        for result in results:
+            report_graph.add((report, SH.result, result))
+        for triple in triples:
+            report_graph.add(triple)
+    return conforms, report_graph
@@ -0,0 +1,351 @@
+"""Materialized views over the datasets held by the server.
+
+A view is a named SELECT query on a dataset, whose result table is computed
+when the view is registered and kept with the dataset. When a transaction
+commits, only the views that read a predicate of the changed triples are
+evaluated again; the tables of the others still hold and are carried over to
+the new version. Views counting the solutions of a basic graph pattern, by
+group, are instead updated from the solutions the changed triples add and
+remove. Queries with the same text as a view are answered from its table.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import re
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+from rdflib import Literal, URIRef, Variable
+from rdflib.paths import AlternativePath, InvPath, MulPath, SequencePath
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import traverse, triples
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.query import Result
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from collections.abc import Set as AbstractSet
+
+    from rdflib import Graph
+    from rdflib.plugins.sparql.sparql import Query
+    from rdflib.term import Node
+
+    type Triple = tuple[Node, Node, Node]
+    type Binding = dict[Variable, Node]
+
+# The string literals of a query, long ones first, and the whitespace between:
+TOKENS = re.compile(
+    r'"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r"|\s+",
+    re.DOTALL,
+)
+
+
+@dataclass(frozen=True)
+class Counting:
+    """The shape of a view counting the solutions of a basic graph pattern.
+
+    `groups` are the variables the solutions are grouped by, all of them in the
+    pattern. `columns` are, for every variable of the table, the group variable
+    it holds, or None if it holds the number of solutions of the group.
+    """
+
+    patterns: list[Triple]
+    groups: list[Variable]
+    columns: list[Variable | None]
+
+
+@dataclass(frozen=True)
+class Delta:
+    """The triples a transaction added and removed, and the graph it changed."""
+
+    previous: Graph
+    added: AbstractSet[Triple]
+    removed: AbstractSet[Triple]
+
+    @property
+    def predicates(self) -> set[Node]:
+        """Get the predicates of the changed triples."""
+        return {p for _, p, _ in self.added | self.removed}
+
+
+@dataclass(frozen=True)
+class MaterializedView:
+    """The result table of a view, for a version of its dataset.
+
+    `predicates` are the predicates the query reads, None if it may read any.
+    `refreshed` is the version the table was last computed on. `counting` is
+    the shape of the query, if it counts the solutions of a basic graph pattern.
+    """
+
+    query: str
+    predicates: frozenset[URIRef] | None
+    version: int
+    refreshed: int
+    variables: list[Variable]
+    rows: list[tuple[Node | None, ...]]
+    counting: Counting | None = None
+
+    def matches(self, query: str) -> bool:
+        """Whether a query has the same text as the view, up to whitespace.
+
+        Whitespace inside string literals is part of the text.
+        """
+        return normalize_query(query) == normalize_query(self.query)
+
+    def result(self) -> Result:
+        """Get the table as the result of the query."""
+        result = Result("SELECT")
+        result.vars = self.variables
+        result.bindings = [
+            {
+                variable: value
+                for variable, value in zip(self.variables, row, strict=True)
+                if value is not None
+            }
+            for row in self.rows
+        ]
+        return result
+
+
+def normalize_query(query: str) -> str:
+    """Collapse the whitespace of a query, outside its string literals."""
+    return TOKENS.sub(
+        lambda match: " " if match.group().isspace() else match.group(), query
+    ).strip()
+
+
+def materialize(query: str, graph: Graph, version: int) -> MaterializedView:
+    """Evaluate the query of a view on a version of its dataset."""
+    parsed_query = prepareQuery(query)
+    qres = graph.query(parsed_query)
+    return MaterializedView(
+        query=query,
+        predicates=read_predicates(parsed_query),
+        version=version,
+        refreshed=version,
+        variables=list(qres.vars or []),
+        rows=[tuple(row) for row in qres],
+        counting=counting_of(parsed_query),
+    )
+
+
+def refresh(
+    view: MaterializedView, graph: Graph, version: int, delta: Delta | None
+) -> MaterializedView:
+    """Bring a view to a new version of its dataset.
+
+    The delta holds the changes from the previous version, None means that
+    any triple may have changed. Views of an older version are evaluated
+    again. Views reading a predicate the delta changed are updated from it if
+    they count the solutions of a basic graph pattern, and evaluated again
+    otherwise.
+    """
+    if delta is None or view.version != version - 1:
+        return materialize(view.query, graph, version)
+    if view.predicates is not None and not view.predicates & delta.predicates:
+        return dataclasses.replace(view, version=version)
+    if view.counting is None:
+        return materialize(view.query, graph, version)
+    return dataclasses.replace(
+        view,
+        version=version,
+        refreshed=version,
+        rows=count_delta(view.counting, view.rows, graph, delta),
+    )
+
+
+def count_delta(
+    counting: Counting,
+    rows: list[tuple[Node | None, ...]],
+    graph: Graph,
+    delta: Delta,
+) -> list[tuple[Node | None, ...]]:
+    """Update the rows of a counting view from the solutions a delta changed.
+
+    The solutions that use an added triple are new, the solutions of the
+    previous graph that use a removed triple are gone. Groups left without
+    solutions are dropped, unless the solutions are not grouped.
+    """
+    group_columns = [counting.columns.index(group) for group in counting.groups]
+    count_column = counting.columns.index(None)
+    counts = {
+        tuple(row[i] for i in group_columns): int(str(row[count_column]))
+        for row in rows
+    }
+    for solutions, sign in (
+        (delta_solutions(counting.patterns, graph, delta.added), 1),
+        (delta_solutions(counting.patterns, delta.previous, delta.removed), -1),
+    ):
+        for solution in solutions:
+            key = tuple(solution[group] for group in counting.groups)
+            counts[key] = counts.get(key, 0) + sign
+    return [
+        tuple(
+            Literal(count) if column is None else key[counting.groups.index(column)]
+            for column in counting.columns
+        )
+        for key, count in counts.items()
+        if count or not counting.groups
+    ]
+
+
+def delta_solutions(
+    patterns: list[Triple], graph: Graph, triples: AbstractSet[Triple]
+) -> list[Binding]:
+    """Get the solutions of a basic graph pattern that use any of the triples."""
+    solutions: set[frozenset[tuple[Variable, Node]]] = set()
+    for i, pattern in enumerate(patterns):
+        others = patterns[:i] + patterns[i + 1 :]
+        for triple in triples:
+            binding = unify(pattern, triple, {})
+            if binding is not None:
+                solutions.update(
+                    frozenset(solution.items())
+                    for solution in solve(others, graph, binding)
+                )
+    return [dict(solution) for solution in solutions]
+
+
+def solve(patterns: list[Triple], graph: Graph, binding: Binding) -> Iterator[Binding]:
+    """Get the solutions of triple patterns in a graph that extend a binding."""
+    if not patterns:
+        yield binding
+        return
+    pattern, *others = patterns
+    s, p, o = (
+        binding.get(term) if isinstance(term, Variable) else term for term in pattern
+    )
+    for triple in graph.triples((s, p, o)):
+        extended = unify(pattern, triple, binding)
+        if extended is not None:
+            yield from solve(others, graph, extended)
+
+
+def unify(pattern: Triple, triple: Triple, binding: Binding) -> Binding | None:
+    """Extend a binding so that the pattern matches the triple, if it can."""
+    extended = dict(binding)
+    for term, value in zip(pattern, triple, strict=True):
+        if isinstance(term, Variable):
+            if extended.setdefault(term, value) != value:
+                return None
+        elif term != value:
+            return None
+    return extended
+
+
+def counting_of(query: Query) -> Counting | None:
+    """Get the shape of a query counting the solutions of a basic graph pattern.
+
+    Matches SELECT queries of group variables and COUNT(*) or COUNT of a
+    variable of the pattern, over a single basic graph pattern of variables,
+    IRIs and literals, with GROUP BY variables and no other modifier. Returns
+    None for other queries.
+    """
+    project = query.algebra.p
+    # The projected variables are bound to the aggregates by Extend nodes:
+    extended: dict[Variable, Variable] = {}
+    node = project.p if project.name == "Project" else project
+    while node.name == "Extend" and isinstance(node.expr, Variable):
+        extended[node.var] = node.expr
+        node = node.p
+    if node.name != "AggregateJoin" or node.p.name != "Group" or node.p.p.name != "BGP":
+        return None
+    patterns, groups = node.p.p.triples, list(node.p.expr or [])
+    terms = {term for pattern in patterns for term in pattern}
+    if not all(
+        isinstance(term, (Variable, URIRef, Literal)) for term in terms
+    ) or not all(isinstance(group, Variable) and group in terms for group in groups):
+        return None
+    aggregates = counted_aggregates(node.A, groups, terms)
+    projected = [extended.get(variable) for variable in project.PV]
+    columns = [aggregates[res] for res in projected if res in aggregates]
+    # Every group is a row, with its number of solutions:
+    if (
+        len(columns) < len(projected)
+        or None not in columns
+        or not set(groups) <= set(columns)
+    ):
+        return None
+    return Counting(patterns=list(patterns), groups=groups, columns=columns)
+
+
+def counted_aggregates(
+    aggregates: list[CompValue], groups: list[Variable], terms: set[Node]
+) -> dict[Variable, Variable | None]:
+    """Get the group variable or count each aggregate holds, None for a count.
+
+    Aggregates that hold neither are left out.
+    """
+    held: dict[Variable, Variable | None] = {}
+    for aggregate in aggregates:
+        if aggregate.name == "Aggregate_Sample" and aggregate.vars in groups:
+            held[aggregate.res] = aggregate.vars
+        elif (
+            aggregate.name == "Aggregate_Count"
+            and not aggregate.distinct
+            and (aggregate.vars == "*" or aggregate.vars in terms)
+        ):
+            held[aggregate.res] = None
+    return held
+
+
+def read_predicates(query: Query) -> frozenset[URIRef] | None:
+    """Get the predicates of the triple patterns of a query.
+
+    Returns None if a pattern has a variable or negated predicate. The patterns
+    of FILTER EXISTS and NOT EXISTS are read too; rdflib may leave them as the
+    triple blocks of the parsed query.
+    """
+    predicates: set[URIRef] = set()
+    unbounded = False
+
+    def visit(node: Any) -> None:  # noqa: ANN401
+        nonlocal unbounded
+        for _, predicate, _ in triple_patterns(node):
+            path_predicates = predicates_of(predicate)
+            if path_predicates is None:
+                unbounded = True
+            else:
+                predicates.update(path_predicates)
+
+    traverse(query.algebra, visitPre=visit)
+    return None if unbounded else frozenset(predicates)
+
+
+def triple_patterns(node: Any) -> list[tuple[Node, Any, Node]]:  # noqa: ANN401
+    """Get the triple patterns of a node of the algebra, if it holds any."""
+    if not isinstance(node, CompValue):
+        return []
+    if node.name == "BGP":
+        return node.triples
+    if node.name == "TriplesBlock":
+        # The parsed form lists the terms of its triples in a row:
+        return triples(node.triples)
+    return []
+
+
+def predicates_of(path: Any) -> set[URIRef] | None:  # noqa: ANN401
+    """Get the predicates a property path follows, or None if it may follow any."""
+    if isinstance(path, URIRef):
+        return {path}
+    if isinstance(path, (SequencePath, AlternativePath)):
+        parts = path.args
+    elif isinstance(path, MulPath):
+        parts = [path.path]
+    elif isinstance(path, InvPath):
+        parts = [path.arg]
+    else:
+        # A variable, or a negated path:
+        return None
+    predicates: set[URIRef] = set()
+    for part in parts:
+        part_predicates = predicates_of(part)
+        if part_predicates is None:
+            return None
+        predicates.update(part_predicates)
+    return predicates
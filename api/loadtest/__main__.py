@@ -0,0 +1,187 @@
+"""Command line interface of the load-test harness.
+
+Run a sweep over worker counts, concurrency levels and payload sizes:
+
+    uv run python -m loadtest run --workers 1,2,4 --concurrency 1,8,32 \
+        --output results.json
+
+Compare two sweeps, e.g. from two commits:
+
+    uv run python -m loadtest compare baseline.json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+from loadtest.harness import DEFAULT_MIX, EXAMPLE_FILES, commit, compare, run
+
+
+def integers(value: str) -> list[int]:
+    """Parse a comma-separated list of integers."""
+    return [int(item) for item in value.split(",")]
+
+
+def weights(value: str) -> dict[str, int]:
+    """Parse a request mix such as sparql=6,shacl=3,prefixes=1."""
+    mix = {}
+    for item in value.split(","):
+        endpoint, _, weight = item.partition("=")
+        if endpoint not in DEFAULT_MIX:
+            msg = f"Unknown endpoint {endpoint}"
+            raise argparse.ArgumentTypeError(msg)
+        mix[endpoint] = int(weight or 1)
+    return mix
+
+
+def table(rows: list[dict[str, Any]], columns: list[str]) -> str:
+    """Format rows as a plain text table."""
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(line, widths, strict=True))
+        for line in cells
+    )
+
+
+def run_command(args: argparse.Namespace) -> None:
+    """Run every combination of workers, concurrency and scale."""
+    runs = []
+    for scale in args.scale:
+        for workers in args.workers:
+            for concurrency in args.concurrency:
+                result = asyncio.run(
+                    run(
+                        workers=workers,
+                        concurrency=concurrency,
+                        duration=args.duration,
+                        mix=args.mix,
+                        corpus=args.corpus,
+                        scale=scale,
+                        cached=not args.no_cache,
+                    )
+                )
+                runs.append(result)
+                sys.stdout.write(
+                    f"workers={workers} concurrency={concurrency} scale={scale}: "
+                    f"{result['throughput']} req/s, "
+                    f"p99 {result['latency_ms']['p99']} ms, "
+                    f"loop lag p99 {result['loop_lag_ms']['p99']} ms\n"
+                )
+    results = {"commit": commit(), "created": time.time(), "runs": runs}
+    sys.stdout.write("\nScaling curves:\n")
+    sys.stdout.write(
+        table(
+            [
+                {
+                    **r,
+                    "p50_ms": r["latency_ms"]["p50"],
+                    "p99_ms": r["latency_ms"]["p99"],
+                    "lag_p99_ms": r["loop_lag_ms"]["p99"],
+                    "cpu_s": sum(p["cpu_seconds"] for p in r["processes"]),
+                    "peak_rss_mb": sum(p["peak_rss_mb"] for p in r["processes"]),
+                }
+                for r in runs
+            ],
+            [
+                "scale",
+                "workers",
+                "concurrency",
+                "throughput",
+                "p50_ms",
+                "p99_ms",
+                "lag_p99_ms",
+                "cpu_s",
+                "peak_rss_mb",
+            ],
+        )
+        + "\n"
+    )
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+def compare_command(args: argparse.Namespace) -> None:
+    """Compare the runs of two result files."""
+    baseline = json.loads(args.baseline.read_text())
+    candidate = json.loads(args.candidate.read_text())
+    sys.stdout.write(f"{baseline['commit']} -> {candidate['commit']}\n")
+    sys.stdout.write(
+        table(
+            compare(baseline, candidate),
+            [
+                "scale",
+                "workers",
+                "concurrency",
+                "throughput",
+                "throughput_change",
+                "p99_ms",
+                "p99_change",
+            ],
+        )
+        + "\n"
+    )
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Parse the arguments and run the command."""
+    parser = argparse.ArgumentParser(prog="loadtest", description=__doc__)
+    commands = parser.add_subparsers(required=True)
+
+    run_parser = commands.add_parser("run", help="run a load test sweep")
+    run_parser.add_argument(
+        "--workers",
+        type=integers,
+        default=[1],
+        help="uvicorn worker counts, 0 drives the app in-process (default: 1)",
+    )
+    run_parser.add_argument(
+        "--concurrency",
+        type=integers,
+        default=[1, 8, 32],
+        help="concurrent clients (default: 1,8,32)",
+    )
+    run_parser.add_argument(
+        "--scale",
+        type=integers,
+        default=[1],
+        help="replications of the example data in every payload (default: 1)",
+    )
+    run_parser.add_argument(
+        "--mix",
+        type=weights,
+        default=DEFAULT_MIX,
+        help="weights of the endpoints (default: sparql=6,shacl=3,prefixes=1)",
+    )
+    run_parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds per run (default: 10)"
+    )
+    run_parser.add_argument(
+        "--corpus",
+        type=Path,
+        default=EXAMPLE_FILES,
+        help="directory with data.ttl, query.rq and shapes.ttl",
+    )
+    run_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="serve with the shared cache disabled (CACHE_MAX_BYTES=0)",
+    )
+    run_parser.add_argument("--output", type=Path, help="write the results as JSON")
+    run_parser.set_defaults(command=run_command)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("candidate", type=Path)
+    compare_parser.set_defaults(command=compare_command)
+
+    args = parser.parse_args(argv)
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Drive the API with concurrent requests and collect scaling measurements."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from rdflib import BNode, Graph, URIRef
+
+from app import app
+from app.cache import cache
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+API_DIR = Path(__file__).parent.parent
+EXAMPLE_FILES = API_DIR / "example-files"
+# Interval between two samples of the event loop lag, in seconds:
+LAG_INTERVAL = 0.01
+# Default weights of the endpoints in a request mix:
+DEFAULT_MIX = {"sparql": 6, "shacl": 3, "prefixes": 1}
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+# Timeout of a single request, in seconds, generous to measure slow requests:
+REQUEST_TIMEOUT = 300.0
+
+
+def load_corpus(corpus: Path, scale: int) -> dict[str, dict[str, Any]]:
+    """Build a request body for each endpoint from the files in the corpus.
+
+    The data is replicated `scale` times, with renamed subjects, to grow the
+    payload while keeping the shape of the data.
+    """
+    data = Graph().parse(corpus / "data.ttl")
+    scaled = Graph(namespace_manager=data.namespace_manager)
+    subjects = set(data.subjects())
+    for i in range(scale):
+
+        def rename(node: Any, i: int = i) -> Any:  # noqa: ANN401
+            if node in subjects and isinstance(node, URIRef) and i > 0:
+                return URIRef(f"{node}-{i}")
+            if isinstance(node, BNode):
+                return BNode(f"{node}{i}")
+            return node
+
+        for s, p, o in data:
+            scaled.add((rename(s), p, rename(o)))
+    payload = scaled.serialize(format="turtle")
+    return {
+        "sparql": {
+            "data": payload,
+            "query": (corpus / "query.rq").read_text(),
+        },
+        "shacl": {
+            "data": payload,
+            "shapes": (corpus / "shapes.ttl").read_text(),
+        },
+        "prefixes": {},
+    }
+
+
+def distinct(body: dict[str, Any], number: int) -> dict[str, Any]:
+    """Make a request body unique, so that it is neither cached nor coalesced.
+
+    A comment numbering the request is prepended to the data, which changes
+    its hash but not the graph it parses into.
+    """
+    if "data" not in body:
+        return body
+    return {**body, "data": f"# request {number}\n{body['data']}"}
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    """Summarise a list of durations, in milliseconds."""
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def process_stats(pid: int) -> dict[str, float]:
+    """Get the CPU time, in seconds, and resident set size, in MiB, of a process."""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:  # pragma: no cover - process gone, or not on Linux
+        return {"cpu_seconds": 0.0, "rss_mb": 0.0}
+    # The command name may contain spaces, so split after its closing parenthesis:
+    fields = stat.rsplit(")", 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    rss_kb = next(
+        int(line.split()[1]) for line in status.splitlines() if line.startswith("VmRSS")
+    )
+    return {
+        "cpu_seconds": (utime + stime) / CLOCK_TICKS,
+        "rss_mb": round(rss_kb / 1024, 1),
+    }
+
+
+def worker_pids(master: int) -> list[int]:
+    """Get the pids of the uvicorn workers spawned by the master process."""
+    pids = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+            cmdline = (entry / "cmdline").read_bytes()
+        except OSError:  # pragma: no cover - process gone
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        if ppid == master and b"spawn_main" in cmdline:
+            pids.append(int(entry.name))
+    return sorted(pids) or [master]
+
+
+@contextlib.asynccontextmanager
+async def serve(
+    workers: int, *, cached: bool = True
+) -> AsyncIterator[tuple[httpx.AsyncClient, list[int]]]:
+    """Serve the app and yield a client for it and the pids of its workers.
+
+    With 0 workers the app is driven in-process through its ASGI interface.
+    Otherwise it is served by uvicorn with the given number of workers,
+    as in the Dockerfile. Unless `cached`, the shared cache is disabled.
+    """
+    if workers == 0:
+        max_bytes = cache.max_bytes
+        if not cached:
+            cache.max_bytes = 0
+        transport = httpx.ASGITransport(app=app)
+        try:
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test", timeout=REQUEST_TIMEOUT
+            ) as client:
+                yield client, [os.getpid()]
+        finally:
+            cache.max_bytes = max_bytes
+        return
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "app:app",
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+        "--log-level",
+        "warning",
+        cwd=API_DIR,
+        env=os.environ if cached else {**os.environ, "CACHE_MAX_BYTES": "0"},
+    )
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}",
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=None),
+        ) as client:
+            await wait_until_healthy(client, workers)
+            yield client, worker_pids(server.pid)
+    finally:
+        server.terminate()
+        await server.wait()
+
+
+async def wait_until_healthy(client: httpx.AsyncClient, workers: int) -> None:
+    """Wait for the server to answer, and for all workers to have started."""
+    for _ in range(600):
+        with contextlib.suppress(httpx.TransportError):
+            response = await client.get("/health")
+            if response.status_code == httpx.codes.OK:
+                # Give the remaining workers time to import the app:
+                await asyncio.sleep(0.5 * workers)
+                return
+        await asyncio.sleep(0.1)
+    msg = "Server did not become healthy"
+    raise RuntimeError(msg)
+
+
+async def sample_lag(samples: list[float]) -> None:
+    """Sample how late the event loop wakes up after a sleep, until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - start - LAG_INTERVAL))
+
+
+async def probe_lag(client: httpx.AsyncClient, samples: list[float]) -> None:
+    """Sample the latency of /health on the server, until cancelled.
+
+    The health check does no work, so its latency is the time a request waits
+    for a busy event loop in the server.
+    """
+    while True:
+        start = time.perf_counter()
+        await client.get("/health")
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(LAG_INTERVAL)
+
+
+async def run(  # noqa: PLR0913
+    *,
+    workers: int,
+    concurrency: int,
+    duration: float,
+    mix: dict[str, int],
+    corpus: Path = EXAMPLE_FILES,
+    scale: int = 1,
+    seed: int = 0,
+    cached: bool = True,
+) -> dict[str, Any]:
+    """Run one load step and return its measurements.
+
+    Every request sends distinct data, so that the server parses and evaluates
+    each one rather than serving cached or coalesced results.
+    """
+    bodies = load_corpus(corpus, scale)
+    numbers = itertools.count()
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    rng = random.Random(seed)  # noqa: S311 not used for security
+    latencies: dict[str, list[float]] = {endpoint: [] for endpoint in endpoints}
+    errors: dict[str, int] = {}
+    lag: list[float] = []
+
+    async with serve(workers, cached=cached) as (client, pids):
+        before = {pid: process_stats(pid) for pid in pids}
+        peak_rss = {pid: before[pid]["rss_mb"] for pid in pids}
+
+        async def user() -> None:
+            while time.perf_counter() < deadline:
+                endpoint = rng.choices(endpoints, weights)[0]
+                start = time.perf_counter()
+                if endpoint == "prefixes":
+                    response = await client.get("/prefixes")
+                else:
+                    response = await client.post(
+                        f"/{endpoint}", json=distinct(bodies[endpoint], next(numbers))
+                    )
+                if response.status_code == httpx.codes.OK:
+                    latencies[endpoint].append(time.perf_counter() - start)
+                else:
+                    errors[endpoint] = errors.get(endpoint, 0) + 1
+                for pid in pids:
+                    peak_rss[pid] = max(peak_rss[pid], process_stats(pid)["rss_mb"])
+                # The in-process transport never yields to the event loop:
+                await asyncio.sleep(0)
+
+        sampler = asyncio.create_task(
+            sample_lag(lag) if workers == 0 else probe_lag(client, lag)
+        )
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await sampler
+        after = {pid: process_stats(pid) for pid in pids}
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "workers": workers,
+        "concurrency": concurrency,
+        "scale": scale,
+        "mix": mix,
+        "cached": cached,
+        "payload_bytes": len(bodies["sparql"]["data"]),
+        "duration": round(elapsed, 3),
+        "requests": completed,
+        "requests_by_endpoint": {
+            endpoint: len(values) for endpoint, values in latencies.items()
+        },
+        "errors": errors,
+        "throughput": round(completed / elapsed, 2),
+        "latency_ms": percentiles(chain_values(latencies)),
+        "latency_ms_by_endpoint": {
+            endpoint: percentiles(values) for endpoint, values in latencies.items()
+        },
+        "loop_lag_ms": percentiles(lag),
+        "processes": [
+            {
+                "pid": pid,
+                "cpu_seconds": round(
+                    after[pid]["cpu_seconds"] - before[pid]["cpu_seconds"], 2
+                ),
+                "rss_mb": after[pid]["rss_mb"],
+                "peak_rss_mb": max(peak_rss[pid], after[pid]["rss_mb"]),
+            }
+            for pid in pids
+        ],
+    }
+
+
+def chain_values(values: dict[str, list[float]]) -> list[float]:
+    """Flatten the latencies of all endpoints."""
+    return [value for endpoint_values in values.values() for value in endpoint_values]
+
+
+def commit() -> str:
+    """Get the commit of the working tree, to label the results."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            cwd=API_DIR,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    except OSError:  # pragma: no cover - git is not installed
+        return "unknown"
+    return result.stdout.strip() or "unknown"
+
+
+def compare(
+    baseline: dict[str, Any], candidate: dict[str, Any]
+) -> list[dict[str, Any]]:
+    """Match the runs of two result sets and compute their relative differences."""
+
+    def key(run: dict[str, Any]) -> tuple:
+        return (
+            run["workers"],
+            run["concurrency"],
+            run["scale"],
+            tuple(sorted(run["mix"].items())),
+            # Runs from before the flag was recorded had the cache on:
+            run.get("cached", True),
+        )
+
+    baseline_runs = {key(run): run for run in baseline["runs"]}
+    rows = []
+    for run in candidate["runs"]:
+        base = baseline_runs.get(key(run))
+        if base is None:
+            continue
+        rows.append(
+            {
+                "workers": run["workers"],
+                "concurrency": run["concurrency"],
+                "scale": run["scale"],
+                "throughput": (base["throughput"], run["throughput"]),
+                "throughput_change": relative(base["throughput"], run["throughput"]),
+                "p99_ms": (base["latency_ms"]["p99"], run["latency_ms"]["p99"]),
+                "p99_change": relative(
+                    base["latency_ms"]["p99"], run["latency_ms"]["p99"]
+                ),
+            }
+        )
+    return rows
+
+
+def relative(before: float, after: float) -> float | None:
+    """Get the relative change from before to after, in percent."""
+    if before == 0:
+        return None
+    return round((after - before) / before * 100, 1)
@@ -0,0 +1,43 @@
+"""Shared fixtures for the tests."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+from app.cache import cache
+from app.datasets import datasets
+from app.revalidation import validations
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Use an empty cache directory for every test."""
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    monkeypatch.setattr(cache, "directory", directory)
+    monkeypatch.setattr(cache, "size", None)
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def datasets_directory(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Hold no datasets, in an empty directory, for every test."""
+    directory = tmp_path / "datasets"
+    monkeypatch.setattr(datasets, "directory", directory)
+    monkeypatch.setattr(datasets, "held", {})
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def validations_directory(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Hold no incremental validations, in an empty directory, for every test."""
+    directory = tmp_path / "validations"
+    directory.mkdir(mode=0o700)
+    monkeypatch.setattr(validations, "directory", directory)
+    monkeypatch.setattr(validations, "held", type(validations.held)())
+    return directory
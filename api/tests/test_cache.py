@@ -0,0 +1,148 @@
+"""Test module for the shared cache."""
+
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+import pytest
+from rdflib import Graph
+from rdflib.compare import isomorphic
+
+from app.cache import SharedCache, cache_key, private_directory
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_cache_key() -> None:
+    """Should depend on the kind and every part."""
+    assert cache_key("graph", "a", "b") == cache_key("graph", "a", "b")
+    assert cache_key("graph", "a", "b") != cache_key("graph", "ab", "")
+    assert cache_key("graph", "a").startswith("graph-")
+
+
+def test_private_directory(tmp_path: Path) -> None:
+    """Should create the directory for the current user only, or accept it."""
+    directory = private_directory(tmp_path / "shared" / "cache")
+    assert directory.stat().st_mode & 0o777 == 0o700  # noqa: PLR2004
+    assert private_directory(directory) == directory
+
+
+@pytest.mark.parametrize("kind", ["group-writable", "symlink", "file", "other-user"])
+def test_private_directory_is_refused(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, kind: str
+) -> None:
+    """Should refuse a directory that other users may own, write or redirect."""
+    directory = tmp_path / "shared"
+    if kind == "group-writable":
+        directory.mkdir()
+        directory.chmod(0o770)
+    elif kind == "symlink":
+        directory.symlink_to(private_directory(tmp_path / "private"))
+    elif kind == "file":
+        directory.touch()
+    else:
+        private_directory(directory)
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    with pytest.raises((PermissionError, FileExistsError)):
+        SharedCache(directory, max_bytes=1024)
+
+
+def test_get_and_put(tmp_path: Path) -> None:
+    """Should return published entries, and None for missing ones."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=1024)
+    assert cache.get("key") is None
+
+    cache.put("key", b"value")
+
+    assert cache.get("key") == b"value"
+    assert SharedCache(tmp_path / "shared", max_bytes=1024).get("key") == b"value"
+
+
+def test_disabled(tmp_path: Path) -> None:
+    """Should not store anything."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=0)
+
+    cache.put("key", b"value")
+    cache.put_graph("graph", Graph())
+    cache.delete("key")
+
+    assert cache.get("key") is None
+    assert cache.get_graph("graph") is None
+    assert not (tmp_path / "shared").exists()
+
+
+def test_entry_larger_than_cache(tmp_path: Path) -> None:
+    """Should not store the entry."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=4)
+    cache.put("key", b"value")
+    assert cache.get("key") is None
+
+
+def test_evicts_least_recently_used(tmp_path: Path) -> None:
+    """Should evict the entries that were used the longest time ago."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=20)
+    for i, key in enumerate(("a", "b", "c")):
+        cache.put(key, b"123456")
+        os.utime(tmp_path / "shared" / key, (i, i))
+    # Reading "a" makes it the most recently used:
+    assert cache.get("a") == b"123456"
+
+    cache.put("d", b"123456")
+
+    # Evicted down to 90% of the limit:
+    assert cache.get("b") is None
+    assert cache.get("c") == b"123456"
+    assert cache.get("a") == b"123456"
+    assert cache.get("d") == b"123456"
+
+
+def test_scans_only_when_the_estimate_crosses_the_limit(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should estimate the size of the cache, and scan it only when full."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=20)
+    other_worker = SharedCache(tmp_path / "shared", max_bytes=20)
+    other_worker.put("a", b"123456")
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+
+    # The first put scans the cache, and finds the entry of the other worker:
+    cache.put("b", b"123456")
+    assert (len(scans), cache.size) == (1, 12)
+    cache.put("c", b"123456")
+    assert (len(scans), cache.size) == (1, 18)
+
+    cache.put("d", b"123456")
+    assert (len(scans), cache.size) == (2, 18)
+    assert cache.get("a") is None
+
+
+def test_delete(tmp_path: Path) -> None:
+    """Should delete the entries with the prefix."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=1024)
+    cache.put("dataset-1-a", b"a")
+    cache.put("dataset-1-b", b"b")
+    cache.put("dataset-2-a", b"c")
+
+    cache.delete("dataset-1-")
+
+    assert cache.get("dataset-1-a") is None
+    assert cache.get("dataset-1-b") is None
+    assert cache.get("dataset-2-a") == b"c"
+
+
+def test_graphs(tmp_path: Path) -> None:
+    """Should return a copy of the published graph."""
+    cache = SharedCache(tmp_path / "shared", max_bytes=1024 * 1024)
+    graph = Graph().parse(data="<http://example.org#a> a <http://example.org#B> .")
+
+    cache.put_graph("graph", graph)
+
+    cached = cache.get_graph("graph")
+    assert cached is not None
+    assert cached is not graph
+    assert isomorphic(cached, graph)
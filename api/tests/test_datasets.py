@@ -0,0 +1,341 @@
+"""Test module for the datasets held by the server and SPARQL Update."""
+
+from __future__ import annotations
+
+import asyncio
+from http import HTTPStatus
+from typing import TYPE_CHECKING
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib import Graph, Literal, URIRef
+from rdflib.plugins.sparql import prepareUpdate
+
+from app import app
+from app.datasets import Dataset, Datasets, DeltaStore, UpdateError, datasets
+from app.routers import sparql
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+EX = "http://example.org/"
+DATA = f"""
+@prefix ex: <{EX}> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:Alice a ex:Person ; ex:name "Alice" .
+ex:Bob a ex:Person ; ex:name "Bob" .
+ex:Person rdfs:subClassOf ex:Agent .
+"""
+PEOPLE = f"SELECT ?s WHERE {{ ?s a <{EX}Person> }} ORDER BY ?s"
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+@pytest.fixture
+async def client() -> AsyncClient:
+    """Get a client for the app, with a dataset named people."""
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.put("/datasets/people", json={"data": DATA})
+        assert response.status_code == HTTPStatus.OK, response.json()
+        yield ac
+
+
+async def select(client: AsyncClient, query: str, **kwargs: str) -> list[str]:
+    """Run a SELECT query on the people dataset and get the values of its rows."""
+    response = await client.post(
+        "/sparql",
+        headers={"Accept": "text/csv"},
+        json={"dataset": "people", "query": query, **kwargs},
+    )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    return response.json()["result"].split()[1:]
+
+
+async def update(client: AsyncClient, update: str) -> dict:
+    """Run an update on the people dataset and get its result."""
+    response = await client.post(
+        "/sparql/update", json={"dataset": "people", "update": update}
+    )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    return response.json()
+
+
+def test_delta_store_records_net_changes() -> None:
+    """Should record the triples actually added and removed."""
+    store = DeltaStore()
+    graph = Graph(store=store)
+    a, b, c, d = (URIRef(EX + name) for name in "abcd")
+    graph.add((a, b, c))
+    store.reset()
+
+    graph.add((a, b, c))
+    graph.add((a, b, d))
+    graph.remove((a, b, c))
+    graph.add((a, b, c))
+    graph.add((b, b, b))
+    graph.remove((b, b, None))
+    assert store.reset() == ({(a, b, d)}, set())
+
+
+def test_datasets_directory_is_private(tmp_path: Path) -> None:
+    """Should refuse a datasets directory that other users may write to."""
+    directory = tmp_path / "shared"
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(PermissionError):
+        Datasets(directory)
+    directory.chmod(0o700)
+    assert Datasets(directory).directory == directory
+
+
+@pytest.mark.anyio
+async def test_create_get_and_delete_dataset(client: AsyncClient) -> None:
+    """Should hold a dataset until it is deleted."""
+    response = await client.get("/datasets/people")
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert response.json() == {"name": "people", "version": 1, "length": 5}
+
+    response = await client.put("/datasets/people", json={"data": ""})
+    assert response.json() == {"name": "people", "version": 2, "length": 0}
+
+    response = await client.delete("/datasets/people")
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    response = await client.get("/datasets/people")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = await client.delete("/datasets/people")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.anyio
+async def test_create_dataset_with_invalid_input(client: AsyncClient) -> None:
+    """Should return 400 for invalid data, 422 for an invalid name."""
+    response = await client.put("/datasets/other", json={"data": "invalid data"})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    response = await client.put("/datasets/not.valid", json={"data": DATA})
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+    response = await client.put("/datasets/other", content=DATA)
+    assert response.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+
+@pytest.mark.anyio
+async def test_query_dataset(client: AsyncClient) -> None:
+    """Should run queries on the dataset, with inference if requested."""
+    assert await select(client, PEOPLE) == [f"{EX}Alice", f"{EX}Bob"]
+    agents = f"SELECT ?s WHERE {{ ?s a <{EX}Agent> }} ORDER BY ?s"
+    assert await select(client, agents) == []
+    assert await select(client, agents, inference="rdfs") == [
+        f"{EX}Alice",
+        f"{EX}Bob",
+    ]
+    assert await select(client, agents, inference="rewrite") == [
+        f"{EX}Alice",
+        f"{EX}Bob",
+    ]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"query": PEOPLE},
+        {"query": PEOPLE, "data": DATA, "dataset": "people"},
+        {"query": PEOPLE, "dataset": "../people"},
+    ],
+)
+async def test_query_without_a_single_source(
+    client: AsyncClient, body: dict[str, str]
+) -> None:
+    """Should return 422 unless the request holds either data or a dataset."""
+    response = await client.post("/sparql", json=body)
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.anyio
+async def test_query_cost_is_estimated_from_the_latest_version(
+    client: AsyncClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should estimate the cost of a query from the triples of the dataset."""
+    estimated = []
+    estimate_cost = sparql.estimate_cost
+    monkeypatch.setattr(
+        sparql,
+        "estimate_cost",
+        lambda triples, *args: (
+            estimated.append(triples) or estimate_cost(triples, *args)
+        ),
+    )
+    # As on a worker that has not loaded the dataset yet:
+    monkeypatch.setattr(datasets, "held", {})
+    await select(client, PEOPLE)
+    assert estimated == [len(Graph().parse(data=DATA))]
+
+    # Datasets published without the number fall back to the snapshot held:
+    (datasets.directory / "people.length").unlink()
+    dataset = datasets.get("people")
+    assert dataset is not None
+    assert dataset.length() == len(dataset.snapshot()[1])
+
+
+@pytest.mark.anyio
+async def test_query_unknown_dataset(client: AsyncClient) -> None:
+    """Should return 404 Not Found."""
+    response = await client.post("/sparql", json={"dataset": "other", "query": PEOPLE})
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = await client.post(
+        "/sparql/update", json={"dataset": "other", "update": "CLEAR DEFAULT"}
+    )
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.anyio
+async def test_update_dataset(client: AsyncClient) -> None:
+    """Should apply the updates and invalidate the cached results."""
+    assert await select(client, PEOPLE) == [f"{EX}Alice", f"{EX}Bob"]
+
+    result = await update(client, f"INSERT DATA {{ <{EX}Carol> a <{EX}Person> }}")
+    assert result == {
+        "dataset": "people",
+        "version": 2,
+        "added": 1,
+        "removed": 0,
+        "length": 6,
+    }
+    assert await select(client, PEOPLE) == [f"{EX}Alice", f"{EX}Bob", f"{EX}Carol"]
+
+    result = await update(client, f"DELETE DATA {{ <{EX}Bob> a <{EX}Person> }}")
+    assert (result["version"], result["added"], result["removed"]) == (3, 0, 1)
+    assert await select(client, PEOPLE) == [f"{EX}Alice", f"{EX}Carol"]
+
+    result = await update(
+        client,
+        f"""
+        DELETE {{ ?s <{EX}name> ?name }}
+        INSERT {{ ?s <{EX}label> ?name }}
+        WHERE {{ ?s <{EX}name> ?name }}
+        """,
+    )
+    assert (result["version"], result["added"], result["removed"]) == (4, 2, 2)
+
+    result = await update(client, f"DELETE WHERE {{ ?s <{EX}label> ?label }}")
+    assert (result["version"], result["added"], result["removed"]) == (5, 0, 2)
+
+    # An update that changes nothing does not create a version:
+    result = await update(client, f"DELETE WHERE {{ ?s <{EX}label> ?label }}")
+    assert (result["version"], result["added"], result["removed"]) == (5, 0, 0)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    ("update_string", "status_code"),
+    [
+        ("INSERT DATA {", HTTPStatus.BAD_REQUEST),
+        ("LOAD <http://example.org/data.ttl>", HTTPStatus.NOT_IMPLEMENTED),
+        (
+            f"INSERT {{ ?s a <{EX}Agent> }} USING <{EX}g> WHERE {{ ?s a ?o }}",
+            HTTPStatus.NOT_IMPLEMENTED,
+        ),
+        (
+            (
+                f"INSERT DATA {{ <{EX}a> <{EX}b> <{EX}c> }} ; "
+                f"INSERT DATA {{ GRAPH <{EX}g> {{ <{EX}a> <{EX}b> <{EX}d> }} }}"
+            ),
+            HTTPStatus.BAD_REQUEST,
+        ),
+    ],
+)
+async def test_invalid_update(
+    client: AsyncClient, update_string: str, status_code: int
+) -> None:
+    """Should reject the update and leave the dataset unchanged."""
+    response = await client.post(
+        "/sparql/update", json={"dataset": "people", "update": update_string}
+    )
+    assert response.status_code == status_code, response.json()
+    response = await client.get("/datasets/people")
+    assert response.json() == {"name": "people", "version": 1, "length": 5}
+
+
+@pytest.mark.anyio
+async def test_concurrent_updates_are_batched(client: AsyncClient) -> None:
+    """Should commit concurrent updates in one transaction, failed ones apart."""
+    dataset = datasets.get("people")
+    assert dataset is not None
+    _, before = dataset.snapshot()
+    updates = [
+        prepareUpdate(f'INSERT DATA {{ <{EX}Alice> <{EX}age> "{age}" }}')
+        for age in range(5)
+    ]
+    updates.insert(
+        2, prepareUpdate(f"INSERT DATA {{ GRAPH <{EX}g> {{ <{EX}a> <{EX}b> 1 }} }}")
+    )
+    results = await asyncio.gather(
+        *(dataset.update(u) for u in updates), return_exceptions=True
+    )
+    assert isinstance(results.pop(2), UpdateError)
+    assert {result.version for result in results} == {2}
+    assert all(result.added == 1 for result in results)
+    assert results[-1].length == 10  # noqa: PLR2004
+
+    # Readers of the previous snapshot are not affected:
+    assert len(before) == 5  # noqa: PLR2004
+    assert await select(client, f"SELECT ?age WHERE {{ <{EX}Alice> <{EX}age> ?age }}")
+
+
+@pytest.mark.anyio
+async def test_other_workers_read_the_latest_version(client: AsyncClient) -> None:
+    """Should load the snapshot committed by another worker."""
+    other_worker = Dataset("people", datasets.directory)
+    length = len(Graph().parse(data=DATA))
+    # The number of triples is known before the snapshot is loaded:
+    assert other_worker.length() == length
+    version, graph = other_worker.snapshot()
+    assert version == 1
+
+    await update(client, f'INSERT DATA {{ <{EX}Carol> <{EX}name> "Carol" }}')
+    assert other_worker.length() == length + 1
+    version, graph = other_worker.snapshot()
+    assert version == 2  # noqa: PLR2004
+    assert (URIRef(EX + "Carol"), URIRef(EX + "name"), Literal("Carol")) in graph
+    # The closure of the new version is computed anew:
+    _, closure = other_worker.graph("rdfs")
+    assert len(closure) > len(graph)
+    # And shared through the cache:
+    _, cached = other_worker.graph("rdfs")
+    assert len(cached) == len(closure)
+
+    response = await client.delete("/datasets/people")
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    with pytest.raises(KeyError):
+        other_worker.snapshot()
+
+
+@pytest.mark.anyio
+async def test_recreated_dataset_is_not_served_stale(client: AsyncClient) -> None:
+    """Should give a recreated dataset new versions, seen by all workers."""
+    worker = Datasets(datasets.directory)
+    other_worker = Datasets(datasets.directory)
+    worker.create("people", Graph().parse(data=f"<{EX}old> a <{EX}Person> ."))
+    dataset = other_worker.get("people")
+    assert dataset is not None
+    version, graph = dataset.snapshot()
+    assert (URIRef(EX + "old"), None, None) in graph
+
+    response = await client.delete("/datasets/people")
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    assert other_worker.get("people") is None
+    response = await client.put("/datasets/people", json={"data": DATA})
+    assert response.json()["version"] > version
+
+    dataset = other_worker.get("people")
+    assert dataset is not None
+    new_version, graph = dataset.snapshot()
+    assert new_version > version
+    assert (URIRef(EX + "old"), None, None) not in graph
+    assert await select(client, PEOPLE) == [f"{EX}Alice", f"{EX}Bob"]
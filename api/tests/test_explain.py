@@ -0,0 +1,168 @@
+"""Test module for explaining and analyzing SPARQL queries."""
+
+from http import HTTPStatus
+from typing import Any
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib.plugins.sparql import prepareQuery
+
+from app import app
+from app.explain import analysis, describe_plan
+
+EX = "http://example.org/"
+DATA = f"""
+@prefix ex: <{EX}> .
+
+ex:Alice ex:name "Alice" ; ex:knows ex:Bob .
+ex:Bob ex:name "Bob" .
+ex:Carol ex:name "Carol" .
+"""
+QUERY = f"""
+PREFIX ex: <{EX}>
+SELECT ?s (COUNT(?o) AS ?count)
+WHERE {{
+    ?s ex:name ?name .
+    OPTIONAL {{ ?s ex:knows ?o }}
+    FILTER(?name != "Bob")
+}}
+GROUP BY ?s
+ORDER BY ?s
+LIMIT 10
+"""
+NAMES = f"?s <{EX}name> ?name"
+KNOWS = f"?s <{EX}knows> ?o"
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+def flatten(plan: dict[str, Any]) -> list[dict[str, Any]]:
+    """Get the operators of a plan, depth first."""
+    return [plan, *(node for operand in plan["operands"] for node in flatten(operand))]
+
+
+async def explain(explain: str, query: str = QUERY) -> dict[str, Any]:
+    """Explain a query on the data and get the response."""
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            headers={"Accept": "text/csv"},
+            json={"data": DATA, "query": query, "explain": explain},
+        )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    return response.json()
+
+
+def test_describe_plan() -> None:
+    """Should describe every operator of the algebra, without stats."""
+    plan = describe_plan(prepareQuery(QUERY).algebra)
+    assert [(node["operator"], node["detail"]) for node in flatten(plan)] == [
+        ("SelectQuery", None),
+        ("Slice", "offset 0, limit 10"),
+        ("Project", "?s ?count"),
+        ("OrderBy", None),
+        ("Extend", "?count"),
+        ("Extend", "?s"),
+        ("AggregateJoin", None),
+        ("Group", None),
+        ("Filter", "RelationalExpression"),
+        ("LeftJoin", None),
+        ("BGP", NAMES),
+        ("BGP", KNOWS),
+    ]
+    assert all(node["rows"] is None for node in flatten(plan))
+
+
+@pytest.mark.anyio
+async def test_explain_plan() -> None:
+    """Should return the plan of the query, without running it."""
+    response = await explain("plan")
+    assert (response["length"], response["result"]) == (0, "")
+    nodes = flatten(response["plan"])
+    assert [node["operator"] for node in nodes][:3] == [
+        "SelectQuery",
+        "Slice",
+        "Project",
+    ]
+    assert all(node["calls"] is None for node in nodes)
+
+
+@pytest.mark.anyio
+async def test_explain_analyze() -> None:
+    """Should run the query and annotate the operators with rows and times."""
+    response = await explain("analyze")
+    assert response["result"].split() == [
+        "s,count",
+        f"{EX}Alice,1",
+        f"{EX}Carol,0",
+    ]
+    nodes = {
+        (node["operator"], node["detail"]): node for node in flatten(response["plan"])
+    }
+    # The query form returns the result, it produces no solutions:
+    assert nodes["SelectQuery", None]["rows"] is None
+    assert nodes["Slice", "offset 0, limit 10"]["rows"] == 2  # noqa: PLR2004
+    assert nodes["Filter", "RelationalExpression"]["rows"] == 2  # noqa: PLR2004
+    assert nodes["LeftJoin", None]["rows"] == 3  # noqa: PLR2004
+    assert nodes["BGP", NAMES]["rows"] == 3  # noqa: PLR2004
+    # The optional pattern is evaluated once for every name:
+    assert nodes["BGP", KNOWS]["calls"] > 1
+    assert nodes["BGP", KNOWS]["rows"] == 1
+    # The time of an operator includes the time of its operands:
+    assert nodes["LeftJoin", None]["time"] >= nodes["BGP", NAMES]["time"] > 0
+    # The analysis ends with the request:
+    assert analysis.get() is None
+
+
+@pytest.mark.anyio
+async def test_explain_lazy_join_and_values() -> None:
+    """Should describe the candidates of a text FILTER bound before the BGP."""
+    response = await explain(
+        "analyze",
+        f'SELECT ?s WHERE {{ ?s <{EX}name> ?name FILTER(CONTAINS(?name, "aro")) }}',
+    )
+    assert response["length"] == 1
+    nodes = {node["operator"]: node for node in flatten(response["plan"])}
+    assert nodes["Join"]["detail"] == "lazy"
+    assert nodes["values"]["detail"] == "1 rows"
+    assert nodes["BGP"]["calls"] == 1
+    assert nodes["BGP"]["rows"] == 1
+
+
+@pytest.mark.anyio
+async def test_explain_requests_are_not_answered_from_each_other() -> None:
+    """Should cache plans apart from results, and not cache analyses."""
+    plain = await explain("none")
+    assert plain["plan"] is None
+    assert (await explain("plan"))["plan"]["rows"] is None
+    first = await explain("analyze")
+    second = await explain("analyze")
+    assert first["plan"]["operands"][0]["calls"] == 1
+    assert second["plan"]["operands"][0]["calls"] == 1
+    assert first["result"] == second["result"] == plain["result"]
+
+
+@pytest.mark.anyio
+async def test_explain_invalid_mode() -> None:
+    """Should return 422 Unprocessable Entity."""
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql", json={"data": DATA, "query": QUERY, "explain": "verbose"}
+        )
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_describe_filter_on_a_variable() -> None:
+    """Should describe a FILTER by its variable."""
+    plan = describe_plan(prepareQuery("SELECT * WHERE { ?s ?p ?o FILTER(?o) }").algebra)
+    assert ("Filter", "?o") in [
+        (node["operator"], node["detail"]) for node in flatten(plan)
+    ]
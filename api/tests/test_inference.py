@@ -0,0 +1,97 @@
+"""Test module for the inference module."""
+
+from typing import Any
+
+from rdflib import Graph
+from rdflib.paths import Path
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from app.inference import InferenceMode, expand, rewrite_query
+
+DATA = """
+@prefix ex: <http://example.org#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:Person rdfs:subClassOf ex:Agent .
+ex:Agent rdfs:subClassOf ex:Person .
+ex:knows rdfs:subPropertyOf ex:worksWith .
+ex:worksWith rdfs:subPropertyOf ex:knows .
+
+ex:Alice a ex:Person ; ex:knows ex:Bob ; ex:name "Alice" .
+"""
+
+
+def test_expand_lite_with_cyclic_hierarchies() -> None:
+    """Should terminate and entail both directions of a cycle."""
+    graph = Graph().parse(data=DATA)
+    expand(graph, InferenceMode.OWL_RL_LITE)
+    query = """
+    PREFIX ex: <http://example.org#>
+
+    ASK { ex:Alice a ex:Agent ; ex:worksWith ex:Bob }
+    """
+    assert graph.query(query).askAnswer
+
+
+def test_rewrite_query_matches_materialised_closure() -> None:
+    """Should return the same solutions as the materialised closure."""
+    query = """
+    PREFIX ex: <http://example.org#>
+
+    SELECT ?s ?c ?o ?name WHERE { ?s a ?c ; ex:worksWith ?o ; ex:name ?name }
+    """
+    graph = Graph().parse(data=DATA)
+    parsed_query = prepareQuery(query)
+    rewrite_query(parsed_query, graph)
+    rewritten = sorted(graph.query(parsed_query))
+
+    expand(graph, InferenceMode.OWL_RL_LITE)
+    materialised = sorted(graph.query(query))
+
+    assert rewritten == materialised
+
+    paths: list[str] = []
+
+    def collect_paths(part: Any) -> None:
+        if isinstance(part, CompValue) and part.name == "BGP":
+            paths.extend(p.n3() for _, p, _ in part.triples if isinstance(p, Path))
+
+    traverse(parsed_query.algebra, visitPost=collect_paths)
+    assert sorted(paths) == [
+        "<http://example.org#knows>|<http://example.org#worksWith>",
+        (
+            "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+            "/<http://www.w3.org/2000/01/rdf-schema#subClassOf>*"
+        ),
+    ]
+
+
+def test_expand_lite_materialises_transitive_hierarchies() -> None:
+    """Should entail the ancestors of classes and properties, as OWL RL does."""
+    graph = Graph().parse(
+        data="""
+        @prefix ex: <http://example.org#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        ex:A rdfs:subClassOf ex:B .
+        ex:B rdfs:subClassOf ex:C .
+        ex:p rdfs:subPropertyOf ex:q .
+        ex:q rdfs:subPropertyOf ex:r .
+        """
+    )
+    expand(graph, InferenceMode.OWL_RL_LITE)
+    query = """
+    PREFIX ex: <http://example.org#>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+    SELECT ?ancestor WHERE { { ex:A rdfs:subClassOf ?ancestor }
+    UNION { ex:p rdfs:subPropertyOf ?ancestor } }
+    """
+    assert sorted(str(row.ancestor) for row in graph.query(query)) == [
+        "http://example.org#B",
+        "http://example.org#C",
+        "http://example.org#q",
+        "http://example.org#r",
+    ]
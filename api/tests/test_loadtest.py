@@ -0,0 +1,110 @@
+"""Test module for the load-test harness."""
+
+from __future__ import annotations
+
+import json
+from typing import TYPE_CHECKING
+
+import pytest
+
+from app.cache import cache
+from app.routers import sparql
+from loadtest.__main__ import main
+from loadtest.harness import compare, distinct, percentiles, run
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_run_in_process(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should drive every endpoint in the mix and report the measurements."""
+    evaluated = []
+    expand = sparql.expand
+    monkeypatch.setattr(
+        sparql, "expand", lambda *args: evaluated.append(args) or expand(*args)
+    )
+    result = await run(
+        workers=0,
+        concurrency=2,
+        duration=0.5,
+        mix={"sparql": 1, "shacl": 1, "prefixes": 1},
+        scale=2,
+    )
+    assert result["requests"] > 0
+    assert result["errors"] == {}
+    assert result["throughput"] > 0
+    assert set(result["latency_ms_by_endpoint"]) == {"sparql", "shacl", "prefixes"}
+    assert result["loop_lag_ms"]["max"] > 0
+    assert result["processes"][0]["peak_rss_mb"] > 0
+    # Every request is parsed and evaluated, none is served from the cache:
+    assert result["cached"]
+    assert len(evaluated) == result["requests_by_endpoint"]["sparql"] > 1
+
+
+def test_distinct() -> None:
+    """Should change the data of every request, and nothing else."""
+    body = {"data": "<urn:a> <urn:b> <urn:c> .", "query": "ASK {}"}
+    first, second = distinct(body, 1), distinct(body, 2)
+    assert first["data"] != second["data"] != body["data"]
+    assert first["query"] == body["query"]
+    assert distinct({}, 1) == {}
+
+
+def test_compare() -> None:
+    """Should match runs and compute the relative change."""
+    baseline = {
+        "runs": [
+            {
+                "workers": 1,
+                "concurrency": 8,
+                "scale": 1,
+                "mix": {"sparql": 1},
+                "throughput": 100.0,
+                "latency_ms": percentiles([0.1, 0.2]),
+            }
+        ]
+    }
+    candidate = json.loads(json.dumps(baseline))
+    candidate["runs"][0]["throughput"] = 150.0
+    candidate["runs"].append({**candidate["runs"][0], "workers": 2})
+
+    rows = compare(baseline, candidate)
+
+    assert len(rows) == 1
+    assert rows[0]["throughput_change"] == 50.0  # noqa: PLR2004
+    assert rows[0]["p99_change"] == 0.0
+
+
+def test_cli(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    """Should write the results and compare them."""
+    output = tmp_path / "results.json"
+    main(
+        [
+            "run",
+            "--workers",
+            "0",
+            "--concurrency",
+            "1",
+            "--duration",
+            "0.2",
+            "--mix",
+            "prefixes",
+            "--no-cache",
+            "--output",
+            str(output),
+        ]
+    )
+    main(["compare", str(output), str(output)])
+
+    results = json.loads(output.read_text())
+    assert results["runs"][0]["mix"] == {"prefixes": 1}
+    assert not results["runs"][0]["cached"]
+    assert cache.max_bytes > 0
+    assert "throughput_change" in capsys.readouterr().out
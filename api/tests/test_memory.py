@@ -0,0 +1,263 @@
+"""Test module for the memory governance of request graphs."""
+
+from __future__ import annotations
+
+import gc
+import pickle
+from http import HTTPStatus
+from typing import TYPE_CHECKING
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib import RDF, XSD, BNode, Graph, Literal, URIRef
+from rdflib.compare import isomorphic
+
+from app import app, memory
+from app.cache import cache, cache_key
+from app.datasets import datasets
+from app.inference import InferenceMode
+from app.memory import (
+    SpillStore,
+    decode,
+    encode,
+    governed_graph,
+    request_memory,
+    shared_graph,
+    worker_account,
+)
+from app.revalidation import IncrementalValidation
+from app.routers import shacl, sparql
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+EX = "http://example.org/"
+DATA = f"""
+@prefix ex: <{EX}> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:Alice a ex:Person ; ex:name "Alice"@en ; ex:age 42 .
+ex:Bob a ex:Person ; ex:name "Bob" ; ex:knows [ ex:name "Carol" ] .
+ex:Person rdfs:subClassOf ex:Agent .
+"""
+SHAPES = f"""
+@prefix ex: <{EX}> .
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+
+ex:PersonShape a sh:NodeShape ;
+    sh:targetClass ex:Person ;
+    sh:property [ sh:path ex:age ; sh:minCount 1 ] .
+"""
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+@pytest.fixture
+def spill_directory(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Spill graphs of more than three triples per request to a temporary directory."""
+    directory = tmp_path / "spill"
+    directory.mkdir()
+    monkeypatch.setattr(memory, "SPILL_DIR", directory)
+    monkeypatch.setattr(memory, "CHARGE_TRIPLES", 1)
+    monkeypatch.setattr(
+        memory, "MEMORY_REQUEST_BYTES", 3 * memory.MEMORY_BYTES_PER_TRIPLE
+    )
+    return directory
+
+
+@pytest.mark.parametrize(
+    "term",
+    [
+        URIRef(EX + "a"),
+        BNode("b0"),
+        Literal("plain"),
+        Literal("tagged", lang="en-GB"),
+        Literal("42", datatype=XSD.integer),
+        Literal('with "quotes"\nand\0nulls'),
+    ],
+)
+def test_encode_and_decode(term: URIRef | BNode | Literal) -> None:
+    """Should decode a term to an equal term of the same kind."""
+    decoded = decode(encode(term))
+    assert decoded == term
+    assert type(decoded) is type(term)
+
+
+def test_graph_is_spilled_past_the_request_limit(spill_directory: Path) -> None:
+    """Should move the triples to disk and keep serving them from there."""
+    held = worker_account.held
+    with request_memory() as account:
+        graph = governed_graph()
+        graph.parse(data=DATA)
+        assert graph.store.spilled
+        assert account.spilled == 1
+        assert account.peak > account.limit
+    # The memory of the graph is released once spilled:
+    assert worker_account.held == held
+    assert len(graph) == 8  # noqa: PLR2004
+    assert isomorphic(graph, Graph().parse(data=DATA))
+    assert set(graph.objects(URIRef(EX + "Alice"), URIRef(EX + "name"))) == {
+        Literal("Alice", lang="en")
+    }
+    assert set(graph.subjects(RDF.type, URIRef(EX + "Person"))) == {
+        URIRef(EX + "Alice"),
+        URIRef(EX + "Bob"),
+    }
+    assert graph.namespace_manager.store.namespace("ex") == URIRef(EX)
+
+    graph.add((URIRef(EX + "Alice"), RDF.type, URIRef(EX + "Person")))
+    graph.remove((URIRef(EX + "Bob"), None, None))
+    assert len(graph) == 5  # noqa: PLR2004
+
+    # The database is deleted with the graph:
+    assert list(spill_directory.iterdir())
+    del graph
+    gc.collect()
+    assert not list(spill_directory.iterdir())
+
+
+def test_graph_is_spilled_past_the_worker_limit(
+    spill_directory: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should move the triples to disk when the worker is over its limit."""
+    monkeypatch.setattr(worker_account, "limit", worker_account.held)
+    graph = governed_graph()
+    graph.parse(data=DATA)
+    assert graph.store.spilled
+    assert len(list(spill_directory.iterdir())) == 1
+
+
+def test_small_graph_is_held_in_memory(spill_directory: Path) -> None:
+    """Should account for the graph until it is collected."""
+    held = worker_account.held
+    with request_memory() as account:
+        graph = governed_graph()
+        graph.add((URIRef(EX + "a"), RDF.type, URIRef(EX + "b")))
+        graph.remove((None, RDF.type, None))
+        graph.add((URIRef(EX + "a"), RDF.type, URIRef(EX + "c")))
+        assert not graph.store.spilled
+        assert account.held == worker_account.held - held > 0
+
+        # A graph loaded from a pickle is accounted again:
+        copy = pickle.loads(pickle.dumps(graph))  # noqa: S301
+        assert set(copy) == set(graph)
+        assert account.held == 2 * memory.MEMORY_BYTES_PER_TRIPLE
+    del graph, copy
+    gc.collect()
+    assert worker_account.held == held
+    assert not list(spill_directory.iterdir())
+
+
+def test_small_graphs_are_charged() -> None:
+    """Should account for graphs smaller than a batch, once parsed or expanded."""
+    dataset = datasets.create("people", Graph().parse(data=DATA))
+    with request_memory() as account:
+        graphs = [
+            sparql.load_graph(DATA, InferenceMode.NONE),
+            sparql.load_graph(DATA, InferenceMode.RDFS),
+            shacl.load_data_graph(DATA, InferenceMode.OWL_RL_LITE),
+            shacl.parse_graph(SHAPES, ""),
+            dataset.graph(InferenceMode.OWL_RL)[1],
+            IncrementalValidation(
+                Graph().parse(data=DATA),
+                Graph().parse(data=SHAPES),
+                InferenceMode.RDFS,
+            ).data_graph,
+        ]
+        assert len(graphs[0]) < memory.CHARGE_TRIPLES
+        assert all(graph.store.uncharged == 0 for graph in graphs)
+        assert account.held == sum(map(len, graphs)) * memory.MEMORY_BYTES_PER_TRIPLE
+
+
+def test_spilled_graph_is_pickled_by_path(spill_directory: Path) -> None:
+    """Should open the same database, and leave it to the original graph."""
+    with request_memory():
+        graph = governed_graph()
+        graph.parse(data=DATA)
+    copy = pickle.loads(pickle.dumps(graph))  # noqa: S301
+    assert isinstance(copy.store, SpillStore)
+    assert set(copy) == set(graph)
+    del copy
+    gc.collect()
+    assert len(list(spill_directory.iterdir())) == 1
+
+
+def test_shared_graph(spill_directory: Path) -> None:
+    """Should hold the graph on disk, and pickle it by the path of its database."""
+    graph = Graph().parse(data=DATA)
+    shared = shared_graph(graph)
+    assert shared.store.spilled
+    assert shared_graph(shared) is shared
+    assert isomorphic(pickle.loads(pickle.dumps(shared)), graph)  # noqa: S301
+    assert shared.namespace_manager.store.namespace("ex") == URIRef(EX)
+
+    del shared
+    gc.collect()
+    assert not list(spill_directory.iterdir())
+
+
+@pytest.mark.anyio
+@pytest.mark.usefixtures("spill_directory")
+async def test_requests_on_spilled_graphs() -> None:
+    """Should answer queries and validations as on graphs held in memory."""
+    spilled = worker_account.spilled
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            headers={"Accept": "text/csv"},
+            json={
+                "data": DATA,
+                "query": f"SELECT ?s WHERE {{ ?s a <{EX}Agent> }} ORDER BY ?s",
+                "inference": "rdfs",
+            },
+        )
+        assert response.status_code == HTTPStatus.OK, response.json()
+        assert response.json()["result"].split() == [
+            "s",
+            f"{EX}Alice",
+            f"{EX}Bob",
+        ]
+        # Spilled graphs are too large for the cache:
+        assert cache.get(cache_key("graph", DATA, "rdfs")) is None
+
+        response = await ac.post(
+            "/shacl",
+            json={"data": DATA, "shapes": SHAPES, "parallel": True},
+        )
+        assert response.status_code == HTTPStatus.OK, response.json()
+        assert "sh:conforms false" in response.json()["result"]
+
+        response = await ac.get("/status/memory")
+        assert response.status_code == HTTPStatus.OK
+        assert response.json()["spilled"] >= spilled + 2
+        assert response.json()["limit"] == worker_account.limit
+
+
+@pytest.mark.anyio
+@pytest.mark.usefixtures("spill_directory")
+async def test_dataset_graphs_are_accounted() -> None:
+    """Should account for the parsed data and closures of datasets."""
+    spilled = worker_account.spilled
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.put("/datasets/people", json={"data": DATA})
+        assert response.status_code == HTTPStatus.OK, response.json()
+        # The parsed data was spilled, the snapshot is held in memory:
+        assert worker_account.spilled == spilled + 1
+        dataset = datasets.get("people")
+        assert dataset is not None
+        _, graph = dataset.snapshot()
+        assert not isinstance(graph.store, SpillStore)
+        assert isomorphic(graph, Graph().parse(data=DATA))
+
+        with request_memory() as account:
+            _, closure = dataset.graph(InferenceMode.RDFS)
+            assert closure.store.spilled
+            assert account.spilled == 1
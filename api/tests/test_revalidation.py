@@ -0,0 +1,247 @@
+"""Test module for the incremental revalidation module."""
+
+from __future__ import annotations
+
+import pickle
+from typing import TYPE_CHECKING
+
+import pytest
+from pyshacl import validate
+from rdflib import RDF, SH, Graph
+from rdflib.compare import isomorphic
+
+from app import memory
+from app.inference import InferenceMode
+from app.memory import governed_graph
+from app.revalidation import (
+    IncrementalValidation,
+    ValidationStore,
+    path_predicates,
+    validations,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+DATA = """
+@prefix ex: <http://example.org#> .
+
+ex:Alice a ex:Person ; ex:worksFor ex:Acme .
+ex:Bob a ex:Person ; ex:worksFor ex:Acme .
+ex:Calvin a ex:Person .
+ex:Acme ex:name "Acme" .
+"""
+
+SHAPES = """
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix ex: <http://example.org#> .
+
+ex:PersonShape
+    a sh:NodeShape ;
+    sh:targetClass ex:Person ;
+    sh:property [
+        sh:path ex:worksFor ;
+        sh:minCount 1 ;
+        sh:node ex:CompanyShape ;
+    ] ;
+    sh:property [
+        sh:path [ sh:inversePath ex:manages ] ;
+        sh:maxCount 1 ;
+    ] .
+
+ex:CompanyShape
+    a sh:NodeShape ;
+    sh:property [
+        sh:path ex:name ;
+        sh:minCount 1 ;
+    ] .
+"""
+
+
+def parse(data: str) -> Graph:
+    """Parse turtle with the example prefix."""
+    return Graph().parse(data="@prefix ex: <http://example.org#> .\n" + data)
+
+
+def focus_nodes_of(results: Graph) -> set[str]:
+    """Get the focus nodes of the top-level results in a graph."""
+    return {
+        str(results.value(result, SH.focusNode))
+        for result in results.subjects(RDF.type, SH.ValidationResult)
+        if (None, SH.detail, result) not in results
+    }
+
+
+def assert_same_as_full_validation(validation: IncrementalValidation) -> None:
+    """Assert that the report equals the one of a full validation."""
+    conforms, expected, _ = validate(
+        data_graph=validation.data_graph, shacl_graph=validation.shapes_graph
+    )
+    assert validation.conforms == conforms
+    assert isomorphic(validation.report(), expected)
+
+
+def test_initial_report_is_identical_to_full_validation() -> None:
+    """Should return the same report as a full validation."""
+    validation = IncrementalValidation(
+        Graph().parse(data=DATA), Graph().parse(data=SHAPES), InferenceMode.NONE
+    )
+    assert not validation.conforms
+    assert_same_as_full_validation(validation)
+
+
+def test_delta_revalidates_nested_shapes() -> None:
+    """Should follow sh:node dependencies and report the difference."""
+    validation = IncrementalValidation(
+        Graph().parse(data=DATA), Graph().parse(data=SHAPES), InferenceMode.NONE
+    )
+
+    added, removed = validation.apply(
+        parse("ex:Calvin ex:worksFor ex:Acme ."), parse('ex:Acme ex:name "Acme" .')
+    )
+
+    assert_same_as_full_validation(validation)
+    # Alice, Bob and Calvin now work for a company without a name:
+    assert focus_nodes_of(added) == {
+        "http://example.org#Alice",
+        "http://example.org#Bob",
+        "http://example.org#Calvin",
+    }
+    # Calvin no longer lacks an employer:
+    assert focus_nodes_of(removed) == {"http://example.org#Calvin"}
+
+
+def test_delta_revalidates_inverse_paths() -> None:
+    """Should revalidate the objects of triples with inverse path predicates."""
+    validation = IncrementalValidation(
+        Graph().parse(data=DATA), Graph().parse(data=SHAPES), InferenceMode.NONE
+    )
+
+    added, removed = validation.apply(
+        parse("ex:Bob ex:manages ex:Alice . ex:Calvin ex:manages ex:Alice ."),
+        Graph(),
+    )
+
+    assert_same_as_full_validation(validation)
+    assert focus_nodes_of(added) == {"http://example.org#Alice"}
+    assert len(removed) == 0
+
+
+def test_delta_revalidates_targeted_objects() -> None:
+    """Should revalidate the objects of triples with sh:targetObjectsOf predicates."""
+    shapes = """
+    @prefix sh: <http://www.w3.org/ns/shacl#> .
+    @prefix ex: <http://example.org#> .
+
+    ex:KnownShape
+        a sh:NodeShape ;
+        sh:targetObjectsOf ex:knows ;
+        sh:property [ sh:path ex:name ; sh:minCount 1 ] .
+    """
+    validation = IncrementalValidation(
+        Graph().parse(data=DATA), Graph().parse(data=shapes), InferenceMode.NONE
+    )
+    assert validation.conforms
+
+    added, _ = validation.apply(parse("ex:A ex:knows ex:B ."), Graph())
+
+    assert not validation.conforms
+    assert_same_as_full_validation(validation)
+    assert focus_nodes_of(added) == {"http://example.org#B"}
+
+    _, removed = validation.apply(Graph(), parse("ex:A ex:knows ex:B ."))
+
+    assert validation.conforms
+    assert focus_nodes_of(removed) == {"http://example.org#B"}
+
+
+def test_delta_with_subclasses_and_inference() -> None:
+    """Should revalidate everything when the class hierarchy changes."""
+    validation = IncrementalValidation(
+        Graph().parse(data=DATA), Graph().parse(data=SHAPES), InferenceMode.RDFS
+    )
+
+    validation.apply(
+        parse(
+            "@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> ."
+            "ex:Employee rdfs:subClassOf ex:Person . ex:Dave a ex:Employee ."
+        ),
+        Graph(),
+    )
+
+    assert_same_as_full_validation(validation)
+    focus_nodes = {str(node) for node in validation.results}
+    assert "http://example.org#Dave" in focus_nodes
+
+
+def test_path_predicates() -> None:
+    """Should find the predicates of complex paths."""
+    shapes = """
+    @prefix sh: <http://www.w3.org/ns/shacl#> .
+    @prefix ex: <http://example.org#> .
+
+    ex:Shape sh:property [
+        sh:path ( ex:a [ sh:alternativePath ( ex:b [ sh:inversePath ex:c ] ) ] ) ;
+    ] , [
+        sh:path [ sh:zeroOrMorePath [ sh:inversePath ex:d ] ] ;
+    ] .
+    """
+    forward, inverse = path_predicates(Graph().parse(data=shapes))
+    assert {str(p) for p in forward} == {"http://example.org#a", "http://example.org#b"}
+    assert {str(p) for p in inverse} == {"http://example.org#c", "http://example.org#d"}
+
+
+def test_validations_are_shared_by_workers() -> None:
+    """Should apply the deltas of a validation in any worker, in order."""
+    worker = ValidationStore(validations.directory, max_validations=2)
+    other_worker = ValidationStore(validations.directory, max_validations=2)
+    validation_id = worker.create(
+        IncrementalValidation(
+            Graph().parse(data=DATA), Graph().parse(data=SHAPES), InferenceMode.NONE
+        )
+    )
+
+    report, added, _ = other_worker.apply(
+        validation_id, Graph(), parse('ex:Acme ex:name "Acme" .')
+    )
+    assert focus_nodes_of(added) == {
+        "http://example.org#Alice",
+        "http://example.org#Bob",
+    }
+    # The first worker reads the delta applied by the other one:
+    report, _, removed = worker.apply(
+        validation_id, parse('ex:Acme ex:name "Acme" .'), Graph()
+    )
+    assert focus_nodes_of(removed) == {
+        "http://example.org#Alice",
+        "http://example.org#Bob",
+    }
+    assert focus_nodes_of(report) == {"http://example.org#Calvin"}
+
+    # The least recently changed validations are deleted beyond the limit:
+    for _ in range(2):
+        other_worker.create(IncrementalValidation(Graph(), Graph(), InferenceMode.NONE))
+    for store in (worker, other_worker):
+        with pytest.raises(KeyError):
+            store.apply(validation_id, Graph(), Graph())
+    with pytest.raises(KeyError):
+        worker.apply("../escape", Graph(), Graph())
+
+
+def test_spilled_validation_is_pickled_by_value(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should copy spilled graphs into the pickle, keeping the closure apart."""
+    monkeypatch.setattr(memory, "SPILL_DIR", tmp_path)
+    data_graph = governed_graph()
+    data_graph.parse(data=DATA)
+    data_graph.store.spill()
+    for inference in (InferenceMode.NONE, InferenceMode.RDFS):
+        validation = IncrementalValidation(
+            data_graph, Graph().parse(data=SHAPES), inference
+        )
+        copy = pickle.loads(pickle.dumps(validation))  # noqa: S301
+        assert not isinstance(copy.asserted.store, memory.SpillStore)
+        assert (copy.data_graph is copy.asserted) == (inference == InferenceMode.NONE)
+        copy.apply(parse("ex:Calvin ex:worksFor ex:Acme ."), Graph())
+        assert_same_as_full_validation(copy)
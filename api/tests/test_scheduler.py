@@ -0,0 +1,283 @@
+"""Test module for cost-aware admission control."""
+
+import asyncio
+from http import HTTPStatus
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib.plugins.sparql import prepareQuery
+from starlette.requests import Request
+
+from app import app
+from app.inference import InferenceMode
+from app.scheduler import (
+    CHEAP_COST,
+    HEAVY_COST,
+    Overloaded,
+    Priority,
+    Scheduler,
+    classify,
+    client_of,
+    estimate_cost,
+    estimate_triples,
+    query_factor,
+    scheduler,
+)
+
+CHEAP = 1
+STANDARD = CHEAP_COST
+HEAVY = HEAVY_COST
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+async def hold(
+    scheduler: Scheduler,
+    client: str,
+    cost: float,
+    order: list[str],
+    release: asyncio.Event,
+) -> None:
+    """Hold a slot until released, recording when the slot was granted."""
+    async with scheduler.admit(client, cost):
+        order.append(client)
+        await release.wait()
+
+
+async def grant_order(
+    scheduler: Scheduler, jobs: list[tuple[str, float]], *, before: float = 0.0
+) -> list[str]:
+    """Queue jobs behind a running one and get the order they are granted in.
+
+    `before` backdates the jobs of the heavy class by this many seconds.
+    """
+    blocker = asyncio.Event()
+    order: list[str] = []
+    done = asyncio.Event()
+    done.set()
+    running = asyncio.ensure_future(hold(scheduler, "blocker", CHEAP, [], blocker))
+    await asyncio.sleep(0)
+    waiting = []
+    for client, cost in jobs:
+        waiting.append(
+            asyncio.ensure_future(hold(scheduler, client, cost, order, done))
+        )
+        await asyncio.sleep(0)
+    for jobs_of_client in scheduler.queues[Priority.HEAVY].values():
+        for job in jobs_of_client:
+            job.enqueued -= before
+    blocker.set()
+    await asyncio.gather(running, *waiting)
+    return order
+
+
+def test_estimate_cost() -> None:
+    """Should weigh the size of the data, the inference mode and the query."""
+    assert estimate_triples("") == 1
+    assert estimate_triples("<a> <b> <c> .\n<a> <b> <d> .\n") == 2  # noqa: PLR2004
+    assert estimate_triples("x" * 1000) == 10  # noqa: PLR2004
+    triples = estimate_triples("<a> <b> <c> .\n" * 100)
+    assert estimate_cost(triples, InferenceMode.NONE) == 100  # noqa: PLR2004
+    assert (
+        estimate_cost(triples, InferenceMode.NONE)
+        < estimate_cost(triples, InferenceMode.OWL_RL_LITE)
+        < estimate_cost(triples, InferenceMode.RDFS)
+        < estimate_cost(triples, InferenceMode.OWL_RL)
+    )
+
+
+def test_query_factor() -> None:
+    """Should weigh the triple patterns, property paths and operators."""
+    simple = prepareQuery("SELECT * WHERE { ?s ?p ?o }").algebra
+    joined = prepareQuery(
+        "SELECT * WHERE { ?s ?p ?o . ?o ?q ?r OPTIONAL { ?r ?x ?y } }"
+    ).algebra
+    path = prepareQuery(
+        "PREFIX ex: <http://example.org/> SELECT * WHERE { ?s ex:p+ ?o }"
+    ).algebra
+    assert query_factor(simple) == 2.0  # noqa: PLR2004
+    assert query_factor(joined) > query_factor(simple)
+    assert query_factor(path) > query_factor(simple)
+
+
+def test_classify() -> None:
+    """Should put jobs in the priority class of their cost."""
+    assert classify(CHEAP) == Priority.CHEAP
+    assert classify(STANDARD) == Priority.STANDARD
+    assert classify(HEAVY) == Priority.HEAVY
+
+
+def test_client_of() -> None:
+    """Should identify clients by header, or else by address."""
+
+    def request(headers: list[tuple[bytes, bytes]], client: object) -> Request:
+        return Request(
+            {"type": "http", "headers": headers, "client": client, "method": "GET"}
+        )
+
+    assert client_of(request([(b"x-client-id", b"dashboard")], ("10.0.0.1", 1))) == (
+        "dashboard"
+    )
+    assert client_of(request([], ("10.0.0.1", 1))) == "10.0.0.1"
+    assert client_of(request([], None)) == "unknown"
+
+
+@pytest.mark.anyio
+async def test_cheap_jobs_go_first() -> None:
+    """Should grant slots to cheaper classes first."""
+    order = await grant_order(
+        Scheduler(slots=1), [("heavy", HEAVY), ("standard", STANDARD), ("cheap", CHEAP)]
+    )
+    assert order == ["cheap", "standard", "heavy"]
+
+
+@pytest.mark.anyio
+async def test_waiting_jobs_are_not_starved() -> None:
+    """Should raise the priority of jobs that have waited for long."""
+    order = await grant_order(
+        Scheduler(slots=1), [("cheap", CHEAP), ("heavy", HEAVY)], before=60.0
+    )
+    assert order == ["heavy", "cheap"]
+
+
+@pytest.mark.anyio
+async def test_clients_take_turns() -> None:
+    """Should alternate between the clients of a class."""
+    order = await grant_order(
+        Scheduler(slots=1), [("a", CHEAP), ("a", CHEAP), ("a", CHEAP), ("b", CHEAP)]
+    )
+    assert order == ["a", "b", "a", "a"]
+
+
+@pytest.mark.anyio
+async def test_concurrency_limits() -> None:
+    """Should limit the running jobs per client and of the heavy class."""
+    limited = Scheduler(slots=3, heavy_slots=1, client_slots=1)
+    release = asyncio.Event()
+    order: list[str] = []
+    jobs = [
+        asyncio.ensure_future(hold(limited, client, cost, order, release))
+        for client, cost in [("a", HEAVY), ("a", CHEAP), ("b", HEAVY), ("c", CHEAP)]
+    ]
+    await asyncio.sleep(0.01)
+    assert order == ["a", "c"]
+    assert limited.stats()["heavy"]["running"] == 1
+    assert limited.stats()["heavy"]["queued"] == 1
+    release.set()
+    await asyncio.gather(*jobs)
+    assert sorted(order) == ["a", "a", "b", "c"]
+    assert limited.stats()["heavy"]["admitted"] == 2  # noqa: PLR2004
+    assert sum(limited.running.values()) == 0
+    # Idle clients are forgotten:
+    assert not limited.client_running
+
+
+@pytest.mark.anyio
+async def test_idle_clients_are_forgotten() -> None:
+    """Should count the running jobs of a client until they all finish."""
+    scheduler = Scheduler(slots=2, client_slots=2)
+    first, second = asyncio.Event(), asyncio.Event()
+    jobs = [
+        asyncio.ensure_future(hold(scheduler, "a", CHEAP, [], release))
+        for release in (first, second)
+    ]
+    await asyncio.sleep(0.01)
+    first.set()
+    await jobs[0]
+    assert scheduler.client_running == {"a": 1}
+    second.set()
+    await jobs[1]
+    assert not scheduler.client_running
+
+
+@pytest.mark.anyio
+async def test_full_queue_is_rejected() -> None:
+    """Should reject jobs with a retry delay when the queue of their class is full."""
+    limited = Scheduler(slots=1, max_queued=1)
+    release = asyncio.Event()
+    jobs = [
+        asyncio.ensure_future(hold(limited, "a", CHEAP, [], release)) for _ in range(2)
+    ]
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded) as exc_info:
+        async with limited.admit("b", CHEAP):
+            pass  # pragma: no cover
+    assert exc_info.value.priority == Priority.CHEAP
+    assert exc_info.value.retry_after >= 1
+    assert limited.stats()["cheap"]["rejected"] == 1
+    release.set()
+    await asyncio.gather(*jobs)
+
+
+@pytest.mark.anyio
+async def test_cancelled_jobs_leave_the_queue() -> None:
+    """Should forget queued jobs, and free granted slots, of cancelled requests."""
+    limited = Scheduler(slots=1)
+    release = asyncio.Event()
+    running = asyncio.ensure_future(hold(limited, "a", CHEAP, [], release))
+    await asyncio.sleep(0)
+    queued = asyncio.ensure_future(hold(limited, "b", CHEAP, [], release))
+    await asyncio.sleep(0)
+    assert limited.queued(Priority.CHEAP) == 1
+    queued.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+    assert limited.queued(Priority.CHEAP) == 0
+
+    release.set()
+    await running
+
+    # Cancelled after its slot was granted, but before it could take it:
+    slot = limited.admit("a", CHEAP)
+    await slot.__aenter__()
+    granted = asyncio.ensure_future(hold(limited, "c", CHEAP, [], release))
+    await asyncio.sleep(0)
+    await slot.__aexit__(None, None, None)
+    granted.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await granted
+    assert sum(limited.running.values()) == 0
+
+
+@pytest.mark.anyio
+async def test_overloaded_request_gets_429(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should return 429 Too Many Requests with a Retry-After header."""
+    monkeypatch.setattr(scheduler, "max_queued", 0)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            json={
+                "data": "<http://example.org/s> <http://example.org/p> 1 .",
+                "query": "SELECT * WHERE { ?s ?p ?o }",
+            },
+        )
+        status = await ac.get("/status/admission")
+    assert response.status_code == HTTPStatus.TOO_MANY_REQUESTS, response.json()
+    assert int(response.headers["retry-after"]) >= 1
+    assert status.status_code == HTTPStatus.OK, status.json()
+    assert set(status.json()) == {"cheap", "standard", "heavy"}
+    assert status.json()["cheap"]["rejected"] >= 1
+
+
+@pytest.mark.anyio
+async def test_admitted_requests_are_counted() -> None:
+    """Should count the validations admitted in their priority class."""
+    admitted = scheduler.admitted[Priority.CHEAP]
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/shacl",
+            json={
+                "data": "<http://example.org/s> <http://example.org/p> 1 .",
+                "shapes": "",
+            },
+        )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert scheduler.admitted[Priority.CHEAP] == admitted + 1
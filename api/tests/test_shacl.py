@@ -1,11 +1,19 @@
 """Test module for api."""
 
 from http import HTTPStatus
+from pathlib import Path
 
 import pytest
 from httpx import ASGITransport, AsyncClient
+from rdflib import Graph
+from rdflib.compare import isomorphic
 
 from app import app
+from app.cache import cache, cache_key
+from app.revalidation import validations
+from app.scheduler import scheduler
+
+EXAMPLE_FILES = Path(__file__).parent.parent / "example-files"
 
 
 @pytest.fixture
@@ -193,3 +201,150 @@ async def test_shacl_with_unsupported_content_type() -> None:
             "/shacl", headers=headers, json={"shapes": shapes, "data": data}
         )
     assert response.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE, response.json()
+
+
+@pytest.mark.anyio
+async def test_shacl_in_parallel(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should return 200 OK and the same report as a sequential validation."""
+    monkeypatch.setattr(cache, "max_bytes", 0)
+    with (EXAMPLE_FILES / "data.ttl").open() as f:
+        data = f.read()
+    with (EXAMPLE_FILES / "shapes.ttl").open() as f:
+        shapes = f.read()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        sequential = await ac.post("/shacl", json={"shapes": shapes, "data": data})
+        parallel = await ac.post(
+            "/shacl", json={"shapes": shapes, "data": data, "parallel": True}
+        )
+    assert parallel.status_code == HTTPStatus.OK, parallel.json()
+    assert isomorphic(
+        Graph().parse(data=parallel.json()["result"]),
+        Graph().parse(data=sequential.json()["result"]),
+    )
+
+
+@pytest.mark.anyio
+async def test_shacl_incremental_validation(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should revalidate a delta and return the updated report and a diff."""
+    monkeypatch.setattr(validations, "max_validations", 1)
+    with (EXAMPLE_FILES / "data.ttl").open() as f:
+        data = f.read()
+    with (EXAMPLE_FILES / "shapes.ttl").open() as f:
+        shapes = f.read()
+    delta = {
+        "added": '<http://example.org#Alice> <http://example.org#ssn> "987-65-4321".',
+        "removed": '<http://example.org#Alice> <http://example.org#ssn> "987-65-432A".',
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        other = await ac.post(
+            "/shacl/validations", json={"shapes": shapes, "data": "", "inference": True}
+        )
+        created = await ac.post(
+            "/shacl/validations", json={"shapes": shapes, "data": data}
+        )
+        evicted = await ac.post(
+            f"/shacl/validations/{other.json()['id']}/delta", json=delta
+        )
+        response = await ac.post(
+            f"/shacl/validations/{created.json()['id']}/delta", json=delta
+        )
+    assert created.status_code == HTTPStatus.OK, created.json()
+    assert evicted.status_code == HTTPStatus.NOT_FOUND, evicted.json()
+    assert response.status_code == HTTPStatus.OK, response.json()
+    result = response.json()
+    assert result["id"] == created.json()["id"]
+    assert len(Graph().parse(data=result["added_results"])) == 0
+    assert len(Graph().parse(data=result["removed_results"])) > 0
+    assert len(Graph().parse(data=result["result"])) < len(
+        Graph().parse(data=created.json()["result"])
+    )
+
+
+@pytest.mark.anyio
+async def test_shacl_incremental_validations_do_not_share_state() -> None:
+    """Should give identical validations their own ids and state."""
+    admitted = scheduler.admitted.total()
+    with (EXAMPLE_FILES / "shapes.ttl").open() as f:
+        shapes = f.read()
+    with (EXAMPLE_FILES / "data.ttl").open() as f:
+        data = f.read()
+    delta = {
+        "removed": '<http://example.org#Alice> <http://example.org#ssn> "987-65-432A".'
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.post(
+            "/shacl/validations", json={"shapes": shapes, "data": data}
+        )
+        second = await ac.post(
+            "/shacl/validations", json={"shapes": shapes, "data": data}
+        )
+        assert first.json()["id"] != second.json()["id"]
+        changed = await ac.post(
+            f"/shacl/validations/{first.json()['id']}/delta", json=delta
+        )
+        unchanged = await ac.post(
+            f"/shacl/validations/{second.json()['id']}/delta", json={}
+        )
+    assert changed.json()["result"] != second.json()["result"]
+    assert unchanged.json()["result"] == second.json()["result"]
+    # Validations and deltas are admitted by the scheduler:
+    assert scheduler.admitted.total() == admitted + 4
+
+
+@pytest.mark.anyio
+async def test_shacl_incremental_validation_with_invalid_delta() -> None:
+    """Should return 400 Bad Request."""
+    with (EXAMPLE_FILES / "shapes.ttl").open() as f:
+        shapes = f.read()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        created = await ac.post(
+            "/shacl/validations", json={"shapes": shapes, "data": ""}
+        )
+        response = await ac.post(
+            f"/shacl/validations/{created.json()['id']}/delta",
+            json={"added": "invalid_data"},
+        )
+    assert response.status_code == HTTPStatus.BAD_REQUEST, response.json()
+
+
+@pytest.mark.anyio
+async def test_shacl_uses_cached_graphs_and_results() -> None:
+    """Should return the same result from the shared cache."""
+    with (EXAMPLE_FILES / "data.ttl").open() as f:
+        data = f.read()
+    with (EXAMPLE_FILES / "shapes.ttl").open() as f:
+        shapes = f.read()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.post(
+            "/shacl", json={"shapes": shapes, "data": data, "inference": "rewrite"}
+        )
+        cached = await ac.post(
+            "/shacl", json={"shapes": shapes, "data": data, "inference": "rewrite"}
+        )
+        other_shapes = await ac.post(
+            "/shacl", json={"shapes": shapes + "\n", "data": data}
+        )
+    assert first.status_code == HTTPStatus.OK, first.json()
+    assert cached.json() == first.json()
+    assert isomorphic(
+        Graph().parse(data=other_shapes.json()["result"]),
+        Graph().parse(data=first.json()["result"]),
+    )
+    # The rewrite mode shares the parsed graph without inference:
+    assert cache.get(cache_key("graph", data, "none")) is not None
+    assert cache.get(cache_key("graph", data, "rewrite")) is None
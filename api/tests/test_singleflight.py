@@ -0,0 +1,162 @@
+"""Test module for the coalescing of identical requests in flight."""
+
+import asyncio
+import threading
+from http import HTTPStatus
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app import app
+from app.routers import sparql
+from app.singleflight import SingleFlight, flights
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+async def wait_for_waiters(single_flight: SingleFlight, waiters: int) -> None:
+    """Wait until the given number of requests wait on a computation."""
+    while single_flight.stats()["waiters"] < waiters:  # noqa: ASYNC110
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_identical_requests_share_a_computation() -> None:
+    """Should run the computation once and share its result with all waiters."""
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute() -> list[int]:
+        calls.append(1)
+        release.wait(timeout=10)
+        return [1, 2, 3]
+
+    tasks = [asyncio.ensure_future(single_flight.do("key", compute)) for _ in range(5)]
+    await wait_for_waiters(single_flight, 5)
+    stats = single_flight.stats()
+    assert stats["in_flight"] == 1
+    assert stats["flights"] == {"key": 5}
+    assert stats["started"] == 1
+    assert stats["coalesced"] == 4  # noqa: PLR2004
+
+    release.set()
+    results = await asyncio.gather(*tasks)
+    assert results == [[1, 2, 3]] * 5
+    assert len(calls) == 1
+    assert single_flight.stats()["in_flight"] == 0
+
+    # A later request starts a new computation:
+    assert await single_flight.do("key", compute) == [1, 2, 3]
+    assert single_flight.stats()["started"] == 2  # noqa: PLR2004
+
+
+@pytest.mark.anyio
+async def test_different_keys_do_not_share_a_computation() -> None:
+    """Should run one computation per key."""
+    single_flight = SingleFlight()
+    results = await asyncio.gather(
+        single_flight.do("a", lambda: "a"), single_flight.do("b", lambda: "b")
+    )
+    assert results == ["a", "b"]
+    assert single_flight.stats()["started"] == 2  # noqa: PLR2004
+    assert single_flight.stats()["coalesced"] == 0
+
+
+@pytest.mark.anyio
+async def test_errors_are_shared() -> None:
+    """Should raise the error of the computation in every waiter."""
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def compute() -> None:
+        release.wait(timeout=10)
+        msg = "boom"
+        raise ValueError(msg)
+
+    tasks = [asyncio.ensure_future(single_flight.do("key", compute)) for _ in range(3)]
+    await wait_for_waiters(single_flight, 3)
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.anyio
+async def test_cancelled_waiter_does_not_cancel_the_computation() -> None:
+    """Should keep computing for the other waiters when one of them goes away."""
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def compute() -> str:
+        release.wait(timeout=10)
+        return "done"
+
+    first = asyncio.ensure_future(single_flight.do("key", compute))
+    second = asyncio.ensure_future(single_flight.do("key", compute))
+    await wait_for_waiters(single_flight, 2)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert single_flight.stats()["flights"] == {"key": 1}
+    release.set()
+    assert await second == "done"
+
+
+@pytest.mark.anyio
+async def test_cancelled_computation_is_forgotten() -> None:
+    """Should forget a computation that was cancelled."""
+    single_flight = SingleFlight()
+    release = threading.Event()
+    waiter = asyncio.ensure_future(
+        single_flight.do("key", lambda: release.wait(timeout=10))
+    )
+    await wait_for_waiters(single_flight, 1)
+    single_flight.flights["key"].task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    release.set()
+    assert single_flight.stats()["in_flight"] == 0
+
+
+@pytest.mark.anyio
+async def test_identical_sparql_requests_are_coalesced(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Should evaluate identical concurrent queries once and report the waiters."""
+    release = threading.Event()
+    load_graph = sparql.load_graph
+    loads = []
+
+    def blocking_load_graph(*args: object) -> object:
+        loads.append(1)
+        release.wait(timeout=10)
+        return load_graph(*args)  # type: ignore[invalid-argument-type]
+
+    monkeypatch.setattr(sparql, "load_graph", blocking_load_graph)
+    body = {
+        "data": "<http://example.org/s> <http://example.org/p> 1 .",
+        "query": "SELECT * WHERE { ?s ?p ?o }",
+    }
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        requests = [
+            asyncio.ensure_future(ac.post("/sparql", json=body)) for _ in range(4)
+        ]
+        await wait_for_waiters(flights, 4)
+        response = await ac.get("/status/flights")
+        assert response.status_code == HTTPStatus.OK, response.json()
+        stats = response.json()
+        assert stats["in_flight"] == 1
+        assert stats["waiters"] == 4  # noqa: PLR2004
+        assert list(stats["flights"].values()) == [4]
+        release.set()
+        responses = await asyncio.gather(*requests)
+
+    assert len(loads) == 1
+    assert all(response.status_code == HTTPStatus.OK for response in responses)
+    assert len({response.text for response in responses}) == 1
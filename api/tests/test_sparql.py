@@ -6,6 +6,7 @@ import pytest
 from httpx import ASGITransport, AsyncClient
 
 from app import app
+from app.routers import sparql
 
 
 @pytest.fixture
@@ -336,3 +337,136 @@ async def test_json_ld_without_prefixes() -> None:
         assert data["result_content_type"] == "text/turtle"
     else:
         assert data["result_content_type"] == headers["Accept"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    ("inference", "expected"),
+    [
+        ("none", ["http://example.org#Alice"]),
+        ("rdfs", ["http://example.org#Alice", "http://example.org#Bob"]),
+        ("owl-rl-lite", ["http://example.org#Alice", "http://example.org#Bob"]),
+        ("owl-rl", ["http://example.org#Alice", "http://example.org#Bob"]),
+        ("rewrite", ["http://example.org#Alice", "http://example.org#Bob"]),
+    ],
+)
+async def test_select_query_with_inference_mode(
+    inference: str, expected: list[str]
+) -> None:
+    """Should return 200 OK and the instances entailed by the inference mode."""
+    query = """
+    PREFIX ex: <http://example.org#>
+
+    SELECT ?s WHERE { ?s a ex:Agent } ORDER BY ?s
+    """
+    data = """
+    @prefix ex: <http://example.org#> .
+    @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+    ex:Agent a rdfs:Class .
+    ex:Person rdfs:subClassOf ex:Agent .
+    ex:Employee rdfs:subClassOf ex:Person .
+
+    ex:Alice a ex:Agent .
+    ex:Bob a ex:Employee, ex:Person .
+	"""
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            headers={"Accept": "text/csv"},
+            json={"query": query, "data": data, "inference": inference},
+        )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    data = response.json()
+    assert data["result"].split()[1:] == expected
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("inference", ["owl-rl-lite", "rewrite"])
+async def test_select_query_with_subproperties_domain_and_range(
+    inference: str,
+) -> None:
+    """Should return 200 OK and the triples entailed by subproperties."""
+    query = """
+    PREFIX ex: <http://example.org#>
+
+    SELECT ?s ?o WHERE { ?s ex:knows ?o } ORDER BY ?s ?o
+    """
+    data = """
+    @prefix ex: <http://example.org#> .
+    @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+    ex:worksWith rdfs:subPropertyOf ex:knows ;
+        rdfs:domain ex:Employee ;
+        rdfs:range ex:Employee .
+    ex:manages rdfs:subPropertyOf ex:worksWith .
+
+    ex:Alice ex:manages ex:Bob ; ex:worksWith ex:Bob .
+    ex:Bob ex:knows ex:Calvin ; ex:name "Bob" .
+	"""
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            headers={"Accept": "text/csv"},
+            json={"query": query, "data": data, "inference": inference},
+        )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    data = response.json()
+    assert data["result"].split()[1:] == [
+        "http://example.org#Alice,http://example.org#Bob",
+        "http://example.org#Bob,http://example.org#Calvin",
+    ]
+
+
+@pytest.mark.anyio
+async def test_select_query_with_unsupported_inference_mode() -> None:
+    """Should return 422 Unprocessable Entity."""
+    query = "SELECT ?s ?p ?o WHERE { ?s ?p ?o }"
+    data = "<http://example.org#Alice> a <http://example.org#Person> ."
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            json={"query": query, "data": data, "inference": "unsupported"},
+        )
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.anyio
+async def test_select_query_uses_cached_graphs_and_results(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Should return the same result from the shared cache."""
+    data = "<http://example.org#Alice> a <http://example.org#Person> ."
+    query = "SELECT ?s WHERE { ?s a ?o }"
+    parsed, evaluated = [], []
+    governed_graph, evaluate = sparql.governed_graph, sparql.evaluate
+    monkeypatch.setattr(
+        sparql, "governed_graph", lambda: parsed.append(1) or governed_graph()
+    )
+    monkeypatch.setattr(
+        sparql, "evaluate", lambda *args: evaluated.append(1) or evaluate(*args)
+    )
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.post("/sparql", json={"query": query, "data": data})
+        cached = await ac.post("/sparql", json={"query": query, "data": data})
+        # Another query on the same data reuses the parsed graph:
+        other_query = await ac.post(
+            "/sparql", json={"query": query + " LIMIT 1", "data": data}
+        )
+    assert first.status_code == HTTPStatus.OK, first.json()
+    assert cached.json() == first.json()
+    assert other_query.json() == first.json()
+    # The data was parsed once, and the same query evaluated once:
+    assert (len(parsed), len(evaluated)) == (1, 2)
@@ -0,0 +1,189 @@
+"""Test module for the literal text index."""
+
+from http import HTTPStatus
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib import Graph
+from rdflib.plugins.sparql import prepareQuery
+
+from app import app, textindex
+from app.routers import sparql
+from app.textindex import (
+    TextIndex,
+    accelerate_text_filters,
+    held,
+    required_substrings,
+    text_filters,
+    text_index,
+    trigrams,
+)
+
+DATA = """
+@prefix ex: <http://example.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+ex:a rdfs:label "Foobar" ; ex:note "colour" .
+ex:b rdfs:label "The FOO fighters"@en ; ex:note "color" .
+ex:c rdfs:label "bar" ; ex:note "collar" .
+ex:d rdfs:label "Food"^^<http://www.w3.org/2001/XMLSchema#string> .
+ex:e ex:seeAlso <http://example.org/foo> .
+"""
+PREFIXES = """
+PREFIX ex: <http://example.org/>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+"""
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+def test_search() -> None:
+    """Should find the literals containing all needles, ignoring case."""
+    index = TextIndex(Graph().parse(data=DATA))
+    assert trigrams("foob") == {"foo", "oob"}
+    assert sorted(map(str, index.search(["foo"]))) == [
+        "Foobar",
+        "Food",
+        "The FOO fighters",
+    ]
+    assert [str(lit) for lit in index.search(["foo", "bar"])] == ["Foobar"]
+    assert index.search(["xyz"]) == []
+
+
+@pytest.mark.parametrize(
+    ("text", "needle"), [("\u017ftra\u00dfe", "STRA"), ("D\u0131ZEL", "dizel")]
+)
+def test_search_folds_case_as_regexes(text: str, needle: str) -> None:
+    """Should find the literals a regex ignoring case matches, as without index."""
+    graph = Graph().parse(data=f'<urn:s> <urn:p> "{text}" .', format="nt")
+    query = f'SELECT ?l WHERE {{ ?s ?p ?l FILTER(REGEX(?l, "{needle}", "i")) }}'
+    expected = [str(row.l) for row in graph.query(query)]
+    parsed_query = prepareQuery(query)
+    accelerate_text_filters(parsed_query, lambda: TextIndex(graph))
+    assert [str(row.l) for row in graph.query(parsed_query)] == expected == [text]
+
+
+@pytest.mark.parametrize(
+    ("pattern", "substrings"),
+    [
+        ("foo", ["foo"]),
+        ("^foo.*bar$", ["foo", "bar"]),
+        ("colou?r", ["colo", "r"]),
+        ("ba+r", ["ba", "r"]),
+        ("ab{2,3}cd", ["a", "cd"]),
+        ("ab{2", ["a"]),
+        ("foo|bar", []),
+        ("fo(o)", []),
+        ("[fb]oo", []),
+        ("\\d+", []),
+    ],
+)
+def test_required_substrings(pattern: str, substrings: list[str]) -> None:
+    """Should get the substrings that every match contains."""
+    assert required_substrings(pattern) == substrings
+
+
+@pytest.mark.parametrize(
+    ("condition", "needles"),
+    [
+        ('CONTAINS(?l, "foo")', ["foo"]),
+        ('CONTAINS(LCASE(?l), "foo")', ["foo"]),
+        ('STRSTARTS(?l, "Foo")', ["Foo"]),
+        ('STRENDS(?l, "bar")', ["bar"]),
+        ('REGEX(?l, "^foo", "i")', ["foo"]),
+        ('CONTAINS(?l, "foo") && CONTAINS(?l, "bar")', ["foo"]),
+        ('?l != "x" && CONTAINS(?l, "bar")', ["bar"]),
+        ('CONTAINS(STR(?l), "foo")', None),
+        ("CONTAINS(?l, ?other)", None),
+        ('CONTAINS(?l, "fo")', None),
+        ('REGEX(?l, "foo", "x")', None),
+        ("REGEX(?l, ?pattern)", None),
+        ('CONTAINS(?l, "foo") || CONTAINS(?l, "bar")', None),
+    ],
+)
+def test_text_filters(condition: str, needles: list[str] | None) -> None:
+    """Should find the conjuncts that need a variable to contain needles."""
+    query = prepareQuery(f"SELECT * WHERE {{ ?s ?p ?l FILTER({condition}) }}")
+    expr = query.algebra.p.p.expr
+    found = list(text_filters(expr))
+    if needles is None:
+        assert found == []
+    else:
+        variable, found_needles = found[0]
+        assert (str(variable), found_needles) == ("l", needles)
+
+
+@pytest.mark.parametrize(
+    ("where", "accelerated"),
+    [
+        ('?s rdfs:label ?l FILTER(CONTAINS(LCASE(?l), "foo"))', 1),
+        ('?s rdfs:label ?l FILTER(CONTAINS(?l, "Foo"))', 1),
+        ('?s rdfs:label ?l FILTER(REGEX(?l, "^foo", "i"))', 1),
+        ('?s ex:note ?l FILTER(REGEX(?l, "colou?r"))', 1),
+        ('?s ?p ?l FILTER(CONTAINS(STR(?l), "foo"))', 0),
+        ('?s ?p ?l FILTER(CONTAINS(?l, "xyz"))', 1),
+        ('?s ?p ?l FILTER(CONTAINS(STR(?s), "foo") && CONTAINS(?s, "foo"))', 0),
+        ("?s ?p ?l FILTER(?l)", 0),
+        ('?s ?p ?o OPTIONAL { ?s rdfs:label ?l } FILTER(CONTAINS(?l, "foo"))', 0),
+        ('?s ?p ?o { ?s rdfs:label ?l FILTER(CONTAINS(?l, "bar")) }', 1),
+    ],
+)
+def test_accelerated_queries_have_the_same_results(
+    where: str, accelerated: int
+) -> None:
+    """Should return the same results with and without the index."""
+    graph = Graph().parse(data=DATA)
+    index = TextIndex(graph)
+    query = f"{PREFIXES} SELECT * WHERE {{ {where} }}"
+    expected = set(graph.query(prepareQuery(query)))
+    parsed_query = prepareQuery(query)
+    assert accelerate_text_filters(parsed_query, lambda: index) == accelerated
+    assert set(graph.query(parsed_query)) == expected
+
+
+def test_text_index_is_held_and_shared(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should keep indexes in memory, up to a limit, and in the shared cache."""
+    monkeypatch.setattr(textindex, "TEXT_INDEX_MAX_HELD", 1)
+    held.clear()
+    graph = Graph().parse(data=DATA)
+    index = text_index("textindex-a", graph)
+    assert text_index("textindex-a", graph) is index
+    held.clear()
+    shared = text_index("textindex-a", graph)
+    assert shared is not index
+    assert shared.search(["foo"]) == index.search(["foo"])
+    text_index("textindex-b", graph)
+    assert list(held) == ["textindex-b"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("enabled", [True, False])
+async def test_sparql_with_text_filter(
+    monkeypatch: pytest.MonkeyPatch, *, enabled: bool
+) -> None:
+    """Should return 200 OK, with the index of the graph held when enabled."""
+    monkeypatch.setattr(sparql, "TEXT_INDEX", enabled)
+    held.clear()
+    query = f"""{PREFIXES}
+    SELECT ?s WHERE {{ ?s rdfs:label ?l FILTER(CONTAINS(LCASE(?l), "foo")) }}
+    ORDER BY ?s
+    """
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/sparql",
+            headers={"Accept": "text/csv"},
+            json={"query": query, "data": DATA},
+        )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert response.json()["result"].split()[1:] == [
+        "http://example.org/a",
+        "http://example.org/b",
+        "http://example.org/d",
+    ]
+    assert len(held) == (1 if enabled else 0)
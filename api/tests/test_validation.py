@@ -0,0 +1,107 @@
+"""Test module for the parallel validation module."""
+
+import gc
+from pathlib import Path
+
+import pytest
+from pyshacl import ShapesGraph, validate
+from rdflib import Graph
+from rdflib.compare import isomorphic
+
+from app import memory, validation
+from app.validation import (
+    init_worker,
+    merge_reports,
+    partition,
+    process_pool,
+    validate_job_partition,
+    validate_parallel,
+    validate_partition,
+)
+
+EXAMPLE_FILES = Path(__file__).parent.parent / "example-files"
+
+
+@pytest.fixture
+def data_graph() -> Graph:
+    """Parse the example data."""
+    return Graph().parse(EXAMPLE_FILES / "data.ttl")
+
+
+@pytest.fixture
+def shapes_graph() -> Graph:
+    """Parse the example shapes."""
+    return Graph().parse(EXAMPLE_FILES / "shapes.ttl")
+
+
+def test_validate_parallel_is_identical_to_sequential(
+    data_graph: Graph,
+    shapes_graph: Graph,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Should return the same report as a sequential validation, from one pool."""
+    monkeypatch.setattr(validation, "SHACL_PARALLEL_MIN_TRIPLES", 0)
+    spill_directory = tmp_path / "spill"
+    spill_directory.mkdir()
+    monkeypatch.setattr(memory, "SPILL_DIR", spill_directory)
+    conforms, expected, _ = validate(data_graph=data_graph, shacl_graph=shapes_graph)
+
+    pool = process_pool(2)
+    for _ in range(2):
+        parallel_conforms, report = validate_parallel(
+            data_graph, shapes_graph, max_workers=2
+        )
+        assert parallel_conforms == conforms
+        assert isomorphic(report, expected)
+    assert process_pool(2) is pool
+
+    # The workers read the data graph from a database, deleted with it:
+    gc.collect()
+    assert not list(spill_directory.iterdir())
+
+
+def test_validate_small_graph_in_process(
+    data_graph: Graph, shapes_graph: Graph, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should not start a process pool for a graph below the threshold."""
+
+    def fail(_: int) -> None:
+        pytest.fail("A process pool was used")
+
+    monkeypatch.setattr(validation, "process_pool", fail)
+    conforms, expected, _ = validate(data_graph=data_graph, shacl_graph=shapes_graph)
+
+    parallel_conforms, report = validate_parallel(data_graph, shapes_graph)
+
+    assert parallel_conforms == conforms
+    assert isomorphic(report, expected)
+
+
+def test_validate_partitions_in_process(data_graph: Graph, shapes_graph: Graph) -> None:
+    """Should split the focus nodes into partitions and merge their reports."""
+    partitions = partition(data_graph, ShapesGraph(shapes_graph), max_workers=1)
+    assert len(partitions) == 3  # noqa: PLR2004 one per person
+
+    init_worker(data_graph, shapes_graph)
+    partials = [validate_partition(task) for task in partitions[:1]]
+    # Workers set up their validator once per validation:
+    partials += [
+        validate_job_partition("job", data_graph, shapes_graph, task)
+        for task in partitions[1:]
+    ]
+    conforms, report = merge_reports(shapes_graph, partials)
+
+    _, expected, _ = validate(data_graph=data_graph, shacl_graph=shapes_graph)
+    assert not conforms
+    assert isomorphic(report, expected)
+
+
+def test_validate_parallel_without_focus_nodes(shapes_graph: Graph) -> None:
+    """Should return a conforming report."""
+    conforms, expected, _ = validate(data_graph=Graph(), shacl_graph=shapes_graph)
+
+    parallel_conforms, report = validate_parallel(Graph(), shapes_graph)
+
+    assert parallel_conforms == conforms
+    assert isomorphic(report, expected)
@@ -0,0 +1,366 @@
+"""Test module for the materialized views of datasets."""
+
+from http import HTTPStatus
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from rdflib import RDF, Graph, Literal, URIRef, Variable
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+
+from app import app
+from app import datasets as datasets_module
+from app.datasets import Dataset, datasets
+from app.views import Counting, counting_of, materialize, read_predicates, refresh
+
+EX = "http://example.org/"
+DATA = f"""
+@prefix ex: <{EX}> .
+
+ex:Alice a ex:Person ; ex:knows ex:Bob ; ex:name "Alice" .
+ex:Bob a ex:Person ; ex:knows ex:Alice ; ex:name "Bob" .
+ex:Acme a ex:Company .
+"""
+COUNTS = """
+SELECT ?class (COUNT(?s) AS ?count)
+WHERE { ?s a ?class }
+GROUP BY ?class
+ORDER BY ?class
+"""
+KNOWS = f"SELECT (COUNT(*) AS ?count) WHERE {{ ?s <{EX}knows> ?o }}"
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Use the asyncio backend for the anyio fixture."""
+    return "asyncio"
+
+
+@pytest.fixture
+async def client() -> AsyncClient:
+    """Get a client for the app, with a dataset named people and two views."""
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.put("/datasets/people", json={"data": DATA})
+        assert response.status_code == HTTPStatus.OK, response.json()
+        for name, query in (("counts", COUNTS), ("knows", KNOWS)):
+            response = await ac.put(
+                f"/datasets/people/views/{name}", json={"query": query}
+            )
+            assert response.status_code == HTTPStatus.OK, response.json()
+        yield ac
+
+
+async def select(client: AsyncClient, query: str, **kwargs: str) -> list[str]:
+    """Run a SELECT query on the people dataset and get its CSV rows."""
+    response = await client.post(
+        "/sparql",
+        headers={"Accept": "text/csv"},
+        json={"dataset": "people", "query": query, **kwargs},
+    )
+    assert response.status_code == HTTPStatus.OK, response.json()
+    return response.json()["result"].split()
+
+
+async def update(client: AsyncClient, update: str) -> None:
+    """Run an update on the people dataset."""
+    response = await client.post(
+        "/sparql/update", json={"dataset": "people", "update": update}
+    )
+    assert response.status_code == HTTPStatus.OK, response.json()
+
+
+@pytest.mark.parametrize(
+    ("query", "predicates"),
+    [
+        (KNOWS, {f"{EX}knows"}),
+        (COUNTS, {"http://www.w3.org/1999/02/22-rdf-syntax-ns#type"}),
+        (
+            (
+                f"SELECT * WHERE {{ ?s (<{EX}a>/^<{EX}b>)|<{EX}c>* ?o "
+                f"{{ SELECT ?s WHERE {{ ?s <{EX}d>+ ?x }} }} }}"
+            ),
+            {f"{EX}{name}" for name in "abcd"},
+        ),
+        (
+            (
+                f"SELECT (COUNT(?s) AS ?n) WHERE {{ ?s a <{EX}C> "
+                f"FILTER NOT EXISTS {{ ?s <{EX}deleted> true ; <{EX}a>/<{EX}b> 1 }} }}"
+            ),
+            {"http://www.w3.org/1999/02/22-rdf-syntax-ns#type"}
+            | {f"{EX}{name}" for name in ("deleted", "a", "b")},
+        ),
+        (
+            f"SELECT * WHERE {{ ?s a <{EX}C> FILTER EXISTS {{ ?s ?p 1 }} }}",
+            None,
+        ),
+        ("SELECT * WHERE { ?s ?p ?o }", None),
+        (f"SELECT * WHERE {{ ?s !<{EX}a> ?o }}", None),
+        (f"SELECT * WHERE {{ ?s <{EX}a>/!<{EX}b> ?o }}", None),
+    ],
+)
+def test_read_predicates(query: str, predicates: set[str] | None) -> None:
+    """Should get the predicates a query reads, or None if it may read any."""
+    expected = None if predicates is None else {URIRef(p) for p in predicates}
+    assert read_predicates(prepareQuery(query)) == expected
+
+
+def test_matches_keeps_whitespace_in_literals() -> None:
+    """Should tell apart queries whose string literals differ in whitespace."""
+    query = f'SELECT ?s WHERE {{ ?s <{EX}name> "Alice  Smith" }}'
+    view = materialize(query, Graph(), 1)
+    assert view.matches(f'  SELECT ?s\nWHERE {{\n  ?s <{EX}name> "Alice  Smith"\n}}')
+    assert not view.matches(f'SELECT ?s WHERE {{ ?s <{EX}name> "Alice Smith" }}')
+    assert not view.matches(f"SELECT ?s WHERE {{ ?s <{EX}name> 'Alice\tSmith' }}")
+
+
+@pytest.mark.anyio
+async def test_create_get_and_delete_view(client: AsyncClient) -> None:
+    """Should materialize a view until it is deleted."""
+    response = await client.get("/datasets/people/views/counts")
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert response.json() == {
+        "dataset": "people",
+        "name": "counts",
+        "query": COUNTS,
+        "version": 1,
+        "refreshed": 1,
+        "length": 2,
+        "predicates": ["http://www.w3.org/1999/02/22-rdf-syntax-ns#type"],
+    }
+
+    response = await client.delete("/datasets/people/views/counts")
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    response = await client.get("/datasets/people/views/counts")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = await client.delete("/datasets/people/views/counts")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+    # Deleting the dataset deletes its views:
+    response = await client.delete("/datasets/people")
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    response = await client.put("/datasets/people", json={"data": DATA})
+    response = await client.get("/datasets/people/views/knows")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    ("path", "body", "status_code"),
+    [
+        ("/datasets/other/views/counts", {"query": COUNTS}, HTTPStatus.NOT_FOUND),
+        ("/datasets/people/views/counts", {"query": "SELECT"}, HTTPStatus.BAD_REQUEST),
+        (
+            "/datasets/people/views/counts",
+            {"query": "ASK { ?s ?p ?o }"},
+            HTTPStatus.BAD_REQUEST,
+        ),
+        (
+            "/datasets/people/views/not.valid",
+            {"query": COUNTS},
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+        ),
+    ],
+)
+async def test_invalid_view(
+    client: AsyncClient, path: str, body: dict[str, str], status_code: int
+) -> None:
+    """Should reject the view and keep the registered one."""
+    response = await client.put(path, json=body)
+    assert response.status_code == status_code, response.json()
+    response = await client.get("/datasets/people/views/counts")
+    assert response.json()["query"] == COUNTS
+
+
+@pytest.mark.anyio
+async def test_query_is_answered_from_view(
+    client: AsyncClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Should answer a query with the same text as a view from its table."""
+
+    def fail(*_: object) -> None:
+        pytest.fail("The query was evaluated")
+
+    # Queries with the same text, up to whitespace, are not evaluated:
+    with monkeypatch.context() as m:
+        m.setattr("app.routers.sparql.load_source", fail)
+        assert await select(client, " ".join(COUNTS.split())) == [
+            "class,count",
+            f"{EX}Company,1",
+            f"{EX}Person,2",
+        ]
+        response = await client.post(
+            "/sparql", json={"dataset": "people", "query": KNOWS}
+        )
+        assert response.status_code == HTTPStatus.OK, response.json()
+        assert response.json()["length"] == 1
+
+    # Queries with inference are evaluated:
+    assert await select(client, COUNTS, inference="rdfs") != await select(
+        client, COUNTS
+    )
+
+
+@pytest.mark.anyio
+async def test_views_are_refreshed_by_the_predicates_they_read(
+    client: AsyncClient,
+) -> None:
+    """Should evaluate a view again only if the update changed its predicates."""
+    await update(client, f"INSERT DATA {{ <{EX}Carol> a <{EX}Person> }}")
+    assert await select(client, COUNTS) == [
+        "class,count",
+        f"{EX}Company,1",
+        f"{EX}Person,3",
+    ]
+    response = await client.get("/datasets/people/views/counts")
+    assert (response.json()["version"], response.json()["refreshed"]) == (2, 2)
+    # The update did not change the predicate of this view:
+    response = await client.get("/datasets/people/views/knows")
+    assert (response.json()["version"], response.json()["refreshed"]) == (2, 1)
+    assert await select(client, KNOWS) == ["count", "2"]
+
+    await update(client, f"INSERT DATA {{ <{EX}Carol> <{EX}knows> <{EX}Bob> }}")
+    assert await select(client, KNOWS) == ["count", "3"]
+    response = await client.get("/datasets/people/views/counts")
+    assert (response.json()["version"], response.json()["refreshed"]) == (3, 2)
+
+    # Replacing the data refreshes all views:
+    await client.put("/datasets/people", json={"data": ""})
+    assert await select(client, KNOWS) == ["count", "0"]
+    assert await select(client, COUNTS) == ["class,count"]
+
+
+@pytest.mark.anyio
+async def test_other_workers_read_the_latest_views(client: AsyncClient) -> None:
+    """Should read the views refreshed by another worker."""
+    other_worker = Dataset("people", datasets.directory)
+    view = other_worker.view(KNOWS)
+    assert view is not None
+    assert view.version == 1
+
+    await update(client, f"INSERT DATA {{ <{EX}Carol> <{EX}knows> <{EX}Bob> }}")
+    view = other_worker.view(KNOWS)
+    assert view is not None
+    assert (view.version, view.rows[0][0].toPython()) == (2, 3)
+    assert other_worker.view("SELECT * WHERE { ?s ?p ?o }") is None
+
+
+@pytest.mark.parametrize(
+    ("query", "counting"),
+    [
+        (
+            KNOWS,
+            Counting(
+                [(Variable("s"), URIRef(EX + "knows"), Variable("o"))], [], [None]
+            ),
+        ),
+        (
+            "SELECT ?c (COUNT(?s) AS ?n) WHERE { ?s a ?c ; ?p 1 } GROUP BY ?c",
+            Counting(
+                [
+                    (Variable("s"), Variable("p"), Literal(1)),
+                    (Variable("s"), RDF.type, Variable("c")),
+                ],
+                [Variable("c")],
+                [Variable("c"), None],
+            ),
+        ),
+        (COUNTS, None),
+        ("SELECT DISTINCT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }", None),
+        ("SELECT (COUNT(DISTINCT ?s) AS ?n) WHERE { ?s ?p ?o }", None),
+        ("SELECT (COUNT(?x) AS ?n) WHERE { ?s ?p ?o }", None),
+        ("SELECT (SUM(?o) AS ?n) WHERE { ?s ?p ?o }", None),
+        ("SELECT (COUNT(*) + 1 AS ?n) WHERE { ?s ?p ?o }", None),
+        ("SELECT ?c WHERE { ?s a ?c } GROUP BY ?c", None),
+        ("SELECT (COUNT(*) AS ?n) WHERE { ?s a ?c } GROUP BY ?c", None),
+        ("SELECT ?c (COUNT(*) AS ?n) WHERE { ?s a ?c } GROUP BY (STR(?c))", None),
+        ("SELECT (COUNT(*) AS ?n) WHERE { ?s a ?c FILTER(?c) }", None),
+        (f"SELECT (COUNT(*) AS ?n) WHERE {{ [] <{EX}a> ?o }}", None),
+        (f"SELECT (COUNT(*) AS ?n) WHERE {{ ?s <{EX}a>/<{EX}b> ?o }}", None),
+        ("SELECT * WHERE { ?s ?p ?o }", None),
+    ],
+)
+def test_counting_of(query: str, counting: Counting | None) -> None:
+    """Should match the queries counting the solutions of a basic graph pattern."""
+    assert counting_of(prepareQuery(query)) == counting
+
+
+def test_counting_views_are_updated_from_the_delta(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Should update counting views as evaluating them again would."""
+    queries = [
+        KNOWS,
+        "SELECT ?c (COUNT(*) AS ?n) WHERE { ?s a ?c } GROUP BY ?c",
+        (
+            f"SELECT (COUNT(?o) AS ?n) ?c WHERE {{ ?s a ?c ; <{EX}knows> ?o . "
+            f"?o a ?c }} GROUP BY ?c"
+        ),
+        f"SELECT (COUNT(*) AS ?n) WHERE {{ ?s a ?c . ?o <{EX}knows> ?o }}",
+    ]
+    dataset = datasets.create("people", Graph().parse(data=DATA))
+    for i, query in enumerate(queries):
+        dataset.put_view(str(i), query)
+    materialized = []
+    monkeypatch.setattr(
+        "app.views.materialize",
+        lambda *args: materialized.append(args) or materialize(*args),
+    )
+    for updates in (
+        [f"INSERT DATA {{ <{EX}Carol> a <{EX}Person> ; <{EX}knows> <{EX}Alice> }}"],
+        [f"INSERT DATA {{ <{EX}Dave> a <{EX}Person> ; <{EX}knows> <{EX}Dave> }}"],
+        [f"DELETE WHERE {{ <{EX}Acme> ?p ?o }}"],
+        [f"DELETE WHERE {{ <{EX}Alice> ?p ?o }}"],
+        # Changes undone within the transaction:
+        [
+            f"INSERT DATA {{ <{EX}Eve> a <{EX}Company> }}",
+            f"DELETE DATA {{ <{EX}Eve> a <{EX}Company> }}",
+            f"DELETE DATA {{ <{EX}Dave> a <{EX}Person> }}",
+            f"INSERT DATA {{ <{EX}Dave> a <{EX}Person> }}",
+        ],
+    ):
+        dataset.commit(list(map(prepareUpdate, updates)))
+        version, graph = dataset.snapshot()
+        for name, query in enumerate(queries):
+            view = dataset.view(query)
+            assert view is not None, name
+            expected = materialize(query, graph, version)
+            assert sorted(view.rows) == sorted(expected.rows), name
+    assert materialized == []
+
+
+def test_stale_views_are_evaluated_again() -> None:
+    """Should evaluate a view again if it missed a version of the dataset."""
+    graph = Graph().parse(data=DATA)
+    view = materialize(KNOWS, Graph(), 1)
+    refreshed = refresh(view, graph, 3, None)
+    assert (refreshed.version, refreshed.refreshed) == (3, 3)
+    assert refreshed.rows == materialize(KNOWS, graph, 3).rows
+
+
+def test_views_are_refreshed_outside_the_lock(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should keep the views replaced while the others were refreshed."""
+    dataset = datasets.create("people", Graph().parse(data=DATA))
+    dataset.put_view("knows", KNOWS)
+    dataset.put_view("counts", COUNTS)
+
+    def replace_view(*args: object) -> object:
+        # Would deadlock if the dataset were still locked:
+        dataset.put_view("counts", KNOWS)
+        return refresh(*args)
+
+    monkeypatch.setattr(datasets_module, "refresh", replace_view)
+    dataset.commit([prepareUpdate(f"INSERT DATA {{ <{EX}Carol> a <{EX}Person> }}")])
+    views = dataset.views()
+    assert views["counts"].query == KNOWS
+    assert views["knows"].version == 2  # noqa: PLR2004
+
+    # Views deleted meanwhile are not written back:
+    def delete_views(*args: object) -> object:
+        for name in list(dataset.views()):
+            dataset.delete_view(name)
+        return refresh(*args)
+
+    monkeypatch.setattr(datasets_module, "refresh", delete_views)
+    dataset.commit([prepareUpdate(f"INSERT DATA {{ <{EX}Dave> a <{EX}Person> }}")])
+    assert dataset.views() == {}